@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the removal of the unaccepted invitations of deleted users as
+``_user_removed`` used to do it (a catalog query for the username and
+another one for the email of each user) with
+``nti.app.invitations.utils.remove_sent_invitations``, called once per
+user and once for all of the users.
+
+Every path removes each invitation through the container, so its
+removal events unregister its intid and unindex it from the invitations
+catalog and from a second catalog that stands for the other catalogs
+(e.g. metadata).
+
+``nti.app.invitations.utils`` needs the dataserver stack to be
+importable; the container, intids and catalogs themselves are the plain
+``zope.container``, ``zope.intid`` and ``zc.catalog`` objects set up
+here, not those of a dataserver.
+
+    python benchmarks/bench_remove_invitations.py [users] [repeat]
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import sys
+import time
+import functools
+
+from persistent import Persistent
+
+from zope import component
+from zope import interface
+
+from zope.catalog.catalog import Catalog
+from zope.catalog.catalog import indexDocSubscriber
+from zope.catalog.catalog import unindexDocSubscriber
+
+from zope.catalog.interfaces import ICatalog
+
+from zope.component.event import objectEventNotify
+
+from zope.component.hooks import setHooks
+
+from zope.container.btree import BTreeContainer
+
+from zope.container.contained import Contained
+
+from zope.intid import IntIds
+from zope.intid import addIntIdSubscriber
+from zope.intid import removeIntIdSubscriber
+
+from zope.intid.interfaces import IIntIds
+from zope.intid.interfaces import IIntIdAddedEvent
+from zope.intid.interfaces import IIntIdRemovedEvent
+
+from zope.keyreference.interfaces import IKeyReference
+
+from zope.lifecycleevent.interfaces import IObjectAddedEvent
+from zope.lifecycleevent.interfaces import IObjectRemovedEvent
+
+from zc.catalog.catalogindex import ValueIndex
+
+from nti.app.invitations.utils import remove_invitations
+from nti.app.invitations.utils import get_sent_invitation_ids
+from nti.app.invitations.utils import remove_sent_invitations
+
+from nti.invitations.index import IX_SITE
+from nti.invitations.index import IX_SENDER
+from nti.invitations.index import IX_ACCEPTED
+from nti.invitations.index import IX_MIMETYPE
+from nti.invitations.index import IX_RECEIVER
+from nti.invitations.index import IX_EXPIRYTIME
+
+#: The invitations catalog indexes and the attributes they index
+INDEXES = ((IX_SENDER, 'sender'),
+           (IX_RECEIVER, 'receiver'),
+           (IX_ACCEPTED, 'accepted'),
+           (IX_SITE, 'site'),
+           (IX_MIMETYPE, 'mimeType'),
+           (IX_EXPIRYTIME, 'expiryTime'))
+
+
+class IBenchInvitation(interface.Interface):
+    pass
+
+
+@interface.implementer(IBenchInvitation)
+class Invitation(Persistent, Contained):
+
+    counter = 0
+
+    def __init__(self, code, sender):
+        Invitation.counter += 1
+        self.key = Invitation.counter
+        self.code = code
+        self.sender = sender
+        self.receiver = code + u'@example.com'
+        self.accepted = False
+        self.site = u'example.com'
+        self.mimeType = u'application/vnd.nextthought.siteinvitation'
+        self.expiryTime = 0
+
+
+@interface.implementer(IKeyReference)
+@component.adapter(IBenchInvitation)
+class _KeyReference(object):
+
+    key_type_id = 'bench'
+
+    def __init__(self, ob):
+        self.ob = ob
+        self.key = ob.key
+
+    def __call__(self):
+        return self.ob
+
+    def __hash__(self):
+        return self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+class InvitationsContainer(BTreeContainer):
+
+    def add(self, invitation):
+        self[invitation.code] = invitation
+
+    def remove(self, invitation):
+        del self[invitation.code]
+
+
+def _setup():
+    # Unlocated objects use the global components
+    setHooks()
+    gsm = component.getGlobalSiteManager()
+    gsm.registerAdapter(_KeyReference)
+    gsm.registerHandler(objectEventNotify)
+    gsm.registerHandler(addIntIdSubscriber,
+                        (IBenchInvitation, IObjectAddedEvent))
+    gsm.registerHandler(removeIntIdSubscriber,
+                        (IBenchInvitation, IObjectRemovedEvent))
+    gsm.registerHandler(indexDocSubscriber, (IIntIdAddedEvent,))
+    gsm.registerHandler(unindexDocSubscriber, (IIntIdRemovedEvent,))
+
+
+def _populate(users, per_user, others):
+    gsm = component.getGlobalSiteManager()
+    intids = IntIds()
+    gsm.registerUtility(intids, IIntIds)
+    catalog = Catalog()
+    for name, attr in INDEXES:
+        catalog[name] = ValueIndex(attr, IBenchInvitation, field_callable=False)
+    metadata = Catalog()
+    for name in ('sender', 'site'):
+        metadata[name] = ValueIndex(name, IBenchInvitation, field_callable=False)
+    gsm.registerUtility(catalog, ICatalog, name='invitations')
+    gsm.registerUtility(metadata, ICatalog, name='metadata')
+    container = InvitationsContainer()
+    for user in range(users):
+        for idx in range(per_user):
+            # Sent by username and by email
+            sender = u'user%s' % user
+            if idx % 2:
+                sender += u'@example.com'
+            container.add(Invitation(u'u%sc%s' % (user, idx), sender))
+    for idx in range(others):
+        container.add(Invitation(u'other%s' % idx, u'other'))
+    return container, intids, catalog
+
+
+def _senders(user):
+    return (u'user%s' % user, u'user%s@example.com' % user)
+
+
+def remove_each(container, intids, catalog, users):
+    # As _user_removed did: a query for the username, another one for
+    # the email, then each invitation
+    for user in range(users):
+        doc_ids = set()
+        for sender in _senders(user):
+            doc_ids.update(get_sent_invitation_ids((sender,), catalog=catalog))
+        remove_invitations(doc_ids, container, intids)
+
+
+def remove_per_user(container, intids, catalog, users):
+    for user in range(users):
+        remove_sent_invitations(_senders(user), container, intids, catalog)
+
+
+def remove_all(container, intids, catalog, users):
+    senders = []
+    for user in range(users):
+        senders.extend(_senders(user))
+    remove_sent_invitations(senders, container, intids, catalog)
+
+
+def _measure(func, users, per_user, others, repeat):
+    best = None
+    for _ in range(repeat):
+        component.getGlobalSiteManager().__init__('base')
+        _setup()
+        container, intids, catalog = _populate(users, per_user, others)
+        start = time.time()
+        func(container, intids, catalog, users)
+        elapsed = time.time() - start
+        assert len(container) == others
+        assert len(intids) == others
+        assert catalog[IX_SENDER].documentCount() == others
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(users=10000, repeat=3, per_user=3, others=10000):
+    measure = functools.partial(_measure, users=users, per_user=per_user,
+                                others=others, repeat=repeat)
+    each = measure(remove_each)
+    per_user_ = measure(remove_per_user)
+    all_ = measure(remove_all)
+    print('best of %s, %s users with %s pending invitations each, %s others'
+          % (repeat, users, per_user, others))
+    print('two queries per user  %8.1f ms' % (each * 1000))
+    print('one query per user    %8.1f ms  (%.1fx)'
+          % (per_user_ * 1000, each / per_user_))
+    print('one query for all     %8.1f ms  (%.1fx)'
+          % (all_ * 1000, each / all_))
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare rendering the site invitation email templates for each receiver
+with rendering them once per sender and message and personalizing the
+result by substitution, as the invitation email dispatcher does.
+
+Requires ``chameleon`` and ``mako``. The macros of the real templates
+(provided by the application at runtime) are left out and their
+``options`` path expressions are evaluated as python. Both ways must
+render the same bodies, with and without the ``h`` default filter of
+the text templates, before anything is timed.
+
+    python benchmarks/bench_render_invitation_email.py [count] [repeat]
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import re
+import sys
+import timeit
+
+from chameleon import PageTemplate
+
+from mako.template import Template
+
+# As in nti.app.invitations.mailing
+_PROBE_FORMS = (
+    (u'&', (u'&amp;', u'&#38;', u'&#x26;', u'&')),
+    (u'<', (u'&lt;', u'&#60;', u'&#x3c;', u'<')),
+    (u'>', (u'&gt;', u'&#62;', u'&#x3e;', u'>')),
+    (u'"', (u'&quot;', u'&#34;', u'&#x22;', u'"')),
+    (u"'", (u'&#39;', u'&#x27;', u'&apos;', u"'")),
+)
+
+_PROBE = u''.join(x[0] for x in _PROBE_FORMS)
+
+RECEIVER_NAME_TOKEN = u'nti0invitation0receiver0name' + _PROBE
+REDEMPTION_LINK_TOKEN = u'nti0invitation0redemption0link' + _PROBE
+
+
+def _placeholder_pattern(*tokens):
+    names = u'|'.join(re.escape(x[:-len(_PROBE)]) for x in tokens)
+    groups = (u'(%s)' % u'|'.join(re.escape(x) for x in forms)
+              for _, forms in _PROBE_FORMS)
+    return re.compile(u'(%s)%s' % (names, u''.join(groups)))
+
+
+_PLACEHOLDER_PATTERN = _placeholder_pattern(RECEIVER_NAME_TOKEN,
+                                            REDEMPTION_LINK_TOKEN)
+
+
+def _split(body):
+    result = []
+    start = 0
+    for match in _PLACEHOLDER_PATTERN.finditer(body):
+        result.append(body[start:match.start()])
+        table = dict((ord(char), match.group(idx + 2))
+                     for idx, (char, _) in enumerate(_PROBE_FORMS))
+        result.append((match.group(1) + _PROBE, table))
+        start = match.end()
+    result.append(body[start:])
+    text = u''.join(x for x in result if not isinstance(x, tuple))
+    if any(x[:-len(_PROBE)] in text
+           for x in (RECEIVER_NAME_TOKEN, REDEMPTION_LINK_TOKEN)):
+        return None
+    return result
+
+
+def _personalize(parts, values):
+    return u''.join(values[x[0]].translate(x[1]) if isinstance(x, tuple) else x
+                    for x in parts)
+
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), '..',
+                         'src', 'nti', 'app', 'invitations', 'templates')
+
+
+def _read(name):
+    with open(os.path.join(TEMPLATES, name)) as f:
+        return f.read()
+
+
+class _Options(dict):
+
+    def __getattr__(self, name):
+        value = self[name]
+        return _Options(value) if isinstance(value, dict) else value
+
+
+def _load(name, default_filters=None):
+    html = _read(name + '.pt')
+    # The macros of the application are not available
+    html = re.sub(r'metal:use-macro="[^"]*"', '', html)
+    # Nor is the lenient parser of the application
+    html = re.sub(r'<(link|hr|br|img)(\s[^>]*[^/]|)>', r'<\1\2 />', html)
+    html = re.sub(r'options((?:/\w+)+)',
+                  lambda m: 'options' + m.group(1).replace('/', '.'),
+                  html)
+    return PageTemplate(html), Template(_read(name + '.mak'),
+                                        default_filters=default_filters)
+
+
+def _args(receiver_name, redemption_link):
+    return {
+        'receiver_name': receiver_name,
+        'support_email': u'support@example.com',
+        'redemption_link': redemption_link,
+        'brand': u'Example',
+        'custom_image_macro': None,
+        'tagline': u'Learning',
+        'brand_message': None,
+        'sender_content': {
+            'sender': u'Sender',
+            'message': u'Join us & learn',
+            'avatar_styles': u'float:left;height:40px;width:40px;',
+        },
+    }
+
+
+def _receivers(count):
+    return [(u'User <%s> & "O\'Hara"' % i,
+             u'http://example.com/invitations?code=%08d&x="1"' % i)
+            for i in range(count)]
+
+
+def render_each(templates, receivers):
+    html, text = templates
+    result = []
+    for name, link in receivers:
+        args = _args(name, link)
+        result.append((html.render(options=_Options(args)), text.render(**args)))
+    return result
+
+
+def render_once(templates, personalized, receivers):
+    html, text = templates
+    args = _args(RECEIVER_NAME_TOKEN, REDEMPTION_LINK_TOKEN)
+    shared_html = html.render(options=_Options(args))
+    shared_text = text.render(**args)
+    shared_html, shared_text = _split(shared_html), _split(shared_text)
+    personalized_html, personalized_text = personalized
+    result = []
+    for name, link in receivers:
+        values = {RECEIVER_NAME_TOKEN: name, REDEMPTION_LINK_TOKEN: link}
+        body = _personalize(shared_html, values)
+        plain = _personalize(shared_text, values)
+        result.append((personalized_html.render(options=_Options(html=body)),
+                       personalized_text.render(text=plain)))
+    return result
+
+
+def main(counts=(1000, 10000), repeat=3):
+    templates = _load('site_invitation_email')
+    personalized = _load('site_invitation_email_personalized')
+    # Also with the html escaping default filter of pyramid_mako
+    for default_filters in (None, ['h']):
+        each = _load('site_invitation_email', default_filters)
+        once = _load('site_invitation_email_personalized', default_filters)
+        assert render_each(each, _receivers(10)) \
+            == render_once(each, once, _receivers(10))
+    print('best of %s' % repeat)
+    for count in counts:
+        receivers = _receivers(count)
+        each = min(timeit.repeat(lambda: render_each(templates, receivers),
+                                 number=1, repeat=repeat))
+        once = min(timeit.repeat(lambda: render_once(templates, personalized, receivers),
+                                 number=1, repeat=repeat))
+        print('%6s receivers  render each %8.1f ms  render once %8.1f ms  (%.1fx)'
+              % (count, each * 1000, once * 1000, each / once))
+
+
+if __name__ == '__main__':
+    args = [int(x) for x in sys.argv[1:]]
+    counts = (args[0],) if args else (1000, 10000)
+    main(counts, *args[1:])
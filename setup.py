@@ -8,6 +8,8 @@ entry_points = {
     ],
     'console_scripts': [
         "nti_invite_user = nti.app.invitations.scripts.nti_invite_user:main",
+        "nti_drain_invitation_emails = nti.app.invitations.scripts.nti_drain_invitation_emails:main",
+        "nti_rebuild_invitations_catalog = nti.app.invitations.scripts.nti_rebuild_invitations_catalog:main",
     ],
 }
 
@@ -60,6 +62,7 @@ setup(
     tests_require=TESTS_REQUIRE,
     install_requires=[
         'setuptools',
+        'gevent',
 	'nti.dataserver',
         'nti.externalization',
         'nti.invitations',
@@ -70,15 +73,21 @@ setup(
         'requests',
         'pyramid',
         'six',
+        'transaction',
+        'zc.catalog',
         'zc.intid',
         'zope.cachedescriptors',
+        'zope.catalog',
         'zope.component',
+        'zope.container',
         'zope.event',
         'zope.generations',
         'zope.i18nmessageid',
+        'zope.index',
         'zope.intid',
         'zope.interface',
         'zope.location',
+        'zope.processlifetime',
         'zope.security',
         'zope.traversing',
     ],
@@ -59,6 +59,10 @@ REL_PENDING_INVITATIONS = u'pending-invitations'
 #: site admin can ``GET`` the outstanding site invitations
 REL_PENDING_SITE_INVITATIONS = u'pending-site-invitations'
 
+#: The link relationship to which an authenticated
+#: site admin can ``GET`` the site invitation counts by status and mimetype
+REL_SITE_INVITATION_COUNTS = u'site-invitation-counts'
+
 #: The link relationship type to which an authenticated
 #: user can ``POST`` data to accept outstanding invitations. Also the name of a
 #: view to handle this feedback: :func:`accept_invitations_view`
@@ -97,6 +101,9 @@ GENERIC_SITE_INVITATION_MIMETYPE = u'application/vnd.nextthought.genericsiteinvi
 #: elsewhere as a parameter for querying the invitation catalog
 SITE_ADMIN_INVITATION_MIMETYPE = u'application/vnd.nextthought.siteadmininvitation'
 
+#: The mimeType for the background jobs sending large site invitation uploads
+SITE_INVITATION_JOB_MIMETYPE = u'application/vnd.nextthought.siteinvitationjob'
+
 #: The key for a request session that has a user's invitation code
 SITE_INVITATION_SESSION_KEY = u'site_invitation_code'
 
@@ -9,9 +9,16 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 from zope import component
+from zope import interface
+
+from nti.app.invitations.interfaces import IInvitationReceiverTerms
 
 from nti.app.invitations.invitations import InvitationInfo
 
+from nti.dataserver.users.interfaces import IFriendlyNamed
+
+from nti.dataserver.users.users import User
+
 from nti.invitations.interfaces import IInvitation
 
 logger = __import__('logging').getLogger(__name__)
@@ -19,4 +26,29 @@ logger = __import__('logging').getLogger(__name__)
 
 @component.adapter(IInvitation)
 def invitation_info(invitation):
-    return InvitationInfo(invitation)
\ No newline at end of file
+    return InvitationInfo(invitation)
+
+
+@component.adapter(IInvitation)
+@interface.implementer(IInvitationReceiverTerms)
+class InvitationReceiverTerms(object):
+
+    def __init__(self, invitation):
+        self.invitation = invitation
+
+    @property
+    def terms(self):
+        invitation = self.invitation
+        values = [invitation.receiver, invitation.original_receiver]
+        user = User.get_user(invitation.receiver) if invitation.receiver else None
+        if user is not None:
+            named = IFriendlyNamed(user, None)
+            values.append(getattr(named, 'realname', None))
+            values.append(getattr(named, 'alias', None))
+        result = set()
+        for value in values:
+            if value:
+                value = value.lower()
+                result.add(value)
+                result.update(value.split())
+        return tuple(result)
@@ -8,6 +8,8 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+from pyramid import httpexceptions as hexc
+
 from pyramid.view import view_config
 from pyramid.view import view_defaults
 
@@ -15,15 +17,18 @@ from requests.structures import CaseInsensitiveDict
 
 import six
 
-from zope import component
-
-from zope.intid.interfaces import IIntIds
-
 from nti.app.base.abstract_views import AbstractAuthenticatedView
 
+from nti.app.externalization.error import raise_json_error
+
 from nti.app.externalization.view_mixins import BatchingUtilsMixin
 from nti.app.externalization.view_mixins import ModeledContentUploadRequestUtilsMixin
 
+from nti.app.invitations import MessageFactory as _
+
+from nti.app.invitations.index import reindex_invitations
+from nti.app.invitations.index import unindex_stale_invitations
+
 from nti.app.invitations.views import InvitationsPathAdapter
 
 from nti.dataserver import authorization as nauth
@@ -33,15 +38,11 @@ from nti.externalization.interfaces import StandardExternalFields
 
 from nti.invitations.index import get_invitations_catalog
 
-from nti.invitations.interfaces import IInvitationsContainer
-
 from nti.invitations.utils import get_invitations
 from nti.invitations.utils import get_expired_invitations
 from nti.invitations.utils import get_pending_invitations
 from nti.invitations.utils import delete_expired_invitations
 
-from nti.metadata import queue_add
-
 ITEMS = StandardExternalFields.ITEMS
 TOTAL = StandardExternalFields.TOTAL
 ITEM_COUNT = StandardExternalFields.ITEM_COUNT
@@ -157,23 +158,65 @@ class DeleteExpiredInvitationsView(AbstractAuthenticatedView,
                request_method='POST',
                name="RebuildInvitationsCatalog",
                permission=nauth.ACT_NTI_ADMIN)
-class RebuildInvitationsCatalogView(AbstractAuthenticatedView):
+class RebuildInvitationsCatalogView(AbstractAuthenticatedView,
+                                    ModeledContentUploadRequestUtilsMixin):
+    """
+    Rebuild the invitations catalog.
+
+    By default every invitation is reindexed in the request transaction.
+    Given a ``chunk_size``, only that many invitations are reindexed per
+    request (and thus per commit) and each response carries the
+    ``Cursor`` to post next, ``None`` once the rebuild is done. After a
+    failure the rebuild resumes by posting the last returned cursor.
+
+    The catalog is reindexed in place, so queries keep working during a
+    chunked rebuild; the doc ids of invitations that are gone are
+    unindexed once the rebuild is done.
+    """
+
+    def readInput(self, value=None):
+        result = None
+        if self.request.body:
+            result = super(RebuildInvitationsCatalogView, self).readInput(value)
+        result = CaseInsensitiveDict(result or {})
+        for name, value in self.request.params.items():
+            result.setdefault(name, value)
+        return result
+
+    def _get_chunk_size(self, values):
+        chunk_size = values.get('chunk_size') or values.get('chunkSize')
+        if chunk_size in (None, ''):
+            return None
+        try:
+            chunk_size = int(chunk_size)
+        except (TypeError, ValueError):
+            chunk_size = 0
+        if chunk_size <= 0:
+            raise_json_error(self.request,
+                             hexc.HTTPUnprocessableEntity,
+                             {
+                                 'message': _(u"Invalid chunk size."),
+                                 'code': 'InvalidChunkSize',
+                             },
+                             None)
+        return chunk_size
 
     def __call__(self):
-        count = 0
-        intids = component.getUtility(IIntIds)
-        # remove indexes
+        values = self.readInput()
+        chunk_size = self._get_chunk_size(values)
+        cursor = values.get('cursor') or None
         catalog = get_invitations_catalog()
-        for index in catalog.values():
-            index.clear()
-        # reindex
-        container = component.getUtility(IInvitationsContainer)
-        for invitation in list(container.values()):
-            doc_id = intids.queryId(invitation)
-            if doc_id is not None:
-                count += 1
-                catalog.index_doc(doc_id, invitation)
-                queue_add(invitation)
+        count, cursor, elapsed = reindex_invitations(cursor=cursor,
+                                                     chunk_size=chunk_size,
+                                                     catalog=catalog)
+        logger.info('Reindexed %s invitation(s) in %.2f(s) (cursor=%s)',
+                    count, elapsed, cursor)
+        if cursor is None:
+            stale = unindex_stale_invitations(catalog)
+            logger.info('Unindexed %s stale invitation(s)', stale)
         result = LocatedExternalDict()
         result[ITEM_COUNT] = result[TOTAL] = count
+        if chunk_size:
+            result['Cursor'] = cursor
+            result['Elapsed'] = elapsed
         return result
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Support for sending site invitations in bulk.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from itertools import islice
+
+from ZODB.POSException import ConflictError
+
+from zope import component
+
+from zope.cachedescriptors.property import Lazy
+
+from zope.component.hooks import getSite
+
+from zope.event import notify
+
+from nti.app.externalization.view_mixins import ModeledContentUploadRequestUtilsMixin
+
+from nti.app.invitations import SITE_INVITATION_MIMETYPE
+
+from nti.app.invitations.utils import get_site_invitations_for_emails
+
+from nti.externalization.interfaces import StandardExternalFields
+
+from nti.invitations.interfaces import InvitationSentEvent
+from nti.invitations.interfaces import IInvitationsContainer
+
+from nti.invitations.utils import get_random_invitation_code
+
+MIMETYPE = StandardExternalFields.MIMETYPE
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class SiteInvitationSenderMixin(ModeledContentUploadRequestUtilsMixin):
+    """
+    Creates, stores and notifies site invitations from input rows
+    (dicts with at least a ``receiver``), a batch at a time, on behalf
+    of ``remoteUser``.
+    """
+
+    #: The number of input rows created and stored per batch
+    _BULK_SEND_BATCH_SIZE = 500
+
+    #: Whether an :class:`InvitationSentEvent` (and thus an email) is
+    #: fired for each created invitation.
+    _notify_sent = True
+
+    @Lazy
+    def invitations(self):
+        return component.getUtility(IInvitationsContainer)
+
+    def _create_invitation(self, ext_values):
+        # pylint: disable=no-member
+        return self.readCreateUpdateContentObject(self.remoteUser,
+                                                  externalValue=ext_values)
+
+    def _notify(self, invitation, email):
+        if self._notify_sent:
+            notify(InvitationSentEvent(invitation, email))
+
+    def _iter_batches(self, items, batch_size=None):
+        """
+        Yield lists of at most ``batch_size`` items from the given
+        iterable, consuming it lazily.
+        """
+        batch_size = batch_size or self._BULK_SEND_BATCH_SIZE
+        items = iter(items)
+        batch = list(islice(items, batch_size))
+        while batch:
+            yield batch
+            batch = list(islice(items, batch_size))
+
+    def _prepare_invitation_values(self, ext_values, user_invitation,
+                                   mimetype, message):
+        if user_invitation is not None:
+            # Issue a new invite with mimetype or existing mimetype
+            # This is where we can update the invitation type
+            ext_values[MIMETYPE] = mimetype or user_invitation.mime_type
+            # Prefer given message if we have one
+            ext_values['message'] = message or user_invitation.message
+            if     user_invitation.is_expired() \
+                or user_invitation.is_accepted():
+                ext_values['code'] = get_random_invitation_code()
+            else:
+                # Pending, re-use code
+                ext_values['code'] = user_invitation.code
+        else:
+            # New invites
+            if MIMETYPE not in ext_values:
+                ext_values[MIMETYPE] = mimetype or SITE_INVITATION_MIMETYPE
+            if 'message' not in ext_values:
+                ext_values['message'] = message
+            ext_values['code'] = get_random_invitation_code()
+        # XXX: we may have receiver with no message and mimetype - that's ok?
+        # We default mimetype and we'll have no message.
+        ext_values['target_site'] = getSite().__name__
+        return ext_values
+
+    def _is_role_change(self, user_invitation, mimetype, force):
+        return  user_invitation is not None \
+            and mimetype \
+            and not force \
+            and user_invitation.mime_type != mimetype
+
+    def _send_row(self, ext_values, user_invitation, mimetype, message):
+        self._prepare_invitation_values(ext_values, user_invitation,
+                                        mimetype, message)
+        invitation = self._create_invitation(ext_values)
+        # pylint: disable=no-member
+        if user_invitation is not None and not user_invitation.is_accepted():
+            self.invitations.remove(user_invitation)
+        self.invitations.add(invitation)
+        return invitation
+
+    def send_batch(self, batch, mimetype, message, force,
+                   challenge_invitations, failures=None):
+        """
+        Create, store and notify the invitations for a batch of input rows.
+        Existing invitations for every receiver in the batch are resolved
+        with a single catalog query.
+
+        If a ``failures`` list is given, rows that cannot be created are
+        recorded there as ``(row, error)`` instead of raising.
+        """
+        created = []
+        existing = get_site_invitations_for_emails([x['receiver'] for x in batch])
+        for ext_values in batch:
+            email = ext_values['receiver']
+            # Check if this user already has an invite to this site
+            # We are only *accepted* here if this is a direct invite that was already
+            # confirmed (e.g. forced).
+            user_invitation = existing.get(email.lower())
+            if self._is_role_change(user_invitation, mimetype, force):
+                # Only challenge invitations that change the user role without the force param
+                challenge_invitations.append(user_invitation)
+                continue
+            try:
+                invitation = self._send_row(ext_values, user_invitation,
+                                            mimetype, message)
+            except ConflictError:
+                raise
+            except Exception as e:  # pylint: disable=broad-except
+                if failures is None:
+                    raise
+                logger.warning('Cannot create site invitation for %s (%s)',
+                               email, e)
+                failures.append((ext_values, e))
+                continue
+            # Later rows for the same receiver must see this invitation
+            existing[email.lower()] = invitation
+            created.append((invitation, email))
+        for invitation, email in created:
+            self._notify(invitation, email)
+        return [x[0] for x in created]
+
+
+class SiteInvitationSender(SiteInvitationSenderMixin):
+    """
+    A :class:`SiteInvitationSenderMixin` for use outside of a view, e.g.
+    by a background job, creating invitations on behalf of ``creator``.
+    """
+
+    def __init__(self, creator, request=None, notify_sent=True):
+        self.creator = self.remoteUser = creator
+        self.request = request
+        self._notify_sent = notify_sent
+
+    def _notify(self, invitation, email):
+        if self._notify_sent:
+            event = InvitationSentEvent(invitation, email)
+            # Our email subscriber prefers the request on the event
+            event.request = self.request
+            notify(event)
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Process caches of invitation state.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+
+from collections import OrderedDict
+
+import transaction
+
+from zope import component
+
+from zope.component.hooks import getSite
+
+from zope.interface.interfaces import IRegistrationEvent
+
+from zope.lifecycleevent.interfaces import IObjectAddedEvent
+from zope.lifecycleevent.interfaces import IObjectRemovedEvent
+from zope.lifecycleevent.interfaces import IObjectModifiedEvent
+
+from nti.app.invitations.interfaces import IInvitationSigner
+
+from nti.invitations.interfaces import IInvitation
+from nti.invitations.interfaces import IInvitationAcceptedEvent
+
+from nti.invitations.utils import has_pending_invitations
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class PendingInvitationsCache(object):
+    """
+    Whether the receivers (username and email) of a user have pending
+    invitations, as answered by :func:`has_pending_invitations`.
+
+    Entries are invalidated by the invitation events of this process;
+    the ``ttl`` bounds how long changes made by other processes can go
+    unnoticed.
+    """
+
+    #: Seconds an entry is trusted for
+    ttl = 60
+
+    #: The cache is dropped when it grows beyond this many entries
+    max_size = 50000
+
+    def __init__(self, ttl=None, max_size=None):
+        if ttl is not None:
+            self.ttl = ttl
+        if max_size is not None:
+            self.max_size = max_size
+        self.clear()
+
+    def clear(self):
+        self._entries = {}
+        self._keys_by_receiver = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _receivers(self, key):
+        return [x for x in key[1:] if x]
+
+    def get(self, db_key, username, email=None, now=None):
+        now = time.time() if now is None else now
+        key = (db_key, username.lower(), email.lower() if email else None)
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+        result = bool(has_pending_invitations(receivers=(username, email)))
+        if len(self._entries) >= self.max_size:
+            self.clear()
+        self._entries[key] = (result, now + self.ttl)
+        for receiver in self._receivers(key):
+            self._keys_by_receiver.setdefault(receiver, set()).add(key)
+        return result
+
+    def invalidate(self, *receivers):
+        for receiver in receivers:
+            if not receiver:
+                continue
+            for key in self._keys_by_receiver.pop(receiver.lower(), ()):
+                self._entries.pop(key, None)
+
+
+class LRUCache(object):
+    """
+    A mapping of at most ``max_size`` entries, dropping the least
+    recently used entries first.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            return default
+        self._entries[key] = value
+        return value
+
+    def set(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+def _registry_key(registry):
+    # Persistent registries have a copy in each connection
+    oid = getattr(registry, '_p_oid', None)
+    return oid if oid is not None else id(registry)
+
+
+def _registry_keys(registry, result=None):
+    """
+    The keys of a registry and of all of its bases.
+    """
+    result = set() if result is None else result
+    key = _registry_key(registry)
+    if key not in result:
+        result.add(key)
+        for base in getattr(registry, '__bases__', ()):
+            _registry_keys(base, result)
+    return result
+
+
+class SiteComponentsCache(object):
+    """
+    Values computed from the components of a site (e.g. its policy and
+    adapters), cached by name for each site.
+
+    Entries are dropped when a component is registered or unregistered
+    in the components of their site or in any of its bases; changes in
+    other sites keep them. Values must not be components themselves
+    (which could be registered again), only what they were looked up
+    by or computed from them.
+
+    Persistent components (e.g. site brands) can also be edited in
+    place; the ``ttl`` bounds how long such edits can go unnoticed.
+    """
+
+    #: Seconds an entry is trusted for
+    ttl = 300
+
+    def __init__(self, ttl=None):
+        if ttl is not None:
+            self.ttl = ttl
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name, factory, now=None):
+        now = time.time() if now is None else now
+        site = getSite()
+        registry = component.getSiteManager()
+        key = (name,
+               getattr(site, '__name__', None),
+               _registry_key(registry))
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= now:
+            entry = self._entries[key] = (factory(),
+                                          now + self.ttl,
+                                          frozenset(_registry_keys(registry)))
+        return entry[0]
+
+    def invalidate(self, registry):
+        """
+        Drop the entries of the sites using the given registry.
+        """
+        key = _registry_key(registry)
+        for name, entry in list(self._entries.items()):
+            if key in entry[2]:
+                del self._entries[name]
+
+    def clear(self):
+        self._entries.clear()
+
+
+_pending_invitations_cache = PendingInvitationsCache()
+
+_site_components_cache = SiteComponentsCache()
+
+#: Signed invitation codes keyed by signer, version, code and email
+_signed_codes_cache = LRUCache(10000)
+
+
+def get_pending_invitations_cache():
+    return _pending_invitations_cache
+
+
+def get_site_components_cache():
+    return _site_components_cache
+
+
+def get_signed_codes_cache():
+    return _signed_codes_cache
+
+
+def _db_key(user):
+    # Users of different databases (e.g. tests) do not share entries
+    jar = getattr(user, '_p_jar', None)
+    return id(jar.db()) if jar is not None else None
+
+
+def user_has_pending_invitations(user, email=None):
+    """
+    Cached :func:`has_pending_invitations` for the username and the
+    given email of a user.
+    """
+    return _pending_invitations_cache.get(_db_key(user), user.username, email)
+
+
+#: The transaction attribute collecting the receivers to invalidate
+_TXN_RECEIVERS_ATTR = '_nti_invitations_pending_receivers'
+
+
+def invalidate_pending_invitations(*receivers):
+    """
+    Invalidate the cached flags for the given receivers now and, since
+    other requests may recompute them before our changes are visible,
+    again once the current transaction commits.
+
+    The receivers of a transaction are collected by a single commit
+    hook, so bulk changes do not register a hook per invitation.
+    """
+    _pending_invitations_cache.invalidate(*receivers)
+    txn = transaction.get()
+    pending = getattr(txn, _TXN_RECEIVERS_ATTR, None)
+    if pending is None:
+        pending = set()
+        setattr(txn, _TXN_RECEIVERS_ATTR, pending)
+
+        def _after_commit(unused_success):
+            _pending_invitations_cache.invalidate(*pending)
+        txn.addAfterCommitHook(_after_commit)
+    pending.update(x for x in receivers if x)
+
+
+def _invalidate_invitation(invitation):
+    invalidate_pending_invitations(invitation.receiver,
+                                   getattr(invitation, 'original_receiver', None))
+
+
+@component.adapter(IInvitation, IObjectAddedEvent)
+def _on_invitation_added(invitation, unused_event):
+    _invalidate_invitation(invitation)
+
+
+@component.adapter(IInvitation, IObjectModifiedEvent)
+def _on_invitation_modified(invitation, unused_event):
+    _invalidate_invitation(invitation)
+
+
+@component.adapter(IInvitation, IInvitationAcceptedEvent)
+def _on_invitation_accepted(invitation, unused_event):
+    _invalidate_invitation(invitation)
+
+
+@component.adapter(IInvitation, IObjectRemovedEvent)
+def _on_invitation_removed(invitation, unused_event):
+    _invalidate_invitation(invitation)
+
+
+@component.adapter(IRegistrationEvent)
+def _on_registration_changed(event):
+    registration = event.object
+    registry = getattr(registration, 'registry', None)
+    if registry is None:
+        _site_components_cache.clear()
+    else:
+        _site_components_cache.invalidate(registry)
+    # Codes are keyed on the signer; replaced signers need not linger
+    if getattr(registration, 'provided', None) is IInvitationSigner:
+        _signed_codes_cache.clear()
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(_pending_invitations_cache.clear)
+    addCleanUp(_signed_codes_cache.clear)
+    addCleanUp(_site_components_cache.clear)
+    del addCleanUp
@@ -20,6 +20,7 @@ from nti.app.invitations import REL_ACCEPT_INVITATIONS
 from nti.app.invitations import REL_TRIVIAL_DEFAULT_INVITATION_CODE
 
 from nti.app.invitations.utils import get_invitation_url
+from nti.app.invitations.utils import request_is_admin_or_site_admin
 
 from nti.app.invitations.interfaces import ISiteInvitation
 
@@ -28,8 +29,6 @@ from nti.app.renderers.decorators import AbstractAuthenticatedRequestAwareDecora
 
 from nti.appserver.pyramid_authorization import is_writable
 
-from nti.dataserver.authorization import is_admin_or_site_admin
-
 from nti.dataserver.interfaces import IUser 
 from nti.dataserver.interfaces import IDataserverFolder
 from nti.dataserver.interfaces import IDynamicSharingTargetFriendsList
@@ -89,5 +88,5 @@ class SiteInvitationLinkProvider(AbstractAuthenticatedRequestAwareDecorator):
             )
 
     def _do_decorate_external(self, context, result):
-        if is_admin_or_site_admin(self.remoteUser):
+        if request_is_admin_or_site_admin(self.remoteUser, self.request):
             self.add_admin_links(context, result)
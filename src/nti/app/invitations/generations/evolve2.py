@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Install the site invitation job container.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zope.component.hooks import site as current_site
+
+from nti.app.invitations.jobs import install_site_invitation_job_container
+
+generation = 2
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def do_evolve(context, generation=generation):
+    conn = context.connection
+    dataserver_folder = conn.root()['nti.dataserver']
+    with current_site(dataserver_folder):
+        install_site_invitation_job_container(dataserver_folder)
+    logger.info('Evolution %s done.', generation)
+
+
+def evolve(context):
+    """
+    Evolve to generation 2 by installing the site invitation job container.
+    """
+    do_evolve(context)
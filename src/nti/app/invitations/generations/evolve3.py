@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Add the created time sort index to the invitations catalog.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zope import component
+
+from zope.component.hooks import site as current_site
+
+from zope.intid.interfaces import IIntIds
+
+from nti.app.invitations.index import install_invitations_sort_indexes
+
+generation = 3
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def do_evolve(context, generation=generation):
+    conn = context.connection
+    dataserver_folder = conn.root()['nti.dataserver']
+    with current_site(dataserver_folder):
+        intids = component.getUtility(IIntIds)
+        count = install_invitations_sort_indexes(intids=intids)
+    logger.info('Evolution %s done. %s invitation(s) indexed.',
+                generation, count)
+
+
+def evolve(context):
+    """
+    Evolve to generation 3 by adding a created time index to the
+    invitations catalog.
+    """
+    do_evolve(context)
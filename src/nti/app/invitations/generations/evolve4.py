@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Add the receiver name index to the invitations catalog.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zope import component
+
+from zope.component.hooks import site as current_site
+
+from zope.intid.interfaces import IIntIds
+
+from nti.app.invitations.index import install_receiver_name_index
+
+generation = 4
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def do_evolve(context, generation=generation):
+    conn = context.connection
+    dataserver_folder = conn.root()['nti.dataserver']
+    with current_site(dataserver_folder):
+        intids = component.getUtility(IIntIds)
+        count = install_receiver_name_index(intids=intids)
+    logger.info('Evolution %s done. %s invitation(s) indexed.',
+                generation, count)
+
+
+def evolve(context):
+    """
+    Evolve to generation 4 by adding a receiver name index to the
+    invitations catalog.
+    """
+    do_evolve(context)
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Install the invitation email outbox.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from nti.app.invitations.outbox import install_invitation_email_outbox
+
+generation = 6
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def do_evolve(context, generation=generation):
+    conn = context.connection
+    dataserver_folder = conn.root()['nti.dataserver']
+    install_invitation_email_outbox(dataserver_folder)
+    logger.info('Evolution %s done.', generation)
+
+
+def evolve(context):
+    """
+    Evolve to generation 6 by installing the invitation email outbox.
+    """
+    do_evolve(context)
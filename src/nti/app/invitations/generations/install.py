@@ -10,17 +10,27 @@ from __future__ import absolute_import
 
 from zope import interface
 
+from zope.component.hooks import site as current_site
+
 from zope.generations.generations import SchemaManager as BaseSchemaManager
 
 from zope.generations.interfaces import IInstallableSchemaManager
 
 from zope.intid.interfaces import IIntIds
 
+from nti.app.invitations.index import install_entity_index
+from nti.app.invitations.index import install_receiver_name_index
+from nti.app.invitations.index import install_invitations_sort_indexes
+
+from nti.app.invitations.jobs import install_site_invitation_job_container
+
+from nti.app.invitations.outbox import install_invitation_email_outbox
+
 from nti.invitations.index import install_invitations_catalog
 
 from nti.invitations.model import install_invitations_container
 
-generation = 1
+generation = 6
 
 logger = __import__('logging').getLogger(__name__)
 
@@ -49,3 +59,9 @@ def evolve(context):
     intids = lsm.getUtility(IIntIds)
     install_invitations_catalog(dataserver_folder, intids)
     install_invitations_container(dataserver_folder, intids)
+    install_site_invitation_job_container(dataserver_folder)
+    install_invitation_email_outbox(dataserver_folder)
+    with current_site(dataserver_folder):
+        install_invitations_sort_indexes(intids=intids)
+        install_receiver_name_index(intids=intids)
+        install_entity_index(intids=intids)
@@ -7,9 +7,15 @@ from __future__ import absolute_import
 
 # pylint: disable=protected-access,too-many-public-methods,arguments-differ
 
+from hamcrest import is_
 from hamcrest import has_key
+from hamcrest import not_none
 from hamcrest import assert_that
 
+from nti.app.invitations.generations.install import generation
+
+from nti.app.invitations.interfaces import ISiteInvitationJobContainer
+
 from nti.app.testing.application_webtest import ApplicationLayerTest
 
 from nti.dataserver.tests import mock_dataserver
@@ -22,3 +28,7 @@ class TestFunctionalInstall(ApplicationLayerTest):
         root = conn.root()
         generations = root['zope.generations']
         assert_that(generations, has_key('nti.dataserver-app-invitations'))
+        assert_that(generations['nti.dataserver-app-invitations'], is_(generation))
+
+        lsm = root['nti.dataserver'].getSiteManager()
+        assert_that(lsm.queryUtility(ISiteInvitationJobContainer), not_none())
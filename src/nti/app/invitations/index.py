@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Additional indexes of the invitations catalog.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import six
+import time
+import numbers
+
+from itertools import chain
+from itertools import islice
+
+from zope import component
+
+from zope.catalog.attribute import AttributeIndex
+
+from zope.catalog.field import FieldIndex
+
+from zope.intid.interfaces import IIntIds
+
+from zope.location import locate
+
+from zc.catalog.catalogindex import SetIndex
+from zc.catalog.catalogindex import ValueIndex
+
+from zc.catalog.index import NormalizationWrapper
+
+from nti.app.invitations.interfaces import IJoinEntityInvitation
+from nti.app.invitations.interfaces import IInvitationReceiverTerms
+
+from nti.invitations.index import IX_ACCEPTED
+
+from nti.invitations.index import get_invitations_catalog
+
+from nti.invitations.interfaces import IInvitation
+from nti.invitations.interfaces import IInvitationsContainer
+
+from nti.metadata import queue_add
+
+#: The invitation creation time, sortable (:class:`zope.index.interfaces.IIndexSort`)
+IX_CREATEDTIME = 'createdTime'
+
+#: The receiver email, username, realname and alias terms
+IX_RECEIVER_NAME = 'receiverName'
+
+#: The entity (username or NTIID) a join entity invitation is for
+IX_ENTITY = 'entity'
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class CreatedTimeIndex(FieldIndex):
+    default_field_name = 'createdTime'
+    default_interface = IInvitation
+
+
+class ReceiverNameIndex(SetIndex):
+    default_field_name = 'terms'
+    default_interface = IInvitationReceiverTerms
+
+
+class EntityIndex(ValueIndex):
+    default_field_name = 'entity'
+    default_interface = IJoinEntityInvitation
+
+
+def _install_index(name, factory, catalog=None, intids=None, container=None):
+    count = 0
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    if name in catalog:
+        return count
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    index = factory(family=intids.family)
+    locate(index, catalog, name)
+    # pylint: disable=protected-access
+    catalog._setitemf(name, index)
+    if container is None:
+        container = component.queryUtility(IInvitationsContainer)
+    for invitation in container.values() if container is not None else ():
+        doc_id = intids.queryId(invitation)
+        if doc_id is not None:
+            index.index_doc(doc_id, invitation)
+            count += 1
+    logger.info('Indexed %s invitation(s) in %s', count, name)
+    return count
+
+
+def install_invitations_sort_indexes(catalog=None, intids=None, container=None):
+    """
+    Add the indexes the site invitation listings sort on to the invitations
+    catalog, indexing the existing invitations. Returns the number of
+    indexed invitations.
+    """
+    return _install_index(IX_CREATEDTIME, CreatedTimeIndex,
+                          catalog, intids, container)
+
+
+def install_receiver_name_index(catalog=None, intids=None, container=None):
+    """
+    Add the receiver name index to the invitations catalog, indexing the
+    existing invitations. Returns the number of indexed invitations.
+    """
+    return _install_index(IX_RECEIVER_NAME, ReceiverNameIndex,
+                          catalog, intids, container)
+
+
+def install_entity_index(catalog=None, intids=None, container=None):
+    """
+    Add the join entity invitation entity index to the invitations catalog,
+    indexing the existing invitations. Returns the number of indexed
+    invitations.
+    """
+    return _install_index(IX_ENTITY, EntityIndex,
+                          catalog, intids, container)
+
+
+def get_entity_invitation_ids(entities, pending=False, catalog=None):
+    """
+    Return the doc ids of the join entity invitations for the given entity
+    usernames or NTIIDs, only the unaccepted ones if ``pending``.
+    """
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    entities = tuple(x for x in entities or () if x)
+    if not entities:
+        return catalog.family.IF.Set()
+    result = catalog[IX_ENTITY].apply({'any_of': entities})
+    if pending and result:
+        unaccepted = catalog[IX_ACCEPTED].apply({'any_of': (False,)})
+        result = catalog.family.IF.intersection(result, unaccepted)
+    return result if result is not None else catalog.family.IF.Set()
+
+
+def reindex_receiver_name(invitation, catalog=None, intids=None):
+    """
+    Reindex the receiver terms of the given invitation.
+    """
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    index = catalog.get(IX_RECEIVER_NAME) if catalog is not None else None
+    if index is None:
+        return False
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    doc_id = intids.queryId(invitation)
+    if doc_id is None:
+        return False
+    index.index_doc(doc_id, invitation)
+    return True
+
+
+def search_invitation_ids(value, prefix=False, doc_ids=None, catalog=None):
+    """
+    Return the doc ids of the invitations with a receiver email, username,
+    realname or alias containing (or, if ``prefix``, with a word starting
+    with) the given value, within ``doc_ids`` if given. Only the index
+    terms are scanned.
+    """
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    index = catalog[IX_RECEIVER_NAME]
+    value = (value or u'').strip().lower()
+    values_to_documents = index.values_to_documents
+    if prefix:
+        terms = values_to_documents.keys(min=value, max=value + u'\uffff')
+    else:
+        terms = (x for x in values_to_documents.keys() if value in x)
+    terms = tuple(terms)
+    if not terms:
+        return catalog.family.IF.Set()
+    result = index.apply({'any_of': terms})
+    if doc_ids is not None:
+        result = catalog.family.IF.intersection(doc_ids, result)
+    return result
+
+
+def _indexed_doc_ids(index):
+    if isinstance(index, NormalizationWrapper):
+        index = index.index
+    mapping = getattr(index, 'documents_to_values', None)  # zc.catalog
+    if mapping is None:
+        mapping = getattr(index, '_rev_index', None)  # zope.index
+    return mapping
+
+
+def unindex_stale_invitations(catalog=None, intids=None, container=None):
+    """
+    Unindex the doc ids of the invitations catalog that are not (anymore)
+    invitations of the container. Returns the number of unindexed doc ids.
+    """
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    if container is None:
+        container = component.getUtility(IInvitationsContainer)
+    doc_ids = set()
+    for index in catalog.values():
+        mapping = _indexed_doc_ids(index)
+        if mapping is not None:
+            doc_ids.update(mapping.keys())
+    count = 0
+    for doc_id in doc_ids:
+        invitation = intids.queryObject(doc_id)
+        if invitation is None \
+                or getattr(invitation, '__parent__', None) is not container:
+            catalog.unindex_doc(doc_id)
+            count += 1
+    return count
+
+
+def _keys_after(container, cursor=None):
+    if cursor is None:
+        return iter(container.keys())
+    # Seek the (case insensitive) cursor, present or not
+    keys = iter(container.keys(cursor))
+    first = next(keys, None)
+    if first is None or first.lower() == cursor.lower():
+        return keys
+    return chain((first,), keys)
+
+
+def reindex_invitations(cursor=None, chunk_size=None, catalog=None,
+                        intids=None, container=None, queue=True):
+    """
+    Index the invitations of the container whose keys follow ``cursor``
+    (all of them by default), at most ``chunk_size`` of them, queuing
+    each one for metadata indexing if ``queue``.
+
+    The returned cursor (the last processed key) resumes a rebuild even
+    if invitations were added or removed in between; it is ``None`` once
+    the container is exhausted.
+
+    :return: A tuple of the number of indexed invitations, the next
+        cursor and the elapsed seconds.
+    """
+    start = time.time()
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    if container is None:
+        container = component.getUtility(IInvitationsContainer)
+    keys = _keys_after(container, cursor)
+    if chunk_size:
+        # Fetch one extra key to tell whether we are done
+        keys = list(islice(keys, chunk_size + 1))
+        has_more = len(keys) > chunk_size
+        keys = keys[:chunk_size]
+    else:
+        keys = list(keys)
+        has_more = False
+    count = 0
+    for key in keys:
+        invitation = container.get(key)
+        doc_id = intids.queryId(invitation) if invitation is not None else None
+        if doc_id is not None:
+            count += 1
+            catalog.index_doc(doc_id, invitation)
+            if queue:
+                queue_add(invitation)
+    cursor = keys[-1] if has_more and keys else None
+    return count, cursor, time.time() - start
+
+
+def _is_attribute_index(index):
+    return isinstance(index, AttributeIndex)
+
+
+def compute_index_values(invitation, catalog=None):
+    """
+    Return the values the attribute indexes of the invitations catalog
+    would record for the given invitation, keyed by index name. These are
+    plain values that can be computed in another process.
+    """
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    result = {}
+    for name, index in catalog.items():
+        if not _is_attribute_index(index):
+            continue
+        obj = invitation
+        if index.interface is not None:
+            obj = index.interface(obj, None)
+        value = getattr(obj, index.field_name, None) if obj is not None else None
+        if value is not None and index.field_callable:
+            value = value()
+        result[name] = value
+    return result
+
+
+def apply_index_values(doc_id, values, invitation=None, catalog=None):
+    """
+    Index a doc id with values computed by :func:`compute_index_values`.
+    Indexes those values cannot be given for are indexed from the
+    ``invitation``, if given.
+    """
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    for name, index in catalog.items():
+        if name in values and _is_attribute_index(index):
+            value = values[name]
+            if value is None:
+                index.unindex_doc(doc_id)
+            else:
+                # Skip the attribute lookup of AttributeIndex
+                super(AttributeIndex, index).index_doc(doc_id, value)
+        elif invitation is not None:
+            index.index_doc(doc_id, invitation)
+
+
+def _normalizer(index):
+    """
+    Return a function normalizing the values given to a
+    ``NormalizationWrapper`` index as it records them, if it is one.
+    """
+    if not isinstance(index, NormalizationWrapper):
+        return None
+    normalize = index.normalizer.value
+    if index.collection_index:
+        return lambda value: [normalize(x) for x in value]
+    return normalize
+
+
+def _normalize_value(value):
+    if value is None or isinstance(value, (six.string_types, numbers.Number)):
+        return value
+    try:
+        # Set indexes do not record empty values
+        return frozenset(value) or None
+    except TypeError:
+        return value
+
+
+def verify_invitations_catalog(doc_values, catalog=None):
+    """
+    Compare the invitations catalog against the expected index values of
+    every invitation, a mapping of doc id to :func:`compute_index_values`.
+    The values of ``NormalizationWrapper`` indexes are normalized first.
+    Nothing is written.
+
+    :return: A dict of index name to a dict with the ``missing`` (not
+        indexed), ``stale`` (indexed but not in the container) and
+        ``mismatched`` doc ids.
+    """
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    result = {}
+    for name, index in catalog.items():
+        mapping = _indexed_doc_ids(index)
+        if mapping is None:
+            logger.warning('Cannot verify index %s', name)
+            continue
+        normalizer = _normalizer(index)
+        report = result[name] = {'missing': [], 'stale': [], 'mismatched': []}
+        for doc_id, values in doc_values.items():
+            if name not in values:
+                continue
+            expected = values[name]
+            if normalizer is not None and expected is not None:
+                expected = normalizer(expected)
+            expected = _normalize_value(expected)
+            actual = _normalize_value(mapping.get(doc_id))
+            if actual is None and expected is not None:
+                report['missing'].append(doc_id)
+            elif actual != expected:
+                report['mismatched'].append(doc_id)
+        report['stale'] = [x for x in mapping.keys() if x not in doc_values]
+    return result
@@ -12,6 +12,10 @@ from __future__ import absolute_import
 
 from zope import interface
 
+from zope.container.constraints import contains
+
+from zope.container.interfaces import IContainer
+
 from zope.location.interfaces import IContained
 
 from nti.app.invitations import MessageFactory as _
@@ -23,8 +27,10 @@ from nti.invitations.interfaces import IActionableInvitation
 from nti.invitations.interfaces import IInvitationActor
 from nti.invitations.interfaces import InvitationValidationError
 
-from nti.schema.field import DecodingValidTextLine as ValidTextLine
 from nti.schema.field import Bool
+from nti.schema.field import Int
+from nti.schema.field import Number
+from nti.schema.field import DecodingValidTextLine as ValidTextLine
 
 
 class IInvitationsWorkspace(IWorkspace):
@@ -146,3 +152,193 @@ class IInvitationInfo(interface.Interface, IContained):
                                         u'creation to match the invitation email.',
                                   required=True,
                                   default=False)
+
+
+class IInvitationReceiverTerms(interface.Interface):
+    """
+    The lower-cased receiver email, username, realname and alias (and
+    their words) of an invitation, used to search invitations by receiver.
+    """
+
+    terms = interface.Attribute(u'The search terms for the receiver')
+
+
+class ISiteInvitationJob(IContained):
+    """
+    A background job creating (and mailing) the site invitations of a
+    large upload, a chunk of rows at a time.
+    """
+
+    id = ValidTextLine(title=u'The job id', required=True)
+
+    creator = ValidTextLine(title=u'The username of the job submitter',
+                            required=True)
+
+    site = ValidTextLine(title=u'The site the invitations are sent for',
+                         required=True)
+
+    state = ValidTextLine(title=u'The job state', required=True)
+
+    total = Int(title=u'The number of input rows', required=True, default=0)
+
+    processed = Int(title=u'The number of processed rows',
+                    required=True, default=0)
+
+    sent = Int(title=u'The number of created invitations',
+               required=True, default=0)
+
+    createdTime = Number(title=u'The time the job was submitted',
+                         required=False)
+
+    lastModified = Number(title=u'The time the job last made progress',
+                          required=False)
+
+    def add_failure(receiver, message, code=None):
+        """
+        Record the failure to create the invitation for ``receiver``.
+        """
+
+    def iter_chunks(start=0):
+        """
+        Iterate over ``(index, rows)`` for the stored chunks of input rows,
+        beginning at chunk ``start``.
+        """
+
+    def remove_chunk(index):
+        """
+        Remove the (processed) chunk of input rows at ``index``.
+        """
+
+    def clear_chunks():
+        """
+        Remove all of the remaining chunks of input rows.
+        """
+
+    def is_finished():
+        """
+        Whether the job succeeded or failed.
+        """
+
+    def is_stale(now=None):
+        """
+        Whether the job is unfinished but made no progress for so long
+        that nothing is running it anymore.
+        """
+
+    def is_expired(now=None):
+        """
+        Whether the job finished long enough ago to be removed.
+        """
+
+
+class ISiteInvitationJobContainer(IContainer):
+    """
+    The storage for :class:`ISiteInvitationJob` objects.
+    """
+    contains(ISiteInvitationJob)
+
+
+class ISiteInvitationJobRunner(interface.Interface):
+    """
+    A utility that runs :class:`ISiteInvitationJob` objects outside
+    of the request that submitted them.
+    """
+
+    def submit(job):
+        """
+        Schedule the job to be run once the current transaction commits.
+        """
+
+    def resume_stale_jobs():
+        """
+        Remove the expired finished jobs and run again the unfinished
+        jobs that nothing is running anymore, e.g. after a restart.
+        Returns the ``(id, site)`` of the resumed jobs.
+        """
+
+
+class IInvitationEmailDispatcher(interface.Interface):
+    """
+    A utility that, when registered, sends the emails of the site
+    invitations sent in a transaction in batches once it commits,
+    instead of one at a time within the transaction.
+    """
+
+    def add(invitation, request):
+        """
+        Schedule the email of the given invitation, sent in the given
+        request, to be sent once the current transaction commits.
+        """
+
+
+class IInvitationEmailOutboxEntry(IContained):
+    """
+    A site invitation email to deliver, written in the transaction that
+    sent the invitation.
+    """
+
+    key = ValidTextLine(title=u'The idempotency key of the email',
+                        required=True)
+
+    code = ValidTextLine(title=u'The invitation code', required=True)
+
+    site = ValidTextLine(title=u'The site the invitation was sent in',
+                         required=True)
+
+    application_url = ValidTextLine(title=u'The application url of the sending request',
+                                    required=True)
+
+    state = ValidTextLine(title=u'The delivery state', required=True)
+
+    attempts = Int(title=u'The number of failed deliveries',
+                   required=True, default=0)
+
+    error = ValidTextLine(title=u'The last delivery error', required=False)
+
+    next_attempt = Number(title=u'The earliest time of the next delivery',
+                          required=False)
+
+    createdTime = Number(title=u'The time the email was written',
+                         required=False)
+
+
+class IInvitationEmailOutbox(IContainer):
+    """
+    The storage for :class:`IInvitationEmailOutboxEntry` objects, keyed
+    by their idempotency key, drained outside of the web requests.
+    """
+    contains(IInvitationEmailOutboxEntry)
+
+    def add_email(invitation, site, application_url):
+        """
+        Write the email of the given invitation, with the application url
+        its links are built from, returning its entry, or ``None`` if an
+        email with the same key is pending, failed or delivered.
+        """
+
+    def add_failure(key, error, max_attempts, backoff):
+        """
+        Record a failed delivery of the entry with the given key; once
+        it failed ``max_attempts`` times, the entry is removed and kept
+        as failed.
+        """
+
+    def get_failed(key, default=None):
+        """
+        Return the failed entry with the given key.
+        """
+
+    def iter_due(now=None):
+        """
+        Iterate the entries due for delivery, by next attempt time.
+        """
+
+    def mark_delivered(key):
+        """
+        Remove the entry with the given key, recording it as delivered.
+        """
+
+    def is_delivered(key):
+        """
+        Whether an email with the given key was delivered.
+        """
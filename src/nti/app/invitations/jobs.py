@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Background jobs for sending the site invitations of large uploads.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import uuid
+import functools
+
+import gevent
+
+import transaction
+
+from BTrees.IOBTree import IOBTree
+
+from persistent import Persistent
+
+from persistent.list import PersistentList
+
+from pyramid.request import Request
+
+from pyramid.threadlocal import manager
+from pyramid.threadlocal import get_current_registry
+
+from six.moves import urllib_parse
+
+from zope import component
+from zope import interface
+
+from zope.container.btree import BTreeContainer
+
+from zope.container.contained import Contained
+
+from zope.processlifetime import IProcessStarting
+
+from nti.app.invitations import INVITATIONS
+from nti.app.invitations import SITE_INVITATION_JOB_MIMETYPE
+
+from nti.app.invitations.bulk import SiteInvitationSender
+
+from nti.app.invitations.interfaces import ISiteInvitationJob
+from nti.app.invitations.interfaces import ISiteInvitationJobRunner
+from nti.app.invitations.interfaces import ISiteInvitationJobContainer
+
+from nti.dataserver.interfaces import IDataserver
+from nti.dataserver.interfaces import IDataserverTransactionRunner
+
+from nti.dataserver.users.users import User
+
+from nti.externalization.externalization import to_external_object
+
+from nti.externalization.interfaces import LocatedExternalDict
+from nti.externalization.interfaces import StandardExternalFields
+from nti.externalization.interfaces import IInternalObjectExternalizer
+
+from nti.links.links import Link
+
+ID = StandardExternalFields.ID
+CLASS = StandardExternalFields.CLASS
+LINKS = StandardExternalFields.LINKS
+MIMETYPE = StandardExternalFields.MIMETYPE
+CREATED_TIME = StandardExternalFields.CREATED_TIME
+LAST_MODIFIED = StandardExternalFields.LAST_MODIFIED
+
+#: The name of the job container utility
+SITE_INVITATION_JOBS = u'++etc++site-invitation-jobs'
+
+#: Job states
+PENDING = u'Pending'
+RUNNING = u'Running'
+SUCCESS = u'Success'
+FAILED = u'Failed'
+
+#: Unfinished jobs that made no progress for this long (seconds) are
+#: considered abandoned, e.g. by a process that was restarted, and resumed
+STALE_JOB_TIMEOUT = 30 * 60
+
+#: Finished jobs are removed this long (seconds) after they finished
+FINISHED_JOB_TTL = 7 * 24 * 60 * 60
+
+logger = __import__('logging').getLogger(__name__)
+
+
+@interface.implementer(ISiteInvitationJob)
+class SiteInvitationJob(Persistent, Contained):
+
+    mimeType = mime_type = SITE_INVITATION_JOB_MIMETYPE
+
+    state = PENDING
+
+    total = 0
+    sent = 0
+    processed = 0
+
+    #: The index of the next chunk to process
+    cursor = 0
+
+    #: The input rows collapsed into an earlier row for the same receiver
+    merged = ()
+
+    createdTime = None
+    lastModified = None
+
+    def __init__(self, creator, site, rows, chunk_size,
+                 mimetype=None, message=None, force=False,
+                 notify_sent=True, application_url=None):
+        self.id = u'%s' % uuid.uuid4().hex
+        self.creator = creator
+        self.site = site
+        self.mimetype = mimetype
+        self.message = message
+        self.force = bool(force)
+        self.notify_sent = notify_sent
+        self.application_url = application_url
+        self.failures = PersistentList()
+        self._chunks = IOBTree()
+        chunk = []
+        for row in rows:
+            chunk.append(dict(row))
+            if len(chunk) >= chunk_size:
+                self._add_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._add_chunk(chunk)
+        self.createdTime = self.lastModified = time.time()
+
+    def _add_chunk(self, rows):
+        self._chunks[len(self._chunks)] = PersistentList(rows)
+        self.total += len(rows)
+
+    def iter_chunks(self, start=0):
+        for idx in self._chunks.keys(min=start):
+            yield idx, self._chunks[idx]
+
+    def remove_chunk(self, index):
+        self._chunks.pop(index, None)
+
+    def clear_chunks(self):
+        self._chunks.clear()
+
+    def add_failure(self, receiver, message, code=None):
+        self.failures.append({'receiver': receiver,
+                              'message': message,
+                              'code': code})
+
+    def updateLastMod(self, t=None):
+        self.lastModified = t if t is not None else time.time()
+
+    def is_finished(self):
+        return self.state in (SUCCESS, FAILED)
+
+    def is_stale(self, now=None, timeout=STALE_JOB_TIMEOUT):
+        now = time.time() if now is None else now
+        return  not self.is_finished() \
+            and (self.lastModified or 0) < now - timeout
+
+    def is_expired(self, now=None, ttl=FINISHED_JOB_TTL):
+        now = time.time() if now is None else now
+        return self.is_finished() and (self.lastModified or 0) < now - ttl
+
+
+@interface.implementer(ISiteInvitationJobContainer)
+class SiteInvitationJobContainer(BTreeContainer):
+    pass
+
+
+def install_site_invitation_job_container(dataserver_folder):
+    lsm = dataserver_folder.getSiteManager()
+    container = lsm.queryUtility(ISiteInvitationJobContainer)
+    if container is None:
+        container = SiteInvitationJobContainer()
+        container.__parent__ = dataserver_folder
+        container.__name__ = SITE_INVITATION_JOBS
+        lsm.registerUtility(container, provided=ISiteInvitationJobContainer)
+    return container
+
+
+def get_site_invitation_job(job_id):
+    container = component.queryUtility(ISiteInvitationJobContainer)
+    return container.get(job_id) if container is not None and job_id else None
+
+
+def get_site_invitation_job_href(job, application_url=None):
+    path = '/%s/%s/%s' % ("dataserver2", INVITATIONS, job.id)
+    return urllib_parse.urljoin(application_url, path) if application_url else path
+
+
+def make_job_request(application_url):
+    """
+    Return a request for work done outside of the request that
+    scheduled it, e.g. to generate links and render emails.
+    """
+    request = Request.blank('/', base_url=application_url)
+    request.registry = get_current_registry()
+    return request
+
+
+def process_site_invitation_job_chunk(job_id):
+    """
+    Process the next chunk of input rows of the given job in the current
+    transaction.
+
+    :return: Whether the job has more chunks to process.
+    """
+    job = get_site_invitation_job(job_id)
+    if job is None or job.is_finished():
+        return False
+    chunk = next(job.iter_chunks(job.cursor), None)
+    if chunk is None:
+        job.state = SUCCESS
+        job.updateLastMod()
+        logger.info('Site invitation job %s finished (sent=%s) (failures=%s)',
+                    job.id, job.sent, len(job.failures))
+        return False
+
+    job.state = RUNNING
+    idx, rows = chunk
+    request = make_job_request(job.application_url)
+    sender = SiteInvitationSender(User.get_user(job.creator),
+                                  request=request,
+                                  notify_sent=job.notify_sent)
+    challenged = []
+    failures = []
+    manager.push({'request': request, 'registry': request.registry})
+    try:
+        created = sender.send_batch([dict(x) for x in rows],
+                                    job.mimetype,
+                                    job.message,
+                                    job.force,
+                                    challenged,
+                                    failures)
+    finally:
+        manager.pop()
+    for invitation in challenged:
+        job.add_failure(invitation.receiver,
+                        u'A pending invitation would be updated to a different role.',
+                        u'UpdatePendingInvitations')
+    for row, error in failures:
+        job.add_failure(row.get('receiver'),
+                        getattr(error, 'i18n_message', None) or str(error),
+                        error.__class__.__name__)
+    job.sent += len(created)
+    job.processed += len(rows)
+    job.cursor = idx + 1
+    # Processed rows are not needed anymore
+    job.remove_chunk(idx)
+    job.updateLastMod()
+    logger.info('Processed %s of %s site invitation(s) (job=%s) (site=%s)',
+                job.processed, job.total, job.id, job.site)
+    return True
+
+
+def _fail_site_invitation_job(job_id):
+    job = get_site_invitation_job(job_id)
+    if job is not None and not job.is_finished():
+        job.state = FAILED
+        job.clear_chunks()
+        job.updateLastMod()
+
+
+def run_site_invitation_job(job_id, site_name, retries=2):
+    """
+    Run the given job to completion, committing one transaction per
+    chunk of input rows.
+    """
+    runner = component.getUtility(IDataserverTransactionRunner)
+    process = functools.partial(process_site_invitation_job_chunk, job_id)
+    while True:
+        try:
+            if not runner(process, retries=retries, site_names=(site_name,)):
+                break
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Site invitation job %s failed', job_id)
+            runner(functools.partial(_fail_site_invitation_job, job_id),
+                   site_names=(site_name,))
+            break
+
+
+def recover_site_invitation_jobs(now=None):
+    """
+    Remove the expired finished jobs and claim the stale unfinished ones
+    in the current transaction. A claimed job is marked as having made
+    progress now, so that other processes recovering jobs concurrently
+    leave it alone (or conflict).
+
+    :return: The ``(id, site)`` of the claimed jobs, to be resumed once
+        the transaction commits.
+    """
+    container = component.queryUtility(ISiteInvitationJobContainer)
+    if container is None:
+        return ()
+    now = time.time() if now is None else now
+    result = []
+    for key, job in list(container.items()):
+        if job.is_expired(now):
+            del container[key]
+        elif job.is_stale(now):
+            job.updateLastMod(now)
+            result.append((job.id, job.site))
+    return result
+
+
+@interface.implementer(ISiteInvitationJobRunner)
+class SiteInvitationJobRunner(object):
+    """
+    Runs submitted jobs in a greenlet once the submitting
+    transaction commits.
+    """
+
+    def submit(self, job):
+        job_id, site_name = job.id, job.site
+
+        def _after_commit(success):
+            if success:
+                self._run(job_id, site_name)
+        transaction.get().addAfterCommitHook(_after_commit)
+
+    def _run(self, job_id, site_name):
+        gevent.spawn(run_site_invitation_job, job_id, site_name)
+
+    def resume_stale_jobs(self):
+        runner = component.getUtility(IDataserverTransactionRunner)
+        jobs = runner(recover_site_invitation_jobs)
+        for job_id, site_name in jobs or ():
+            logger.info('Resuming site invitation job %s (site=%s)',
+                        job_id, site_name)
+            self._run(job_id, site_name)
+        return jobs
+
+
+class InProcessSiteInvitationJobRunner(SiteInvitationJobRunner):
+    """
+    Collects committed jobs to be run in process, outside of any
+    transaction, by calling :meth:`run_pending`.
+    """
+
+    def __init__(self):
+        self.pending = []
+
+    def _run(self, job_id, site_name):
+        self.pending.append((job_id, site_name))
+
+    def run_pending(self):
+        while self.pending:
+            job_id, site_name = self.pending.pop(0)
+            run_site_invitation_job(job_id, site_name)
+
+
+def _resume_stale_jobs(runner):
+    try:
+        runner.resume_stale_jobs()
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('Cannot resume the stale site invitation jobs')
+
+
+@component.adapter(IProcessStarting)
+def _resume_site_invitation_jobs(unused_event):
+    # Jobs whose greenlet died with a previous process; run once the
+    # process is up
+    runner = component.queryUtility(ISiteInvitationJobRunner)
+    if runner is not None:
+        gevent.spawn(_resume_stale_jobs, runner)
+
+
+@component.adapter(ISiteInvitationJob)
+@interface.implementer(IInternalObjectExternalizer)
+class _SiteInvitationJobExternalizer(object):
+
+    def __init__(self, job):
+        self.job = job
+
+    def toExternalObject(self, **unused_kwargs):
+        job = self.job
+        result = LocatedExternalDict()
+        result[CLASS] = 'SiteInvitationJob'
+        result[MIMETYPE] = job.mime_type
+        result[ID] = job.id
+        result['State'] = job.state
+        result['Site'] = job.site
+        result['Creator'] = job.creator
+        result['Total'] = job.total
+        result['Processed'] = job.processed
+        result['Sent'] = job.sent
+        result['Failures'] = [dict(x) for x in job.failures]
+        result['FailureCount'] = len(job.failures)
+        result['Merged'] = [dict(x) for x in job.merged]
+        result[CREATED_TIME] = job.createdTime
+        result[LAST_MODIFIED] = job.lastModified
+        ds2 = component.getUtility(IDataserver).dataserver_folder
+        links = (
+            Link(ds2, rel='status', method='GET',
+                 elements=(INVITATIONS, job.id)),
+        )
+        result[LINKS] = to_external_object(links)
+        return result
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Batched sending of site invitation emails.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import re
+import functools
+
+from itertools import groupby
+
+import gevent
+
+import transaction
+
+from pyramid.threadlocal import manager
+
+from zope import component
+from zope import interface
+
+from zope.component.hooks import getSite
+
+from nti.app.invitations.interfaces import IInvitationEmailDispatcher
+
+from nti.app.invitations.jobs import make_job_request
+
+from nti.app.invitations.utils import get_invitation_url
+
+from nti.app.invitations.subscribers import queue_invitation_email
+from nti.app.invitations.subscribers import get_invitation_email_args
+from nti.app.invitations.subscribers import get_invitation_email_context
+
+from nti.appserver.interfaces import IApplicationSettings
+
+from nti.dataserver.interfaces import IDataserverTransactionRunner
+
+from nti.dataserver.users.users import User
+
+from nti.invitations.interfaces import IInvitationsContainer
+
+#: The transaction attribute collecting the emails to send
+_TXN_EMAILS_ATTR = '_nti_invitations_pending_emails'
+
+#: The characters templates may escape, ending each placeholder so that
+#: a rendering shows how every occurrence of it was escaped
+_PROBE_FORMS = (
+    (u'&', (u'&amp;', u'&#38;', u'&#x26;', u'&')),
+    (u'<', (u'&lt;', u'&#60;', u'&#x3c;', u'<')),
+    (u'>', (u'&gt;', u'&#62;', u'&#x3e;', u'>')),
+    (u'"', (u'&quot;', u'&#34;', u'&#x22;', u'"')),
+    (u"'", (u'&#39;', u'&#x27;', u'&apos;', u"'")),
+)
+
+_PROBE = u''.join(x[0] for x in _PROBE_FORMS)
+
+#: Placeholders of the per-receiver fields in a shared rendering
+RECEIVER_NAME_TOKEN = u'nti0invitation0receiver0name' + _PROBE
+REDEMPTION_LINK_TOKEN = u'nti0invitation0redemption0link' + _PROBE
+
+#: The templates of an email whose bodies are already rendered
+PERSONALIZED_EMAIL_TEMPLATE = 'nti.app.invitations:templates/site_invitation_email_personalized'
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _as_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _body(part):
+    # Message parts may be attachments
+    return getattr(part, 'data', part)
+
+
+def _placeholder_pattern(*tokens):
+    names = u'|'.join(re.escape(x[:-len(_PROBE)]) for x in tokens)
+    groups = (u'(%s)' % u'|'.join(re.escape(x) for x in forms)
+              for _, forms in _PROBE_FORMS)
+    return re.compile(u'(%s)%s' % (names, u''.join(groups)))
+
+
+_PLACEHOLDER_PATTERN = _placeholder_pattern(RECEIVER_NAME_TOKEN,
+                                            REDEMPTION_LINK_TOKEN)
+
+
+def _split(body):
+    """
+    Split a rendered body into its text and ``(token, table)``
+    placeholders, the table translating a value as the placeholder was
+    escaped. Returns ``None`` if a placeholder was transformed otherwise.
+    """
+    result = []
+    start = 0
+    for match in _PLACEHOLDER_PATTERN.finditer(body):
+        result.append(body[start:match.start()])
+        table = dict((ord(char), match.group(idx + 2))
+                     for idx, (char, _) in enumerate(_PROBE_FORMS))
+        result.append((match.group(1) + _PROBE, table))
+        start = match.end()
+    result.append(body[start:])
+    text = u''.join(x for x in result if not isinstance(x, tuple))
+    if any(x[:-len(_PROBE)] in text
+           for x in (RECEIVER_NAME_TOKEN, REDEMPTION_LINK_TOKEN)):
+        return None
+    return result
+
+
+def _personalize(parts, values):
+    return u''.join(values[x[0]].translate(x[1]) if isinstance(x, tuple) else x
+                    for x in parts)
+
+
+class SharedInvitationEmail(object):
+    """
+    A site invitation email rendered once for a sender and message, with
+    placeholders for the receiver name and redemption link, personalized
+    for each receiver by substitution.
+
+    Each occurrence of a placeholder is replaced with the receiver value
+    escaped the way the template escaped the placeholder there, so the
+    result does not depend on the escaping (or default filters) of the
+    templates.
+    """
+
+    def __init__(self, html, text):
+        # The parts of the bodies, see _split
+        self.html = html
+        self.text = text
+
+    @classmethod
+    def render(cls, invitation, sender, request, context):
+        args = get_invitation_email_args(invitation,
+                                         sender,
+                                         RECEIVER_NAME_TOKEN,
+                                         invitation.message,
+                                         request,
+                                         context,
+                                         redemption_link=REDEMPTION_LINK_TOKEN)
+        message = context['mailer'].create_simple_html_text_email(
+            context['template'],
+            subject=context['subject'],
+            recipients=(),
+            template_args=args,
+            request=request,
+            package=context['package'],
+            text_template_extension='.mak')
+        html = _body(message.html)
+        if not html:
+            return None
+        html, text = _split(html), _split(_body(message.body) or u'')
+        if html is None or text is None:
+            return None
+        return cls(html, text)
+
+    def personalize(self, receiver_name, redemption_link):
+        """
+        Return the html and text bodies for the given receiver.
+        """
+        values = {
+            RECEIVER_NAME_TOKEN: receiver_name,
+            REDEMPTION_LINK_TOKEN: redemption_link,
+        }
+        return _personalize(self.html, values), _personalize(self.text, values)
+
+    def queue(self, receiver_name, receiver_email, redemption_link,
+              request, context):
+        html, text = self.personalize(receiver_name, redemption_link)
+        context['mailer'].queue_simple_html_text_email(
+            PERSONALIZED_EMAIL_TEMPLATE,
+            subject=context['subject'],
+            recipients=[receiver_email],
+            bcc=context['bcc'],
+            template_args={'html': html, 'text': text},
+            request=request,
+            text_template_extension='.mak')
+
+
+@interface.implementer(IInvitationEmailDispatcher)
+class InvitationEmailDispatcher(object):
+    """
+    Collects the site invitations sent in a transaction and, once it
+    commits, renders and queues their emails in a greenlet, a batch per
+    transaction, at most ``rate`` messages per second. A failed batch is
+    retried ``retries`` times, waiting ``backoff`` seconds, doubled on
+    each attempt.
+
+    With ``render_once``, the emails of a batch sharing a sender and
+    message are rendered once and personalized by substitution (see
+    :class:`SharedInvitationEmail`).
+
+    The defaults can be overridden with the ``invitations_email_batch_size``,
+    ``invitations_email_rate``, ``invitations_email_retries``,
+    ``invitations_email_backoff`` and ``invitations_email_render_once``
+    application settings.
+    """
+
+    batch_size = 50
+
+    #: Messages per second; zero (or less) does not limit the rate
+    rate = 10
+
+    retries = 3
+
+    backoff = 1.0
+
+    render_once = True
+
+    def __init__(self, batch_size=None, rate=None, retries=None, backoff=None,
+                 render_once=None):
+        for name, value in (('batch_size', batch_size),
+                            ('rate', rate),
+                            ('retries', retries),
+                            ('backoff', backoff),
+                            ('render_once', render_once)):
+            if value is not None:
+                setattr(self, name, value)
+
+    def _setting(self, name, factory):
+        value = getattr(self, name)
+        settings = component.queryUtility(IApplicationSettings) or {}
+        try:
+            return factory(settings.get('invitations_email_' + name, value))
+        except (TypeError, ValueError):
+            logger.warning('Invalid invitation email setting %s', name)
+            return value
+
+    def add(self, invitation, request):
+        txn = transaction.get()
+        pending = getattr(txn, _TXN_EMAILS_ATTR, None)
+        if pending is None:
+            pending = []
+            setattr(txn, _TXN_EMAILS_ATTR, pending)
+            txn.addAfterCommitHook(self._after_commit, args=(pending,))
+        pending.append((getSite().__name__,
+                        request.application_url,
+                        invitation.code))
+
+    def _after_commit(self, success, pending):
+        if success and pending:
+            self._spawn(self.dispatch, list(pending))
+
+    def _spawn(self, func, *args):
+        gevent.spawn(func, *args)
+
+    def _sleep(self, seconds):
+        gevent.sleep(seconds)
+
+    def _run(self, func, site_name):
+        runner = component.getUtility(IDataserverTransactionRunner)
+        return runner(func, site_names=(site_name,))
+
+    def _iter_batches(self, pending):
+        batch_size = max(self._setting('batch_size', int), 1)
+        for key, items in groupby(pending, key=lambda x: x[:2]):
+            codes = [x[2] for x in items]
+            for idx in range(0, len(codes), batch_size):
+                yield key[0], key[1], codes[idx:idx + batch_size]
+
+    def dispatch(self, pending):
+        """
+        Send the emails of the given ``(site name, application url, code)``
+        entries. Returns the number of queued emails.
+        """
+        rate = self._setting('rate', float)
+        total = 0
+        for site_name, application_url, codes in self._iter_batches(pending):
+            total += self._send_with_retries(site_name, application_url, codes)
+            if rate > 0:
+                # Pace the mail relay
+                self._sleep(len(codes) / rate)
+        return total
+
+    def _send_with_retries(self, site_name, application_url, codes):
+        retries = self._setting('retries', int)
+        backoff = self._setting('backoff', float)
+        send = functools.partial(self.send_batch, codes, application_url)
+        for attempt in range(retries + 1):
+            try:
+                return self._run(send, site_name)
+            except Exception:  # pylint: disable=broad-except
+                if attempt >= retries:
+                    logger.exception('Cannot send %s site invitation email(s) (site=%s)',
+                                     len(codes), site_name)
+                    return 0
+                delay = backoff * (2 ** attempt)
+                logger.warning('Failed to send %s site invitation email(s) (site=%s), '
+                               'retrying in %s(s)', len(codes), site_name, delay)
+                self._sleep(delay)
+
+    def send_batch(self, codes, application_url):
+        """
+        Render and queue the emails of the given invitation codes in the
+        current transaction, sharing one email context. Any error fails
+        the whole batch.
+        """
+        count = 0
+        shared = {}
+        render_once = self._setting('render_once', _as_bool)
+        request = make_job_request(application_url)
+        container = component.getUtility(IInvitationsContainer)
+        manager.push({'request': request, 'registry': request.registry})
+        try:
+            context = get_invitation_email_context(request)
+            for code in codes:
+                invitation = container.get_invitation_by_code(code)
+                if invitation is None or not invitation.receiver:
+                    continue
+                sender = User.get_user(invitation.sender)
+                receiver_name = invitation.receiver_name or invitation.receiver
+                email = None
+                if render_once:
+                    key = (invitation.sender, invitation.message)
+                    if key not in shared:
+                        shared[key] = SharedInvitationEmail.render(invitation, sender,
+                                                                   request, context)
+                    email = shared[key]
+                if email is not None:
+                    email.queue(receiver_name,
+                                invitation.receiver,
+                                get_invitation_url(request.application_url, invitation),
+                                request,
+                                context)
+                else:
+                    queue_invitation_email(invitation,
+                                           sender,
+                                           receiver_name,
+                                           invitation.receiver,
+                                           invitation.message,
+                                           request,
+                                           context)
+                count += 1
+        finally:
+            manager.pop()
+        logger.info('Queued %s site invitation email(s)', count)
+        return count
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A transactional outbox of site invitation emails.
+
+The email of a site invitation is written to the outbox in the same
+transaction as the invitation, so an aborted transaction leaves no
+email behind. The outbox is drained by an
+:class:`InvitationEmailOutboxDrainer`, outside of the web requests
+(see the ``nti_drain_invitation_emails`` script). Each email is queued
+with the (transactional) mailer in the same transaction that removes
+its entry, and its key is remembered, so retries never send an email
+twice.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import functools
+
+from itertools import groupby
+
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+
+from persistent import Persistent
+
+from pyramid.threadlocal import manager
+
+from ZODB.POSException import ConflictError
+
+from zope import component
+from zope import interface
+
+from zope.container.btree import BTreeContainer
+
+from zope.container.contained import Contained
+
+from nti.app.invitations.interfaces import IInvitationEmailOutbox
+from nti.app.invitations.interfaces import IInvitationEmailOutboxEntry
+
+from nti.app.invitations.jobs import make_job_request
+
+from nti.app.invitations.subscribers import queue_invitation_email
+from nti.app.invitations.subscribers import get_invitation_email_context
+
+from nti.dataserver.interfaces import IDataserverTransactionRunner
+
+from nti.dataserver.users.users import User
+
+from nti.invitations.interfaces import IInvitationsContainer
+
+#: The name of the outbox utility
+INVITATION_EMAIL_OUTBOX = u'++etc++invitation-email-outbox'
+
+#: Entry states
+PENDING = u'Pending'
+FAILED = u'Failed'
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def get_invitation_email_key(invitation):
+    """
+    Return the idempotency key of the email of the given invitation.
+    Re-sent pending invitations keep their code but are new objects, so
+    the creation time tells their emails apart.
+    """
+    created = getattr(invitation, 'createdTime', None)
+    if not created:
+        return invitation.code
+    return u'%s:%d' % (invitation.code, int(created * 1000))
+
+
+@interface.implementer(IInvitationEmailOutboxEntry)
+class InvitationEmailOutboxEntry(Persistent, Contained):
+
+    state = PENDING
+
+    attempts = 0
+    error = None
+    next_attempt = None
+
+    createdTime = None
+
+    def __init__(self, key, code, site, application_url):
+        self.key = key
+        self.code = code
+        self.site = site
+        self.application_url = application_url
+        self.createdTime = time.time()
+
+    def is_due(self, now=None):
+        now = time.time() if now is None else now
+        return self.state == PENDING and (self.next_attempt or 0) <= now
+
+    def add_failure(self, error, max_attempts, backoff):
+        self.attempts += 1
+        self.error = u'%s' % (error,)
+        if self.attempts >= max_attempts:
+            self.state = FAILED
+        else:
+            self.next_attempt = time.time() + backoff * (2 ** (self.attempts - 1))
+
+
+def _due_item(entry):
+    return (entry.next_attempt or 0, entry.key)
+
+
+@interface.implementer(IInvitationEmailOutbox)
+class InvitationEmailOutbox(BTreeContainer):
+    """
+    The pending entries are indexed by their next attempt time, so the
+    due ones are found without visiting the others. Failed entries are
+    moved out of the container, and kept for ``failed_ttl`` seconds.
+    """
+
+    #: Seconds the keys of delivered emails are remembered for
+    delivered_ttl = 7 * 24 * 60 * 60
+
+    #: Seconds failed entries are kept for
+    failed_ttl = 30 * 24 * 60 * 60
+
+    def __init__(self):
+        super(InvitationEmailOutbox, self).__init__()
+        # (next attempt time, key) of the pending entries
+        self._due = OOTreeSet()
+        # key -> delivery time, and (delivery time, key) for pruning
+        self._delivered = OOBTree()
+        self._delivered_order = OOTreeSet()
+        # key -> failed entry, and (failure time, key) for pruning
+        self._failed = OOBTree()
+        self._failed_order = OOTreeSet()
+
+    def __setitem__(self, key, entry):
+        super(InvitationEmailOutbox, self).__setitem__(key, entry)
+        self._due.add(_due_item(entry))
+
+    def __delitem__(self, key):
+        item = _due_item(self[key])
+        super(InvitationEmailOutbox, self).__delitem__(key)
+        if item in self._due:
+            self._due.remove(item)
+
+    def add_email(self, invitation, site, application_url):
+        key = get_invitation_email_key(invitation)
+        if key in self or key in self._failed or self.is_delivered(key):
+            return None
+        entry = InvitationEmailOutboxEntry(key, invitation.code,
+                                           site, application_url)
+        self[key] = entry
+        return entry
+
+    def add_failure(self, key, error, max_attempts, backoff):
+        entry = self[key]
+        self._due.remove(_due_item(entry))
+        entry.add_failure(error, max_attempts, backoff)
+        if entry.state != FAILED:
+            self._due.add(_due_item(entry))
+            return entry
+        del self[key]
+        now = time.time()
+        self._failed[key] = entry
+        self._failed_order.add((now, key))
+        return entry
+
+    def get_failed(self, key, default=None):
+        return self._failed.get(key, default)
+
+    def is_delivered(self, key):
+        return key in self._delivered
+
+    def mark_delivered(self, key):
+        if key in self:
+            del self[key]
+        now = time.time()
+        self._delivered[key] = now
+        self._delivered_order.add((now, key))
+
+    def _pop_expired(self, order, ttl, now=None):
+        now = time.time() if now is None else now
+        expired = []
+        for item in order:
+            if item[0] > now - ttl:
+                break
+            expired.append(item)
+        for item in expired:
+            order.remove(item)
+        return expired
+
+    def prune_delivered(self, now=None):
+        """
+        Forget the keys of the emails delivered more than
+        ``delivered_ttl`` seconds ago, returning how many.
+        """
+        expired = self._pop_expired(self._delivered_order,
+                                    self.delivered_ttl, now)
+        for when, key in expired:
+            if self._delivered.get(key) == when:
+                del self._delivered[key]
+        return len(expired)
+
+    def prune_failed(self, now=None):
+        """
+        Drop the entries that failed more than ``failed_ttl`` seconds
+        ago, returning how many.
+        """
+        expired = self._pop_expired(self._failed_order, self.failed_ttl, now)
+        for _, key in expired:
+            self._failed.pop(key, None)
+        return len(expired)
+
+    def iter_due(self, now=None):
+        now = time.time() if now is None else now
+        for due, key in self._due:
+            if due > now:
+                break
+            entry = self.get(key)
+            if entry is not None:
+                yield entry
+
+
+def install_invitation_email_outbox(dataserver_folder):
+    lsm = dataserver_folder.getSiteManager()
+    outbox = lsm.queryUtility(IInvitationEmailOutbox)
+    if outbox is None:
+        outbox = InvitationEmailOutbox()
+        outbox.__parent__ = dataserver_folder
+        outbox.__name__ = INVITATION_EMAIL_OUTBOX
+        lsm.registerUtility(outbox, provided=IInvitationEmailOutbox)
+    return outbox
+
+
+class InvitationEmailOutboxDrainer(object):
+    """
+    Delivers the due emails of the outbox, a batch of the same site and
+    application url per transaction.
+
+    Failed deliveries are retried with exponential backoff, up to
+    ``max_attempts`` times; the entry is then moved to the failed
+    entries of the outbox.
+    """
+
+    batch_size = 100
+
+    max_attempts = 5
+
+    backoff = 60.0
+
+    def __init__(self, batch_size=None, max_attempts=None, backoff=None):
+        for name, value in (('batch_size', batch_size),
+                            ('max_attempts', max_attempts),
+                            ('backoff', backoff)):
+            if value is not None:
+                setattr(self, name, value)
+
+    def _run(self, func, site_name=None):
+        runner = component.getUtility(IDataserverTransactionRunner)
+        site_names = (site_name,) if site_name else ()
+        return runner(func, site_names=site_names)
+
+    def due_batches(self):
+        """
+        Return lists of ``(site, application_url, key)`` of the due
+        emails, each of at most ``batch_size`` emails of the same site
+        and application url.
+        """
+        outbox = component.queryUtility(IInvitationEmailOutbox)
+        if outbox is None:
+            return []
+        outbox.prune_delivered()
+        outbox.prune_failed()
+        due = sorted((x.site, x.application_url, x.key)
+                     for x in outbox.iter_due())
+        result = []
+        for _, group in groupby(due, key=lambda x: x[:2]):
+            group = list(group)
+            for idx in range(0, len(group), self.batch_size):
+                result.append(group[idx:idx + self.batch_size])
+        return result
+
+    def drain(self):
+        """
+        Deliver the due emails, returning the number delivered.
+        """
+        count = 0
+        for batch in self._run(self.due_batches):
+            site_name, application_url = batch[0][:2]
+            keys = [x[2] for x in batch]
+            try:
+                count += self._run(functools.partial(self.deliver, keys,
+                                                     application_url),
+                                   site_name)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Cannot deliver %s invitation email(s) (site=%s)',
+                                 len(keys), site_name)
+        logger.info('Delivered %s invitation email(s)', count)
+        return count
+
+    def deliver(self, keys, application_url):
+        """
+        Queue the emails of the given outbox keys in the current
+        transaction, removing their entries.
+        """
+        count = 0
+        outbox = component.getUtility(IInvitationEmailOutbox)
+        container = component.getUtility(IInvitationsContainer)
+        request = make_job_request(application_url)
+        manager.push({'request': request, 'registry': request.registry})
+        try:
+            context = get_invitation_email_context(request)
+            for key in keys:
+                entry = outbox.get(key)
+                if entry is None or not entry.is_due():
+                    continue
+                invitation = container.get_invitation_by_code(entry.code)
+                if invitation is None \
+                        or not invitation.receiver \
+                        or get_invitation_email_key(invitation) != key:
+                    # Removed or re-sent since
+                    del outbox[key]
+                    continue
+                try:
+                    queue_invitation_email(invitation,
+                                           User.get_user(invitation.sender),
+                                           invitation.receiver_name or invitation.receiver,
+                                           invitation.receiver,
+                                           invitation.message,
+                                           request,
+                                           context)
+                except ConflictError:
+                    raise
+                except Exception as e:  # pylint: disable=broad-except
+                    logger.warning('Cannot deliver invitation email %s (%s)', key, e)
+                    outbox.add_failure(key, e, self.max_attempts, self.backoff)
+                    continue
+                outbox.mark_delivered(key)
+                count += 1
+        finally:
+            manager.pop()
+        return count
@@ -10,37 +10,69 @@ from __future__ import absolute_import
 
 from zope import component
 
+from zope.intid.interfaces import IIntIds
+
+from nti.coremetadata.interfaces import SYSTEM_USER_ID
+from nti.coremetadata.interfaces import SYSTEM_USER_NAME
+
 from nti.dataserver.interfaces import IUser
 from nti.dataserver.interfaces import ISystemUserPrincipal
 
 from nti.dataserver.metadata.predicates import BasePrincipalObjects
 
+from nti.invitations.index import IX_SENDER
+
+from nti.invitations.index import get_invitations_catalog
+
 from nti.invitations.interfaces import IInvitationsContainer
 
 logger = __import__('logging').getLogger(__name__)
 
 
-@component.adapter(ISystemUserPrincipal)
-class SystemInvitationsObjects(BasePrincipalObjects):
+class InvitationsObjectsMixin(object):
 
     @property
     def invitations(self):
         return component.getUtility(IInvitationsContainer)
 
+    def iter_sent_invitations(self, senders):
+        """
+        Lazily yield the invitations sent by any of the given usernames,
+        resolved from the catalog sender index.
+        """
+        catalog = get_invitations_catalog()
+        if catalog is None:  # pragma: no cover
+            for obj in self.invitations.values():
+                yield obj
+            return
+        terms = set()
+        for sender in senders:
+            if sender:
+                terms.update((sender, sender.lower()))
+        doc_ids = catalog[IX_SENDER].apply({'any_of': tuple(terms)})
+        intids = component.getUtility(IIntIds)
+        for doc_id in doc_ids or ():
+            obj = intids.queryObject(doc_id)
+            if obj is not None:
+                yield obj
+
+
+@component.adapter(ISystemUserPrincipal)
+class SystemInvitationsObjects(BasePrincipalObjects,
+                               InvitationsObjectsMixin):
+
     def iter_objects(self):
-        for obj in self.invitations.values():
+        for obj in self.iter_sent_invitations((SYSTEM_USER_ID,
+                                               SYSTEM_USER_NAME)):
             if self.is_system_username(self.creator(obj)):
                 yield obj
 
 
 @component.adapter(IUser)
-class UserInvitationsObjects(BasePrincipalObjects):
-
-    @property
-    def invitations(self):
-        return component.getUtility(IInvitationsContainer)
+class UserInvitationsObjects(BasePrincipalObjects,
+                             InvitationsObjectsMixin):
 
     def iter_objects(self):
-        for obj in self.invitations.values():
+        for obj in self.iter_sent_invitations((self.username,)):
             if self.creator(obj) == self.username:
                 yield obj
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""
+Delivers the site invitation emails of the invitation email outbox
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from nti.monkey import patch_relstorage_all_except_gevent_on_import
+
+patch_relstorage_all_except_gevent_on_import.patch()
+
+import os
+import sys
+import time
+import argparse
+
+from nti.app.invitations.outbox import InvitationEmailOutboxDrainer
+
+from nti.dataserver.utils import run_with_dataserver
+
+from nti.dataserver.utils.base_script import create_context
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _drain(drainer, interval=None):
+    while True:
+        start = time.time()
+        count = drainer.drain()
+        print('Delivered %s invitation email(s) in %.2f(s)'
+              % (count, time.time() - start))
+        if not interval:
+            return count
+        time.sleep(interval)
+
+
+def process_args(args=None):
+    arg_parser = argparse.ArgumentParser(description="Deliver the invitation emails of the outbox.")
+
+    arg_parser.add_argument('--batch-size',
+                            dest='batch_size',
+                            action='store',
+                            type=int,
+                            default=InvitationEmailOutboxDrainer.batch_size,
+                            help="Emails delivered per transaction.")
+
+    arg_parser.add_argument('--max-attempts',
+                            dest='max_attempts',
+                            action='store',
+                            type=int,
+                            default=InvitationEmailOutboxDrainer.max_attempts,
+                            help="Deliveries attempted before an email is failed.")
+
+    arg_parser.add_argument('--interval',
+                            dest='interval',
+                            action='store',
+                            type=float,
+                            default=0,
+                            help="Keep draining, every this many seconds.")
+
+    arg_parser.add_argument('--devmode',
+                            dest='devmode',
+                            action='store_true',
+                            default=False,
+                            help="Dev mode")
+
+    arg_parser.add_argument('-v', '--verbose', help="Be verbose",
+                            action='store_true', dest='verbose')
+
+    args = arg_parser.parse_args(args=args)
+
+    env_dir = os.getenv('DATASERVER_DIR')
+    if not env_dir or not os.path.exists(env_dir) and not os.path.isdir(env_dir):
+        print("Invalid dataserver environment root directory", env_dir)
+        sys.exit(2)
+
+    if args.batch_size <= 0 or args.max_attempts <= 0 or args.interval < 0:
+        print("Batch size, attempts and interval must be positive")
+        sys.exit(2)
+
+    drainer = InvitationEmailOutboxDrainer(batch_size=args.batch_size,
+                                           max_attempts=args.max_attempts)
+    config_features = ('devmode',) if args.devmode else ()
+    context = create_context(env_dir, config_features)
+    # The drainer commits a transaction per batch
+    run_with_dataserver(environment_dir=env_dir,
+                        xmlconfig_packages=('nti.appserver', 'nti.app.invitations'),
+                        context=context,
+                        verbose=args.verbose,
+                        minimal_ds=True,
+                        use_transaction_runner=False,
+                        function=lambda: _drain(drainer, args.interval))
+
+
+def main(args=None):
+    process_args(args)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
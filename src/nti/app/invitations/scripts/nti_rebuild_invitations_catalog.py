@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*
+"""
+Rebuilds or verifies the invitations catalog
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from nti.monkey import patch_relstorage_all_except_gevent_on_import
+
+patch_relstorage_all_except_gevent_on_import.patch()
+
+import os
+import sys
+import time
+import argparse
+import functools
+import multiprocessing
+
+import transaction
+
+from zope import component
+
+from zope.intid.interfaces import IIntIds
+
+from nti.app.invitations.index import apply_index_values
+from nti.app.invitations.index import reindex_invitations
+from nti.app.invitations.index import compute_index_values
+from nti.app.invitations.index import unindex_stale_invitations
+from nti.app.invitations.index import verify_invitations_catalog
+
+from nti.dataserver.interfaces import IDataserverTransactionRunner
+
+from nti.dataserver.utils import run_with_dataserver
+
+from nti.dataserver.utils.base_script import create_context
+
+from nti.invitations.index import get_invitations_catalog
+
+from nti.invitations.interfaces import IInvitationsContainer
+
+from nti.metadata import queue_add
+
+#: The default number of invitations indexed per transaction
+DEFAULT_CHUNK_SIZE = 500
+
+#: The most worker processes ``--parallel`` starts
+MAX_PARALLEL_WORKERS = 8
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _in_transaction(func, *args, **kwargs):
+    runner = component.getUtility(IDataserverTransactionRunner)
+    return runner(functools.partial(func, *args, **kwargs))
+
+
+def _read_only(func, *args):
+    # The transaction cannot be committed
+    transaction.doom()
+    return func(*args)
+
+
+def _compute_values(worker=0, workers=1):
+    """
+    Compute the index values of every ``workers``-th invitation of the
+    container, starting at ``worker``.
+    """
+    result = {}
+    catalog = get_invitations_catalog()
+    intids = component.getUtility(IIntIds)
+    container = component.getUtility(IInvitationsContainer)
+    for idx, key in enumerate(container.keys()):
+        if idx % workers != worker:
+            continue
+        invitation = container.get(key)
+        doc_id = intids.queryId(invitation) if invitation is not None else None
+        if doc_id is not None:
+            result[doc_id] = compute_index_values(invitation, catalog)
+    return result
+
+
+def _apply_values(doc_ids, doc_values, metadata=False):
+    catalog = get_invitations_catalog()
+    intids = component.getUtility(IIntIds)
+    # Only the indexes the values cannot be computed for need the invitations
+    computed = set(next(iter(doc_values.values()), ()))
+    load = metadata or bool(set(catalog.keys()) - computed)
+    for doc_id in doc_ids:
+        invitation = intids.queryObject(doc_id) if load else None
+        apply_index_values(doc_id, doc_values[doc_id], invitation, catalog)
+        if metadata and invitation is not None:
+            queue_add(invitation)
+    return len(doc_ids)
+
+
+def _rebuild(chunk_size=DEFAULT_CHUNK_SIZE, doc_values=None, metadata=False,
+             cursor=None):
+    """
+    Reindex the invitations catalog in place, committing a transaction
+    per chunk, then unindex the invitations that are gone.
+
+    Return the number of invitations indexed, or None if a chunk failed;
+    the chunks committed before it are kept.
+    """
+    total = 0
+    start = time.time()
+    if doc_values is not None:
+        # Values computed by the workers
+        doc_ids = sorted(doc_values)
+        for idx in range(0, len(doc_ids), chunk_size):
+            try:
+                total += _in_transaction(_apply_values,
+                                         doc_ids[idx:idx + chunk_size],
+                                         doc_values,
+                                         metadata)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Cannot index invitations %s to %s',
+                                 idx, idx + chunk_size)
+                return None
+            print('Indexed %s invitation(s) in %.2f(s)'
+                  % (total, time.time() - start))
+    else:
+        while True:
+            try:
+                count, cursor, elapsed = _in_transaction(reindex_invitations,
+                                                         cursor=cursor,
+                                                         chunk_size=chunk_size,
+                                                         queue=metadata)
+            except Exception:  # pylint: disable=broad-except
+                # The cursor resumes the rebuild after a failure
+                logger.exception('Cannot index invitations (resume with --cursor %s)',
+                                 cursor)
+                return None
+            total += count
+            print('Indexed %s invitation(s) in %.2f(s) (total=%s, cursor=%s)'
+                  % (count, elapsed, total, cursor))
+            if cursor is None:
+                break
+    stale = _in_transaction(unindex_stale_invitations)
+    print('Unindexed %s stale invitation(s)' % stale)
+    return total
+
+
+def _verify(doc_values=None):
+    if doc_values is None:
+        doc_values = _compute_values()
+    report = verify_invitations_catalog(doc_values)
+    problems = 0
+    for name, values in sorted(report.items()):
+        counts = dict((k, len(v)) for k, v in values.items())
+        problems += sum(counts.values())
+        print('%s: %s missing, %s stale, %s mismatched'
+              % (name, counts['missing'], counts['stale'], counts['mismatched']))
+    print('%s invitation(s) verified, %s problem(s)'
+          % (len(doc_values), problems))
+    return problems
+
+
+def _run(args, function, use_transaction_runner=True):
+    env_dir = os.getenv('DATASERVER_DIR')
+    config_features = ('devmode',) if args.devmode else ()
+    context = create_context(env_dir, config_features)
+    return run_with_dataserver(environment_dir=env_dir,
+                               xmlconfig_packages=('nti.appserver', 'nti.app.invitations'),
+                               context=context,
+                               verbose=args.verbose,
+                               minimal_ds=True,
+                               use_transaction_runner=use_transaction_runner,
+                               function=function)
+
+
+def _worker(args, worker):
+    return _run(args, functools.partial(_read_only, _compute_values,
+                                        worker, args.parallel))
+
+
+def _compute_values_in_parallel(args):
+    """
+    Compute the index values in ``args.parallel`` worker processes.
+
+    Each worker starts a dataserver of its own (configuration, database
+    and connection caches), which costs seconds and the memory of a
+    process per worker; only large containers are worth it.
+    """
+    pool = multiprocessing.Pool(args.parallel)
+    try:
+        result = {}
+        for values in pool.map(functools.partial(_worker, args),
+                               range(args.parallel)):
+            result.update(values or {})
+        return result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def process_args(args=None):
+    arg_parser = argparse.ArgumentParser(description="Rebuild or verify the invitations catalog.")
+
+    arg_parser.add_argument('--verify',
+                            dest='verify',
+                            action='store_true',
+                            default=False,
+                            help="Compare the catalog with the container without writing.")
+
+    arg_parser.add_argument('--parallel',
+                            dest='parallel',
+                            action='store',
+                            type=int,
+                            default=0,
+                            help="Compute index values in this many worker processes "
+                                 "(at most %s and the number of CPUs); each one "
+                                 "starts a dataserver." % MAX_PARALLEL_WORKERS)
+
+    arg_parser.add_argument('--chunk-size',
+                            dest='chunk_size',
+                            action='store',
+                            type=int,
+                            default=DEFAULT_CHUNK_SIZE,
+                            help="Invitations indexed per transaction.")
+
+    arg_parser.add_argument('--cursor',
+                            dest='cursor',
+                            action='store',
+                            default=None,
+                            help="Resume a rebuild after this container key.")
+
+    arg_parser.add_argument('--metadata',
+                            dest='metadata',
+                            action='store_true',
+                            default=False,
+                            help="Also queue the invitations for metadata indexing.")
+
+    arg_parser.add_argument('--devmode',
+                            dest='devmode',
+                            action='store_true',
+                            default=False,
+                            help="Dev mode")
+
+    arg_parser.add_argument('-v', '--verbose', help="Be verbose",
+                            action='store_true', dest='verbose')
+
+    args = arg_parser.parse_args(args=args)
+
+    env_dir = os.getenv('DATASERVER_DIR')
+    if not env_dir or not os.path.exists(env_dir) and not os.path.isdir(env_dir):
+        print("Invalid dataserver environment root directory", env_dir)
+        sys.exit(2)
+
+    if args.chunk_size <= 0 or args.parallel < 0:
+        print("Chunk size and parallel workers must be positive")
+        sys.exit(2)
+
+    if args.cursor and (args.parallel or args.verify):
+        print("A cursor only resumes a rebuild without parallel workers")
+        sys.exit(2)
+
+    if args.parallel:
+        workers = min(args.parallel, MAX_PARALLEL_WORKERS,
+                      multiprocessing.cpu_count())
+        if workers < args.parallel:
+            print("Using %s parallel workers" % workers)
+        args.parallel = workers
+
+    doc_values = None
+    if args.parallel:
+        doc_values = _compute_values_in_parallel(args)
+
+    result = {}
+    if args.verify:
+        def _verify_catalog():
+            result['problems'] = _verify(doc_values)
+        _run(args, functools.partial(_read_only, _verify_catalog))
+        # Any missing, stale or mismatched entry fails the verification
+        return 1 if result.get('problems', 1) else 0
+
+    def _rebuild_catalog():
+        result['total'] = _rebuild(args.chunk_size, doc_values,
+                                   args.metadata, args.cursor)
+    # Each chunk is committed by its own transaction
+    _run(args, _rebuild_catalog, use_transaction_runner=False)
+    return 0 if result.get('total') is not None else 1
+
+
+def main(args=None):
+    sys.exit(process_args(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,18 +17,34 @@ from zc.intid.interfaces import IBeforeIdRemovedEvent
 from zope import component
 from zope import interface
 
+from zope.component.hooks import getSite
+
 from zope.i18n import translate
 
+from zope.intid.interfaces import IIntIds
+
 from zope.lifecycleevent.interfaces import IObjectAddedEvent
+from zope.lifecycleevent.interfaces import IObjectModifiedEvent
+
+from zope.processlifetime import IProcessStarting
 
 from nti.app.invitations import MessageFactory as _
 
 from nti.app.invitations import SITE_INVITATION_SESSION_KEY
 from nti.app.invitations import SITE_INVITATION_EMAIL_SESSION_KEY
 
+from nti.app.invitations.caches import get_site_components_cache
+
+from nti.app.invitations.index import reindex_receiver_name
+from nti.app.invitations.index import get_entity_invitation_ids
+
 from nti.app.invitations.interfaces import ISiteInvitation
+from nti.app.invitations.interfaces import IInvitationEmailOutbox
+from nti.app.invitations.interfaces import IInvitationEmailDispatcher
 from nti.app.invitations.interfaces import InvitationRequiredError
 
+from nti.app.invitations.utils import remove_invitations
+from nti.app.invitations.utils import remove_sent_invitations
 from nti.app.invitations.utils import get_invitation_url
 from nti.app.invitations.utils import accept_site_invitation_by_code
 
@@ -48,6 +64,8 @@ from nti.common.url import safe_add_query_params
 from nti.dataserver.authentication import get_current_request
 
 from nti.dataserver.interfaces import IUser
+from nti.dataserver.interfaces import ICommunity
+from nti.dataserver.interfaces import IDynamicSharingTargetFriendsList
 
 from nti.dataserver.users.interfaces import IUserProfile
 from nti.dataserver.users.interfaces import IFriendlyNamed
@@ -55,12 +73,15 @@ from nti.dataserver.users.interfaces import IWillCreateNewEntityEvent
 
 from nti.dataserver.users.users import User
 
+from nti.invitations.index import IX_RECEIVER
+
+from nti.invitations.index import get_invitations_catalog
+
+from nti.invitations.interfaces import IInvitation
 from nti.invitations.interfaces import IInvitationSentEvent
-from nti.invitations.interfaces import IInvitationsContainer
+from nti.invitations.interfaces import IInvitationAcceptedEvent
 from nti.invitations.interfaces import InvitationValidationError
 
-from nti.invitations.utils import get_sent_invitations
-
 from nti.mailer.interfaces import ITemplatedMailer
 
 logger = __import__('logging').getLogger(__name__)
@@ -68,18 +89,78 @@ logger = __import__('logging').getLogger(__name__)
 
 @component.adapter(IUser, IBeforeIdRemovedEvent)
 def _user_removed(user, unused_event):
-    invitations = set()
-    # check unaccepted invitations sent via username
-    invitations.update(get_sent_invitations(user.username))
-    # check unaccepted invitations sent via user's email
+    # unaccepted invitations sent via username or the user's email
     profile = IUserProfile(user)
     email = getattr(profile, 'email', None)
-    if email:
-        invitations.update(get_sent_invitations(email))
     # remove unaccepted invitations
-    container = component.getUtility(IInvitationsContainer)
-    for invitation in invitations:
-        container.remove(invitation)
+    remove_sent_invitations((user.username, email))
+
+
+def _remove_entity_invitations(entity):
+    # Join invitations may refer to the entity by username (communities)
+    # or NTIID (DFLs)
+    catalog = get_invitations_catalog()
+    if catalog is None:
+        return
+    entities = (getattr(entity, 'username', None),
+                getattr(entity, 'NTIID', None))
+    doc_ids = get_entity_invitation_ids(entities, pending=True, catalog=catalog)
+    if not doc_ids:
+        return
+    count = remove_invitations(doc_ids)
+    logger.info('Removed %s pending invitation(s) to join %s',
+                count, entity)
+
+
+@component.adapter(ICommunity, IBeforeIdRemovedEvent)
+def _community_removed(community, unused_event):
+    _remove_entity_invitations(community)
+
+
+@component.adapter(IDynamicSharingTargetFriendsList, IBeforeIdRemovedEvent)
+def _dfl_removed(dfl, unused_event):
+    _remove_entity_invitations(dfl)
+
+
+@component.adapter(IInvitation, IInvitationAcceptedEvent)
+def _invitation_accepted(invitation, unused_event):
+    # The receiver becomes the accepting user
+    reindex_receiver_name(invitation)
+
+
+@component.adapter(IInvitation, IObjectModifiedEvent)
+def _invitation_modified(invitation, unused_event):
+    reindex_receiver_name(invitation)
+
+
+#: The user attributes indexed with the invitations the user accepted
+_INDEXED_USER_ATTRIBUTES = frozenset(('realname', 'alias'))
+
+
+def _indexed_attributes_changed(event):
+    for description in getattr(event, 'descriptions', None) or ():
+        names = getattr(description, 'attributes', None) or ()
+        if _INDEXED_USER_ATTRIBUTES.intersection(names):
+            return True
+    return False
+
+
+@component.adapter(IUser, IObjectModifiedEvent)
+def _user_modified(user, event):
+    # Update the receiver terms of the invitations the user has accepted
+    # (their receiver is the username) if the realname or alias changed
+    if not _indexed_attributes_changed(event):
+        return
+    catalog = get_invitations_catalog()
+    if catalog is None:
+        return
+    intids = component.getUtility(IIntIds)
+    username = user.username
+    doc_ids = catalog[IX_RECEIVER].apply({'any_of': (username, username.lower())})
+    for doc_id in doc_ids or ():
+        invitation = intids.queryObject(doc_id)
+        if invitation is not None:
+            reindex_receiver_name(invitation, catalog, intids)
 
 
 def _validate_site_invitation(user):
@@ -137,38 +218,68 @@ def _get_app_setting(setting_name, default):
     return settings.get(setting_name, default)
 
 
+#: The parsed ``invitations_bcc`` setting and the raw value it was parsed from
+_invitations_bcc = {}
+
+
+def parse_invitations_bcc(value):
+    """
+    Return the valid addrs of a comma separated ``invitations_bcc``
+    setting, warning about the invalid ones.
+    """
+    result = []
+    for email in (value or '').split(","):
+        email = email.strip()
+        if not email:
+            continue
+        if isValidMailAddress(email):
+            result.append(email)
+        else:
+            logger.warning("Ignoring invalid invitations bcc address %r", email)
+    return tuple(result)
+
+
 def _get_invitations_bcc():
-    invitations_bcc = _get_app_setting("invitations_bcc", None) or ()
+    # Only parsed (and logged) when the setting changes
+    value = _get_app_setting("invitations_bcc", None) or ''
+    if 'bcc' not in _invitations_bcc or _invitations_bcc['value'] != value:
+        bcc = parse_invitations_bcc(value)
+        _invitations_bcc.update(value=value, bcc=bcc)
+        logger.info("Using bcc of %s for sending invitation", bcc)
+    return _invitations_bcc['bcc']
+
 
-    if invitations_bcc:
-        invitations_bcc = [email.strip() for email in invitations_bcc.split(",")]
-        invitations_bcc = [email for email in invitations_bcc
-                           if isValidMailAddress(email.strip())]
-        invitations_bcc = tuple(invitations_bcc)
+def reload_invitations_bcc():
+    """
+    Parse the ``invitations_bcc`` setting again, returning the addrs.
+    """
+    _invitations_bcc.clear()
+    return _get_invitations_bcc()
 
-    logger.info("Using bcc of %s for sending invitation" % (invitations_bcc,))
 
-    return tuple(invitations_bcc)
+@component.adapter(IProcessStarting)
+def _validate_invitations_bcc(unused_event):
+    if component.queryUtility(IApplicationSettings) is not None:
+        reload_invitations_bcc()
 
 
 def _site_policy():
     return component.getUtility(ISitePolicyUserEventListener)
 
 
-def send_invitation_email(invitation,
-                          sender,
-                          receiver_name,
-                          receiver_email,
-                          message,
-                          request=None):
-    if not request or not receiver_email:
-        logger.warn("Not sending an invitation email because of no email or request")
-        return False
+#: The context keys of the site invitation macros and their names
+_INVITATION_MACROS = (('custom_image', 'site_invitation_image'),
+                      ('tagline', 'site_invitation_tagline'),
+                      ('brand_message', 'site_invitation_brand_message'))
+
+_MACRO_REQUIRED = (interface.Interface, interface.Interface, interface.Interface)
 
-    template_args = _TemplateArgs(request=request,
-                                  remoteUser=sender,
-                                  objs=[invitation])
 
+def _query_invitation_macro(name):
+    return component.queryMultiAdapter(_MACRO_REQUIRED, name=name)
+
+
+def _resolve_invitation_email_context():
     policy = _site_policy()
     template = (getattr(policy, 'SITE_INVITATION_EMAIL_TEMPLATE_BASE_NAME', None)
                 or 'site_invitation_email')
@@ -176,31 +287,74 @@ def send_invitation_email(invitation,
     # Some sites want a custom macros in the invitation
     # If there is a macro registered then we will render it to
     # We have to do this here because we cannot do try/except within the template
-    custom_image = component.queryMultiAdapter((interface.Interface, interface.Interface, interface.Interface),
-                                               name='site_invitation_image')
-    tagline = component.queryMultiAdapter((interface.Interface, interface.Interface, interface.Interface),
-                                          name='site_invitation_tagline')
-    brand_message = component.queryMultiAdapter((interface.Interface, interface.Interface, interface.Interface),
-                                                name='site_invitation_brand_message')
-
-    support_email = getattr(policy, 'SUPPORT_EMAIL', 'support@nextthought.com')
+    macros = tuple((key, name) for key, name in _INVITATION_MACROS
+                   if _query_invitation_macro(name) is not None)
+
     brand = get_site_brand_name()
-    package = getattr(policy, 'PACKAGE', None)
+    subject = (getattr(policy, 'SITE_INVITATION_EMAIL_SUBJECT', None)
+               or u"You're invited to ${site_name}")
+    subject = translate(_(subject,
+                        mapping={'site_name': brand}))
+    return {
+        'template': template,
+        'subject': subject,
+        'macros': macros,
+        'support_email': getattr(policy, 'SUPPORT_EMAIL', 'support@nextthought.com'),
+        'brand': brand,
+        'package': getattr(policy, 'PACKAGE', None),
+    }
+
+
+def get_invitation_email_context(unused_request=None):
+    """
+    Return the parts of the site invitation email that do not depend on
+    the invitation (template, subject, branding, macros, bcc and mailer)
+    for the current site, to be shared by the emails of a batch.
+
+    The template, subject and branding, and which macros the site
+    registers, are cached until components are (un)registered in the
+    site; the macros and the mailer themselves are looked up each time.
+    """
+    cache = get_site_components_cache()
+    result = dict(cache.get('invitation_email_context',
+                            _resolve_invitation_email_context))
+    macros = dict(result.pop('macros'))
+    for key, name in _INVITATION_MACROS:
+        result[key] = _query_invitation_macro(name) if key in macros else None
+    result['mailer'] = component.getUtility(ITemplatedMailer)
+    result['bcc'] = _get_invitations_bcc()
+    return result
+
+
+def get_invitation_email_args(invitation,
+                              sender,
+                              receiver_name,
+                              message,
+                              request,
+                              context,
+                              redemption_link=None):
+    """
+    Return the template args of the site invitation email; the
+    redemption link of the invitation is used unless one is given.
+    """
+    template_args = _TemplateArgs(request=request,
+                                  remoteUser=sender,
+                                  objs=[invitation])
 
     names = IFriendlyNamed(sender)
     informal_username = names.alias or names.realname or sender.username
 
-    redemption_link = get_invitation_url(request.application_url, invitation)
+    if redemption_link is None:
+        redemption_link = get_invitation_url(request.application_url, invitation)
 
-    receiver_name = receiver_name
     msg_args = {
         'receiver_name': receiver_name,
-        'support_email': support_email,
+        'support_email': context['support_email'],
         'redemption_link': redemption_link,
-        'brand': brand,
-        'custom_image_macro': custom_image,
-        'tagline': tagline,
-        'brand_message': brand_message,
+        'brand': context['brand'],
+        'custom_image_macro': context['custom_image'],
+        'tagline': context['tagline'],
+        'brand_message': context['brand_message'],
         'sender_content': None
     }
 
@@ -213,22 +367,52 @@ def send_invitation_email(invitation,
             'message': message,
             'avatar_styles': avatar_styles
         }
+    return msg_args
+
+
+def queue_invitation_email(invitation,
+                           sender,
+                           receiver_name,
+                           receiver_email,
+                           message,
+                           request,
+                           context=None):
+    """
+    Queue the site invitation email, raising any error. A ``context``
+    from :func:`get_invitation_email_context` may be given.
+    """
+    context = get_invitation_email_context(request) if context is None else context
+    msg_args = get_invitation_email_args(invitation, sender, receiver_name,
+                                         message, request, context)
+    context['mailer'].queue_simple_html_text_email(
+        context['template'],
+        subject=context['subject'],
+        recipients=[receiver_email],
+        bcc=context['bcc'],
+        template_args=msg_args,
+        request=request,
+        package=context['package'],
+        text_template_extension='.mak')
 
-    subject = (getattr(policy, 'SITE_INVITATION_EMAIL_SUBJECT', None)
-               or u"You're invited to ${site_name}")
-    subject = translate(_(subject,
-                        mapping={'site_name': brand}))
+
+def send_invitation_email(invitation,
+                          sender,
+                          receiver_name,
+                          receiver_email,
+                          message,
+                          request=None,
+                          context=None):
+    if not request or not receiver_email:
+        logger.warn("Not sending an invitation email because of no email or request")
+        return False
     try:
-        mailer = component.getUtility(ITemplatedMailer)
-        mailer.queue_simple_html_text_email(
-            template,
-            subject=subject,
-            recipients=[receiver_email],
-            bcc=_get_invitations_bcc(),
-            template_args=msg_args,
-            request=request,
-            package=package,
-            text_template_extension='.mak')
+        queue_invitation_email(invitation,
+                               sender,
+                               receiver_name,
+                               receiver_email,
+                               message,
+                               request,
+                               context)
     except Exception:
         logger.exception("Cannot send site invitation email to %s",
                          receiver_email)
@@ -236,9 +420,32 @@ def send_invitation_email(invitation,
     return True
 
 
+def get_invitation_email_outbox():
+    """
+    Return the invitation email outbox if it is enabled with the
+    ``invitations_email_outbox`` application setting, otherwise ``None``.
+    """
+    settings = component.queryUtility(IApplicationSettings) or {}
+    enabled = str(settings.get('invitations_email_outbox', '')).strip().lower()
+    if enabled not in ('1', 'true', 'yes', 'on'):
+        return None
+    return component.queryUtility(IInvitationEmailOutbox)
+
+
 @component.adapter(ISiteInvitation, IInvitationSentEvent)
 def _on_site_invitation_sent(invitation, event):
     request = getattr(event, 'request', None) or get_current_request()
+    outbox = get_invitation_email_outbox()
+    if outbox is not None and request is not None and invitation.receiver:
+        # Delivered by the outbox drainer if we commit; the links are
+        # built from the application url of the sending request
+        outbox.add_email(invitation, getSite().__name__, request.application_url)
+        return
+    dispatcher = component.queryUtility(IInvitationEmailDispatcher)
+    if dispatcher is not None and request is not None and invitation.receiver:
+        # Rendered and queued in batches once we commit
+        dispatcher.add(invitation, request)
+        return
     sender = User.get_user(invitation.sender)
     send_invitation_email(invitation,
                           sender=sender,
@@ -257,3 +464,12 @@ def require_invite_for_user_creation(unused_user, event):
         invitation = request.session.get(SITE_INVITATION_SESSION_KEY)
         if invitation is None:
             raise InvitationRequiredError()
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(_invitations_bcc.clear)
+    del addCleanUp
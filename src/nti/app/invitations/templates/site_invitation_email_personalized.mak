@@ -0,0 +1 @@
+${text | n}
\ No newline at end of file
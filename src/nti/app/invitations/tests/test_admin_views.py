@@ -8,6 +8,7 @@ from __future__ import absolute_import
 # pylint: disable=protected-access,too-many-public-methods,arguments-differ
 
 from hamcrest import is_
+from hamcrest import none
 from hamcrest import is_not
 from hamcrest import has_entry
 from hamcrest import has_length
@@ -26,6 +27,8 @@ from nti.invitations.interfaces import IInvitationsContainer
 
 from nti.invitations.model import Invitation
 
+from nti.invitations.utils import get_invitations
+
 
 class TestAdminViews(ApplicationLayerTest):
 
@@ -115,3 +118,34 @@ class TestAdminViews(ApplicationLayerTest):
         res = self.testapp.post('/dataserver2/Invitations/@@RebuildInvitationsCatalog',
                                 status=200)
         assert_that(res.json_body, has_entry('Total', is_(2)))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_rebuild_invitations_catalog_in_chunks(self):
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            invitations = component.getUtility(IInvitationsContainer)
+            for code in (u'bleach1', u'bleach2', u'bleach3'):
+                invitations.add(Invitation(receiver=u'ichigo',
+                                           sender=u'aizen',
+                                           code=code))
+
+        href = '/dataserver2/Invitations/@@RebuildInvitationsCatalog'
+        res = self.testapp.post_json(href, {'chunk_size': 2}, status=200)
+        assert_that(res.json_body, has_entry('Total', is_(2)))
+        assert_that(res.json_body, has_entry('Elapsed', is_not(none())))
+        cursor = res.json_body['Cursor']
+        assert_that(cursor, is_not(none()))
+
+        # The catalog is reindexed in place
+        with mock_dataserver.mock_db_trans(self.ds):
+            assert_that(get_invitations(senders=u'aizen'), has_length(3))
+
+        res = self.testapp.post_json(href, {'chunk_size': 2, 'cursor': cursor},
+                                     status=200)
+        assert_that(res.json_body, has_entry('Total', is_(1)))
+        assert_that(res.json_body, has_entry('Cursor', is_(none())))
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            assert_that(get_invitations(senders=u'aizen'), has_length(3))
+
+        self.testapp.post_json(href, {'chunk_size': 'a'}, status=422)
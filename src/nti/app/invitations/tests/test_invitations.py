@@ -8,21 +8,54 @@ from __future__ import absolute_import
 # pylint: disable=protected-access,too-many-public-methods,arguments-differ
 
 from hamcrest import assert_that
+from hamcrest import contains
+from hamcrest import contains_inanyorder
+from hamcrest import has_key
+from hamcrest import has_entries
 from hamcrest import has_length
 from hamcrest import is_
+from hamcrest import none
 from hamcrest import not_none
 
 import time
+
+import fudge
+
 from hamcrest import is_not
 from nti.app.invitations.utils import accept_site_invitation_by_code
 from nti.dataserver.users.interfaces import IUserProfile
+from nti.dataserver.users.interfaces import IFriendlyNamed
 
 from zope import component
 from zope import interface
 
+from pyramid.testing import DummyRequest
+
+from zope.event import notify
+
+from zope.intid.interfaces import IIntIds
+
+from zope.lifecycleevent import Attributes
+from zope.lifecycleevent import ObjectModifiedEvent
+
+from zope.location import locate
+
+from zc.catalog.catalogindex import NormalizationWrapper
+
+from zc.catalog.index import ValueIndex
+
 from nti.app.invitations import GENERIC_SITE_INVITATION_MIMETYPE
 from nti.app.invitations import SITE_INVITATION_MIMETYPE
 
+from nti.app.invitations.index import IX_CREATEDTIME
+
+from nti.app.invitations.index import apply_index_values
+from nti.app.invitations.index import compute_index_values
+from nti.app.invitations.index import reindex_invitations
+from nti.app.invitations.index import search_invitation_ids
+from nti.app.invitations.index import unindex_stale_invitations
+from nti.app.invitations.index import verify_invitations_catalog
+
 from nti.app.invitations.invitations import DefaultGenericSiteInvitationActor
 from nti.app.invitations.invitations import DefaultSiteAdminInvitationActor
 from nti.app.invitations.invitations import DefaultSiteInvitationActor
@@ -33,6 +66,15 @@ from nti.app.invitations.invitations import SiteAdminInvitation
 from nti.app.invitations.invitations import SiteInvitation
 
 from nti.app.invitations.utils import accept_site_invitation
+from nti.app.invitations.utils import LazyInvitations
+from nti.app.invitations.utils import sort_invitation_ids
+from nti.app.invitations.utils import get_site_invitation_ids
+from nti.app.invitations.utils import get_site_invitation_for_email
+from nti.app.invitations.utils import get_site_invitations_for_emails
+from nti.app.invitations.utils import get_pending_site_invitation_for_email
+from nti.app.invitations.utils import InvitationSigner
+from nti.app.invitations.utils import get_signed_invitation_code
+from nti.app.invitations.utils import request_is_admin_or_site_admin
 
 from nti.app.testing.application_webtest import ApplicationLayerTest
 
@@ -42,6 +84,11 @@ from nti.dataserver.authorization import is_site_admin
 
 from nti.dataserver.tests import mock_dataserver
 
+from nti.dataserver.users.users import User
+
+from nti.invitations.index import get_invitations_catalog
+
+from nti.invitations.interfaces import IInvitation
 from nti.invitations.interfaces import IDisabledInvitation
 from nti.invitations.interfaces import InvitationEmailNotMatchingError
 from nti.invitations.interfaces import IInvitationsContainer
@@ -54,6 +101,12 @@ from nti.invitations.utils import get_pending_invitations
 from nti.invitations.utils import get_sent_invitations
 
 
+class _LowerNormalizer(object):
+
+    def value(self, value):
+        return value.lower()
+
+
 class TesInvitations(ApplicationLayerTest):
 
     @WithSharedApplicationMockDS
@@ -396,3 +449,311 @@ class TesInvitations(ApplicationLayerTest):
             assert_that(invitation.acceptedTime, not_none())
             assert_that(IUserProfile(receiver).email_verified, is_(True))
 
+    @WithSharedApplicationMockDS
+    def test_get_site_invitations_for_emails(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            invitations = component.getUtility(IInvitationsContainer)
+            for code, receiver, site in ((u'Sunnyvale1', u'ricky@tpb.net', u'dataserver2'),
+                                         (u'Sunnyvale2', u'Julian@tpb.net', u'dataserver2'),
+                                         (u'Sunnyvale3', u'bubbles@tpb.net', u'exclude_me')):
+                invitations.add(SiteInvitation(code=code,
+                                               receiver=receiver,
+                                               sender=u'lahey',
+                                               target_site=site))
+            # Created in another site
+            invitations.add(SiteInvitation(code=u'Sunnyvale4',
+                                           receiver=u'randy@tpb.net',
+                                           sender=u'lahey',
+                                           site=u'exclude_me',
+                                           target_site=u'dataserver2'))
+
+            result = get_site_invitations_for_emails((u'ricky@tpb.net',
+                                                      u'julian@tpb.net',
+                                                      u'bubbles@tpb.net',
+                                                      u'randy@tpb.net',
+                                                      u'trinity@tpb.net'))
+            assert_that(result, has_length(3))
+            assert_that(result[u'ricky@tpb.net'].code, is_(u'Sunnyvale1'))
+            assert_that(result[u'julian@tpb.net'].code, is_(u'Sunnyvale2'))
+            assert_that(result[u'randy@tpb.net'].code, is_(u'Sunnyvale4'))
+            assert_that(get_site_invitations_for_emails(()), has_length(0))
+
+    @WithSharedApplicationMockDS
+    def test_get_site_invitation_for_email(self):
+        now = time.time()
+        with mock_dataserver.mock_db_trans(self.ds):
+            invitations = component.getUtility(IInvitationsContainer)
+            for code, receiver, accepted, site in ((u'Sunnyvale1', u'ricky@tpb.net', None, u'exclude_me'),
+                                                   (u'Sunnyvale2', u'ricky@tpb.net', None, u'dataserver2'),
+                                                   (u'Sunnyvale3', u'julian@tpb.net', now, u'dataserver2'),
+                                                   (u'Sunnyvale4', u'bubbles@tpb.net', None, u'exclude_me')):
+                invitations.add(SiteInvitation(code=code,
+                                               receiver=receiver,
+                                               sender=u'lahey',
+                                               acceptedTime=accepted,
+                                               site=site,
+                                               target_site=site))
+            # Created in another site, to join this one
+            invitations.add(SiteInvitation(code=u'Sunnyvale5',
+                                           receiver=u'randy@tpb.net',
+                                           sender=u'lahey',
+                                           site=u'exclude_me',
+                                           target_site=u'dataserver2'))
+
+            invitation = get_pending_site_invitation_for_email(u'Ricky@tpb.net')
+            assert_that(invitation.code, is_(u'Sunnyvale2'))
+            assert_that(get_pending_site_invitation_for_email(u'julian@tpb.net'),
+                        is_(none()))
+            assert_that(get_site_invitation_for_email(u'julian@tpb.net').code,
+                        is_(u'Sunnyvale3'))
+            assert_that(get_site_invitation_for_email(u'bubbles@tpb.net'),
+                        is_(none()))
+            assert_that(get_pending_site_invitation_for_email(u'randy@tpb.net').code,
+                        is_(u'Sunnyvale5'))
+            assert_that(get_site_invitation_for_email(None), is_(none()))
+
+    @WithSharedApplicationMockDS
+    def test_get_site_invitation_ids(self):
+        now = time.time()
+        with mock_dataserver.mock_db_trans(self.ds):
+            invitations = component.getUtility(IInvitationsContainer)
+            for code, accepted, expiry, site in ((u'Sunnyvale1', None, 0, u'dataserver2'),
+                                                 (u'Sunnyvale2', now, 0, u'dataserver2'),
+                                                 (u'Sunnyvale3', None, now - 60, u'dataserver2'),
+                                                 (u'Sunnyvale4', None, now + 60, u'dataserver2'),
+                                                 (u'Sunnyvale5', None, 0, u'exclude_me')):
+                invitations.add(SiteInvitation(code=code,
+                                               receiver=code.lower() + u'@tpb.net',
+                                               sender=u'lahey',
+                                               acceptedTime=accepted,
+                                               expiryTime=expiry,
+                                               site=site))
+
+            catalog = get_invitations_catalog()
+            assert_that(catalog, has_key(IX_CREATEDTIME))
+            intids = component.getUtility(IIntIds)
+
+            def _codes(doc_ids):
+                return [intids.getObject(x).code for x in doc_ids]
+
+            doc_ids = get_site_invitation_ids(sites=u'dataserver2',
+                                              mimeTypes=SITE_INVITATION_MIMETYPE)
+            assert_that(doc_ids, has_length(4))
+            assert_that(_codes(get_site_invitation_ids(u'dataserver2', type_filter='pending')),
+                        contains_inanyorder(u'Sunnyvale1', u'Sunnyvale4'))
+            assert_that(_codes(get_site_invitation_ids(u'dataserver2', type_filter='accepted')),
+                        contains_inanyorder(u'Sunnyvale2'))
+            assert_that(_codes(get_site_invitation_ids(u'dataserver2', type_filter='expired')),
+                        contains_inanyorder(u'Sunnyvale3'))
+
+            sorted_ids = sort_invitation_ids(doc_ids, IX_CREATEDTIME, reverse=True, limit=2)
+            assert_that(_codes(sorted_ids), contains(u'Sunnyvale4', u'Sunnyvale3'))
+            assert_that(sort_invitation_ids(doc_ids, u'does_not_exist'), is_(none()))
+
+            lazy = LazyInvitations(sorted_ids, len(doc_ids))
+            assert_that(lazy, has_length(4))
+            assert_that([x.code for x in lazy[:1]], contains(u'Sunnyvale4'))
+
+    def test_sort_invitation_ids_by_values(self):
+        # An index that cannot sort, only map doc ids to values
+
+        class _ValueIndex(object):
+            documents_to_values = {1: u'c', 2: u'a', 3: u'b', 4: u'a'}
+        catalog = {u'receiver': _ValueIndex()}
+        doc_ids = (1, 2, 3, 4, 5)
+
+        def _sort(**kwargs):
+            return sort_invitation_ids(doc_ids, u'receiver', catalog=catalog,
+                                       **kwargs)
+        assert_that(_sort(), contains(2, 4, 3, 1, 5))
+        assert_that(_sort(limit=2), contains(2, 4))
+        assert_that(_sort(reverse=True), contains(1, 3, 2, 4, 5))
+        assert_that(_sort(reverse=True, limit=3), contains(1, 3, 2))
+        assert_that(_sort(limit=5), contains(2, 4, 3, 1, 5))
+        assert_that(_sort(limit=0), has_length(0))
+
+    @WithSharedApplicationMockDS
+    def test_search_invitation_ids(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            user = self._create_user(u'ricky_user',
+                                     external_value={'email': u'ricky@tpb.net',
+                                                     'realname': u'Ricky LaFleur'})
+            invitations = component.getUtility(IInvitationsContainer)
+            accepted = SiteInvitation(code=u'Sunnyvale1',
+                                      receiver=u'ricky_user',
+                                      original_receiver=u'ricky@tpb.net',
+                                      sender=u'lahey',
+                                      acceptedTime=time.time())
+            invitations.add(accepted)
+            invitations.add(SiteInvitation(code=u'Sunnyvale2',
+                                           receiver=u'Julian@tpb.net',
+                                           sender=u'lahey'))
+            intids = component.getUtility(IIntIds)
+
+            def _codes(value, prefix=False):
+                return [intids.getObject(x).code
+                        for x in search_invitation_ids(value, prefix=prefix)]
+
+            assert_that(_codes(u'LAFLEUR'), contains(u'Sunnyvale1'))
+            assert_that(_codes(u'ricky@'), contains(u'Sunnyvale1'))
+            assert_that(_codes(u'julian'), contains(u'Sunnyvale2'))
+            assert_that(_codes(u'tpb.net'), contains_inanyorder(u'Sunnyvale1',
+                                                               u'Sunnyvale2'))
+            assert_that(_codes(u'laf', prefix=True), contains(u'Sunnyvale1'))
+            assert_that(_codes(u'fleur', prefix=True), has_length(0))
+
+            # Only changes to the indexed attributes are reflected
+            IFriendlyNamed(user).realname = u'Richard LaFleur'
+            notify(ObjectModifiedEvent(user, Attributes(IUserProfile, 'email')))
+            assert_that(_codes(u'richard'), has_length(0))
+            notify(ObjectModifiedEvent(user, Attributes(IUserProfile, 'realname')))
+            assert_that(_codes(u'richard'), contains(u'Sunnyvale1'))
+            assert_that(_codes(u'ricky l'), has_length(0))
+
+    def test_request_admin_roles(self):
+        calls = []
+
+        def _check(user):
+            calls.append(user)
+            return user == u'ichigo'
+
+        with fudge.patched_context('nti.app.invitations.utils',
+                                   'is_admin_or_site_admin', _check):
+            request = DummyRequest()
+            for _ in range(5):
+                assert_that(request_is_admin_or_site_admin(u'ichigo', request),
+                            is_(True))
+                assert_that(request_is_admin_or_site_admin(u'aizen', request),
+                            is_(False))
+            assert_that(calls, contains(u'ichigo', u'aizen'))
+
+            # A new request resolves the roles again
+            assert_that(request_is_admin_or_site_admin(u'ichigo', DummyRequest()),
+                        is_(True))
+            assert_that(calls, has_length(3))
+
+            assert_that(request_is_admin_or_site_admin(None, request),
+                        is_(False))
+
+    def test_get_signed_invitation_code(self):
+        encoded = []
+
+        class _Signer(object):
+            def encode(self, content):
+                encoded.append(content)
+                return u'%(code)s:%(email)s' % content
+
+        signer = _Signer()
+        invitation = SiteInvitation(code=u'Sunnyvale1',
+                                    receiver=u'ichigo@bleach.org')
+        for _ in range(3):
+            assert_that(get_signed_invitation_code(invitation, signer),
+                        is_(u'Sunnyvale1:ichigo@bleach.org'))
+        assert_that(encoded, has_length(1))
+
+        # Changing the code or receiver signs again
+        invitation.code = u'Sunnyvale2'
+        assert_that(get_signed_invitation_code(invitation, signer),
+                    is_(u'Sunnyvale2:ichigo@bleach.org'))
+        invitation.original_receiver = u'aizen@bleach.org'
+        assert_that(get_signed_invitation_code(invitation, signer),
+                    is_(u'Sunnyvale2:aizen@bleach.org'))
+        assert_that(encoded, has_length(3))
+
+        # Signers with another secret or salt never share signatures
+        old = InvitationSigner(u'PUYIESYbVRYVDQA=', u'soul')
+        new = InvitationSigner(u'PUYIESYbVRYVDQA=', u'society')
+        code = get_signed_invitation_code(invitation, old)
+        assert_that(new.decode(get_signed_invitation_code(invitation, new)),
+                    has_entries('code', u'Sunnyvale2'))
+        assert_that(get_signed_invitation_code(invitation, new), is_not(code))
+
+    @WithSharedApplicationMockDS
+    def test_verify_invitations_catalog(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            invitations = component.getUtility(IInvitationsContainer)
+            for code in (u'Sunnyvale1', u'Sunnyvale2'):
+                invitations.add(SiteInvitation(code=code,
+                                               receiver=code.lower() + u'@tpb.net',
+                                               sender=u'lahey'))
+            catalog = get_invitations_catalog()
+            intids = component.getUtility(IIntIds)
+            doc_values = dict()
+            for invitation in invitations.values():
+                doc_id = intids.getId(invitation)
+                doc_values[doc_id] = compute_index_values(invitation, catalog)
+            assert_that(doc_values[doc_id], has_key(IX_CREATEDTIME))
+
+            def _problems(report):
+                return sum(len(x) for v in report.values() for x in v.values())
+            assert_that(_problems(verify_invitations_catalog(doc_values, catalog)),
+                        is_(0))
+
+            catalog[IX_CREATEDTIME].unindex_doc(doc_id)
+            report = verify_invitations_catalog(doc_values, catalog)
+            assert_that(report[IX_CREATEDTIME]['missing'], contains(doc_id))
+            assert_that(_problems(report), is_(1))
+
+            apply_index_values(doc_id, doc_values[doc_id], catalog=catalog)
+            assert_that(_problems(verify_invitations_catalog(doc_values, catalog)),
+                        is_(0))
+
+            doc_values.pop(doc_id)
+            report = verify_invitations_catalog(doc_values, catalog)
+            assert_that(report[IX_CREATEDTIME]['stale'], contains(doc_id))
+
+    @WithSharedApplicationMockDS
+    def test_verify_normalized_index(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            invitation = SiteInvitation(code=u'Sunnyvale1',
+                                        receiver=u'Ricky@TPB.net',
+                                        sender=u'lahey')
+            component.getUtility(IInvitationsContainer).add(invitation)
+            catalog = get_invitations_catalog()
+            index = NormalizationWrapper('receiver', IInvitation, False,
+                                         ValueIndex(), _LowerNormalizer())
+            locate(index, catalog, 'lowerReceiver')
+            catalog._setitemf('lowerReceiver', index)
+            doc_id = component.getUtility(IIntIds).getId(invitation)
+            catalog.index_doc(doc_id, invitation)
+
+            doc_values = {doc_id: compute_index_values(invitation, catalog)}
+            assert_that(doc_values[doc_id],
+                        has_entries('lowerReceiver', u'Ricky@TPB.net'))
+            report = verify_invitations_catalog(doc_values, catalog)
+            assert_that(report['lowerReceiver'],
+                        has_entries('missing', has_length(0),
+                                    'mismatched', has_length(0)))
+
+            # Recorded without normalizing
+            index.index.index_doc(doc_id, u'Ricky@TPB.net')
+            report = verify_invitations_catalog(doc_values, catalog)
+            assert_that(report['lowerReceiver']['mismatched'], contains(doc_id))
+
+    @WithSharedApplicationMockDS(users=True)
+    def test_reindex_invitations(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            invitations = component.getUtility(IInvitationsContainer)
+            for code in (u'Sunnyvale1', u'Sunnyvale2', u'Sunnyvale3'):
+                invitations.add(SiteInvitation(code=code,
+                                               receiver=code.lower() + u'@tpb.net',
+                                               sender=u'lahey'))
+            count, cursor, _ = reindex_invitations(chunk_size=1, queue=False)
+            assert_that(count, is_(1))
+            assert_that(cursor, is_(u'Sunnyvale1'))
+
+            # The cursor invitation may be gone
+            invitations.remove(invitations.get_invitation_by_code(cursor))
+            count, cursor, _ = reindex_invitations(cursor, chunk_size=1, queue=False)
+            assert_that(cursor, is_(u'Sunnyvale2'))
+            count, cursor, _ = reindex_invitations(cursor, chunk_size=1, queue=False)
+            assert_that(count, is_(1))
+            assert_that(cursor, is_(none()))
+
+            catalog = get_invitations_catalog()
+            intids = component.getUtility(IIntIds)
+            doc_id = intids.getId(User.get_user(self.default_username))
+            catalog.index_doc(doc_id, invitations.get_invitation_by_code(u'Sunnyvale3'))
+            assert_that(unindex_stale_invitations(catalog), is_(1))
+            assert_that(unindex_stale_invitations(catalog), is_(0))
+            assert_that(catalog[IX_CREATEDTIME].documentCount(), is_(2))
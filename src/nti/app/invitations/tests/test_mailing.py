@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods,arguments-differ
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import is_not
+from hamcrest import contains
+from hamcrest import has_entries
+from hamcrest import has_length
+from hamcrest import assert_that
+
+from xml.sax.saxutils import escape
+
+from pyramid.testing import DummyRequest
+
+from pyramid.threadlocal import manager
+
+from zope import component
+
+from nti.app.invitations.invitations import SiteInvitation
+
+from nti.app.invitations.mailing import RECEIVER_NAME_TOKEN
+from nti.app.invitations.mailing import REDEMPTION_LINK_TOKEN
+from nti.app.invitations.mailing import PERSONALIZED_EMAIL_TEMPLATE
+
+from nti.app.invitations.mailing import _body
+from nti.app.invitations.mailing import SharedInvitationEmail
+from nti.app.invitations.mailing import InvitationEmailDispatcher
+
+from nti.app.invitations.jobs import make_job_request
+
+from nti.app.invitations.subscribers import get_invitation_email_args
+from nti.app.invitations.subscribers import get_invitation_email_context
+
+from nti.app.invitations.utils import get_invitation_url
+
+from nti.app.testing.application_webtest import ApplicationLayerTest
+
+from nti.app.testing.decorators import WithSharedApplicationMockDS
+
+from nti.dataserver.tests import mock_dataserver
+
+from nti.dataserver.users.users import User
+
+from nti.invitations.interfaces import IInvitationsContainer
+
+from nti.mailer.interfaces import ITemplatedMailer
+
+
+class _Message(object):
+
+    def __init__(self, html, body):
+        self.html = html
+        self.body = body
+
+
+class _FakeMailer(object):
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sent = []
+        self.rendered = []
+
+    def create_simple_html_text_email(self, template, subject, recipients,
+                                      template_args=None, **unused_kwargs):
+        message = template_args['sender_content']['message']
+        self.rendered.append(message)
+        html = u'<a href="%s">%s</a>' % (escape(template_args['redemption_link'],
+                                               {'"': '&quot;'}),
+                                        escape(template_args['receiver_name']))
+        text = u'%(receiver_name)s %(redemption_link)s' % template_args
+        return _Message(html + message, text + message)
+
+    def queue_simple_html_text_email(self, template, subject, recipients, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise ValueError('Relay unavailable')
+        self.sent.append((template, subject, tuple(recipients), kwargs))
+
+
+class _Dispatcher(InvitationEmailDispatcher):
+
+    def __init__(self, *args, **kwargs):
+        super(_Dispatcher, self).__init__(*args, **kwargs)
+        self.sleeps = []
+        self.spawned = []
+
+    def _spawn(self, func, *args):
+        self.spawned.append(args)
+
+    def _sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+    def _run(self, func, unused_site_name):
+        # Within the current test transaction
+        return func()
+
+
+class TestMailing(ApplicationLayerTest):
+
+    def _register_mailer(self, mailer):
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(mailer, ITemplatedMailer)
+        self.addCleanup(gsm.unregisterUtility, mailer, ITemplatedMailer)
+
+    @WithSharedApplicationMockDS(users=True)
+    def test_dispatch(self):
+        mailer = _FakeMailer(failures=1)
+        self._register_mailer(mailer)
+        codes = [u'bleach%s' % i for i in range(5)]
+        with mock_dataserver.mock_db_trans(self.ds):
+            invitations = component.getUtility(IInvitationsContainer)
+            for code in codes:
+                invitations.add(SiteInvitation(code=code,
+                                               receiver=code + u'@bleach.org',
+                                               sender=self.default_username))
+
+            dispatcher = _Dispatcher(batch_size=2, rate=4, retries=2, backoff=0.5)
+            pending = [(u'dataserver2', u'http://localhost', x) for x in codes]
+            assert_that(dispatcher.dispatch(pending), is_(5))
+
+        assert_that([x[2] for x in mailer.sent],
+                    contains(*[(x + u'@bleach.org',) for x in codes]))
+        # One retry of the first batch, then the pacing of the three batches
+        assert_that(dispatcher.sleeps, contains(0.5, 0.5, 0.5, 0.25))
+
+    @WithSharedApplicationMockDS(users=True)
+    def test_dispatch_gives_up(self):
+        mailer = _FakeMailer(failures=10)
+        self._register_mailer(mailer)
+        with mock_dataserver.mock_db_trans(self.ds):
+            invitations = component.getUtility(IInvitationsContainer)
+            invitations.add(SiteInvitation(code=u'hollow1',
+                                           receiver=u'orihime@bleach.org',
+                                           sender=self.default_username))
+            dispatcher = _Dispatcher(rate=0, retries=2, backoff=1)
+            pending = [(u'dataserver2', u'http://localhost', u'hollow1')]
+            assert_that(dispatcher.dispatch(pending), is_(0))
+        assert_that(mailer.sent, has_length(0))
+        assert_that(dispatcher.sleeps, contains(1, 2))
+
+    @WithSharedApplicationMockDS
+    def test_add_dispatches_after_commit(self):
+        dispatcher = _Dispatcher()
+        request = DummyRequest()
+        with mock_dataserver.mock_db_trans(self.ds):
+            for code in (u'espada1', u'espada2'):
+                dispatcher.add(SiteInvitation(code=code), request)
+        assert_that(dispatcher.spawned, has_length(1))
+        pending = dispatcher.spawned[0][0]
+        assert_that([x[2] for x in pending], contains(u'espada1', u'espada2'))
+
+        # Aborted transactions send nothing
+        with self.assertRaises(ValueError):
+            with mock_dataserver.mock_db_trans(self.ds):
+                dispatcher.add(SiteInvitation(code=u'espada3'), request)
+                raise ValueError()
+        assert_that(dispatcher.spawned, has_length(1))
+
+    @WithSharedApplicationMockDS(users=True)
+    def test_dispatch_renders_once(self):
+        mailer = _FakeMailer()
+        self._register_mailer(mailer)
+        with mock_dataserver.mock_db_trans(self.ds):
+            invitations = component.getUtility(IInvitationsContainer)
+            for idx, message in enumerate((u'Bankai', u'Bankai', u'Shikai')):
+                invitations.add(SiteInvitation(code=u'zanpakuto%s' % idx,
+                                               receiver=u'z%s@bleach.org' % idx,
+                                               receiver_name=u'Ichigo & Rukia',
+                                               message=message,
+                                               sender=self.default_username))
+            dispatcher = _Dispatcher(rate=0)
+            pending = [(u'dataserver2', u'http://localhost', u'zanpakuto%s' % i)
+                       for i in range(3)]
+            assert_that(dispatcher.dispatch(pending), is_(3))
+
+        # One rendering per sender and message
+        assert_that(mailer.rendered, contains(u'Bankai', u'Shikai'))
+        assert_that(mailer.sent, has_length(3))
+        template, _, recipients, kwargs = mailer.sent[0]
+        assert_that(template, is_(PERSONALIZED_EMAIL_TEMPLATE))
+        assert_that(recipients, is_((u'z0@bleach.org',)))
+        html = kwargs['template_args']['html']
+        text = kwargs['template_args']['text']
+        assert_that(RECEIVER_NAME_TOKEN in html + text, is_(False))
+        assert_that(REDEMPTION_LINK_TOKEN in html + text, is_(False))
+        assert_that('Ichigo &amp; Rukia' in html, is_(True))
+        assert_that(text.startswith(u'Ichigo & Rukia http://localhost'), is_(True))
+
+        # Rendering each email is still possible
+        mailer.sent[:] = []
+        with mock_dataserver.mock_db_trans(self.ds):
+            dispatcher = _Dispatcher(rate=0, render_once=False)
+            assert_that(dispatcher.dispatch(pending[:1]), is_(1))
+        assert_that(mailer.sent[0][3],
+                    has_entries('template_args', has_entries('receiver_name', u'Ichigo & Rukia')))
+
+    @WithSharedApplicationMockDS(users=True)
+    def test_render_once_matches_templates(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            invitation = SiteInvitation(code=u'zanpakuto',
+                                        receiver=u'z@bleach.org',
+                                        message=u'Bankai <now> & "forever"',
+                                        sender=self.default_username)
+            component.getUtility(IInvitationsContainer).add(invitation)
+            sender = User.get_user(self.default_username)
+            request = make_job_request(u'http://localhost')
+            manager.push({'request': request, 'registry': request.registry})
+            try:
+                context = get_invitation_email_context(request)
+                mailer = context['mailer']
+                shared = SharedInvitationEmail.render(invitation, sender,
+                                                      request, context)
+                assert_that(shared, is_not(none()))
+                link = get_invitation_url(request.application_url, invitation)
+                for name in (u'Ichigo', u'Ichigo & Rukia', u'<Kenpachi>',
+                             u'Rangiku "Ran" O\'Hara'):
+                    args = get_invitation_email_args(invitation, sender, name,
+                                                     invitation.message,
+                                                     request, context)
+                    expected = mailer.create_simple_html_text_email(
+                        context['template'],
+                        subject=context['subject'],
+                        recipients=[invitation.receiver],
+                        template_args=args,
+                        request=request,
+                        package=context['package'],
+                        text_template_extension='.mak')
+                    html, text = shared.personalize(name, link)
+                    actual = mailer.create_simple_html_text_email(
+                        PERSONALIZED_EMAIL_TEMPLATE,
+                        subject=context['subject'],
+                        recipients=[invitation.receiver],
+                        template_args={'html': html, 'text': text},
+                        request=request,
+                        text_template_extension='.mak')
+                    assert_that(_body(actual.html).encode('utf-8'),
+                                is_(_body(expected.html).encode('utf-8')))
+                    assert_that(_body(actual.body).encode('utf-8'),
+                                is_(_body(expected.body).encode('utf-8')))
+            finally:
+                manager.pop()
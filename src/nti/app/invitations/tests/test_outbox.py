@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods,arguments-differ
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import is_not
+from hamcrest import contains
+from hamcrest import has_length
+from hamcrest import assert_that
+
+import time
+
+from pyramid.testing import DummyRequest
+
+from zope import component
+
+from zope.event import notify
+
+from nti.app.invitations.interfaces import IInvitationEmailOutbox
+
+from nti.app.invitations.invitations import SiteInvitation
+
+from nti.app.invitations.outbox import FAILED
+from nti.app.invitations.outbox import get_invitation_email_key
+
+from nti.app.invitations.outbox import InvitationEmailOutboxDrainer
+
+from nti.app.testing.application_webtest import ApplicationLayerTest
+
+from nti.app.testing.decorators import WithSharedApplicationMockDS
+
+from nti.appserver.interfaces import IApplicationSettings
+
+from nti.dataserver.tests import mock_dataserver
+
+from nti.invitations.interfaces import InvitationSentEvent
+from nti.invitations.interfaces import IInvitationsContainer
+
+from nti.mailer.interfaces import ITemplatedMailer
+
+
+class _FakeMailer(object):
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.sent = []
+
+    def queue_simple_html_text_email(self, template, subject, recipients, **kwargs):
+        if self.fail:
+            raise ValueError('Relay unavailable')
+        self.sent.append(tuple(recipients))
+
+
+class _Drainer(InvitationEmailOutboxDrainer):
+
+    def _run(self, func, unused_site_name=None):
+        # Within the current test transaction
+        return func()
+
+
+class TestOutbox(ApplicationLayerTest):
+
+    def _register_mailer(self, mailer):
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(mailer, ITemplatedMailer)
+        self.addCleanup(gsm.unregisterUtility, mailer, ITemplatedMailer)
+
+    def _add_invitations(self, *codes):
+        invitations = component.getUtility(IInvitationsContainer)
+        for code in codes:
+            invitations.add(SiteInvitation(code=code,
+                                           receiver=code + u'@bleach.org',
+                                           sender=self.default_username))
+        return [invitations.get_invitation_by_code(x) for x in codes]
+
+    @WithSharedApplicationMockDS(users=True)
+    def test_sent_invitations_are_written(self):
+        mailer = _FakeMailer()
+        self._register_mailer(mailer)
+        settings = component.getUtility(IApplicationSettings)
+        settings['invitations_email_outbox'] = 'true'
+        self.addCleanup(settings.pop, 'invitations_email_outbox', None)
+
+        with self.assertRaises(ValueError):
+            with mock_dataserver.mock_db_trans(self.ds):
+                invitation, = self._add_invitations(u'aizen')
+                event = InvitationSentEvent(invitation, invitation.receiver)
+                event.request = DummyRequest()
+                notify(event)
+                assert_that(component.getUtility(IInvitationEmailOutbox),
+                            has_length(1))
+                raise ValueError()
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            outbox = component.getUtility(IInvitationEmailOutbox)
+            # Nothing was left behind by the aborted transaction
+            assert_that(outbox, has_length(0))
+            invitation, = self._add_invitations(u'gin')
+            event = InvitationSentEvent(invitation, invitation.receiver)
+            event.request = DummyRequest()
+            notify(event)
+            notify(event)
+            assert_that(outbox, has_length(1))
+            assert_that(mailer.sent, has_length(0))
+
+            assert_that(_Drainer().drain(), is_(1))
+            assert_that(outbox, has_length(0))
+            assert_that(mailer.sent, contains((u'gin@bleach.org',)))
+
+            # Delivered emails are not written again
+            notify(event)
+            assert_that(outbox, has_length(0))
+
+    @WithSharedApplicationMockDS(users=True)
+    def test_drain(self):
+        mailer = _FakeMailer(fail=True)
+        self._register_mailer(mailer)
+        with mock_dataserver.mock_db_trans(self.ds):
+            tosen, komamura = self._add_invitations(u'tosen', u'komamura')
+            outbox = component.getUtility(IInvitationEmailOutbox)
+            invitations = component.getUtility(IInvitationsContainer)
+            keys = [outbox.add_email(x, u'dataserver2', u'http://localhost').key
+                    for x in (tosen, komamura)]
+            assert_that(outbox.add_email(tosen, u'dataserver2', u'http://localhost'),
+                        is_(none()))
+
+            drainer = _Drainer(batch_size=1, max_attempts=2, backoff=0)
+            assert_that(drainer.due_batches(), has_length(2))
+            assert_that(drainer.drain(), is_(0))
+            assert_that(outbox[keys[0]].attempts, is_(1))
+            assert_that(outbox[keys[0]].error, is_not(none()))
+
+            mailer.fail = False
+            # Removed invitations are dropped
+            invitations.remove(komamura)
+            assert_that(drainer.drain(), is_(1))
+            assert_that(mailer.sent, contains((u'tosen@bleach.org',)))
+            assert_that(outbox, has_length(0))
+            assert_that(outbox.is_delivered(keys[0]), is_(True))
+
+            kaname, = self._add_invitations(u'kaname')
+            entry = outbox.add_email(kaname, u'dataserver2', u'http://localhost')
+            mailer.fail = True
+            drainer.drain()
+            drainer.drain()
+            assert_that(entry.state, is_(FAILED))
+            assert_that(drainer.due_batches(), has_length(0))
+            # Moved out of the outbox
+            assert_that(outbox, has_length(0))
+            assert_that(outbox.get_failed(entry.key), is_(entry))
+            assert_that(outbox.add_email(kaname, u'dataserver2', u'http://localhost'),
+                        is_(none()))
+
+    @WithSharedApplicationMockDS(users=True)
+    def test_failed_and_waiting_entries_are_skipped(self):
+        mailer = _FakeMailer(fail=True)
+        self._register_mailer(mailer)
+        with mock_dataserver.mock_db_trans(self.ds):
+            outbox = component.getUtility(IInvitationEmailOutbox)
+            failed = self._add_invitations(*[u'hollow%s' % i for i in range(10)])
+            waiting = self._add_invitations(*[u'arrancar%s' % i for i in range(10)])
+            for invitation in failed + waiting:
+                outbox.add_email(invitation, u'dataserver2', u'http://localhost')
+            _Drainer(max_attempts=1).deliver([get_invitation_email_key(x)
+                                              for x in failed],
+                                             u'http://localhost')
+            _Drainer(max_attempts=2, backoff=3600).drain()
+            assert_that(outbox, has_length(10))
+            assert_that(list(outbox.iter_due()), has_length(0))
+
+            # Neither failed nor waiting entries hold back due ones
+            mailer.fail = False
+            ichigo, = self._add_invitations(u'ichigo')
+            outbox.add_email(ichigo, u'dataserver2', u'http://localhost')
+            assert_that([x.code for x in outbox.iter_due()], contains(u'ichigo'))
+            assert_that(_Drainer().drain(), is_(1))
+            assert_that(mailer.sent, contains((u'ichigo@bleach.org',)))
+
+            # Failed entries are dropped after a while
+            now = time.time() + outbox.failed_ttl + 1
+            assert_that(outbox.prune_failed(now), is_(10))
+            key = get_invitation_email_key(failed[0])
+            assert_that(outbox.get_failed(key), is_(none()))
@@ -7,6 +7,7 @@ from __future__ import absolute_import
 
 # pylint: disable=protected-access,too-many-public-methods,arguments-differ
 
+from hamcrest import is_
 from hamcrest import is_not
 from hamcrest import has_length
 from hamcrest import assert_that
@@ -54,3 +55,20 @@ class TestPredicates(ApplicationLayerTest):
         predicate = UserInvitationsObjects(self.default_username)
         assert_that(list(predicate.iter_objects()),
                     has_length(greater_than(0)))
+
+    @mock_dataserver.WithMockDSTrans
+    def test_user_only_loads_sent_invitations(self):
+        self._create_user(self.default_username)
+        self._create_user(u'aizen')
+
+        invitations = component.getUtility(IInvitationsContainer)
+        for receiver, sender in ((u"ichigo@bleach.org", self.default_username),
+                                 (u"rukia@bleach.org", self.default_username),
+                                 (u"gin@bleach.org", u'aizen')):
+            invitations.add(Invitation(receiver=receiver, sender=sender))
+
+        predicate = UserInvitationsObjects(self.default_username)
+        assert_that(sorted(x.receiver for x in predicate.iter_objects()),
+                    is_([u"ichigo@bleach.org", u"rukia@bleach.org"]))
+        predicate = UserInvitationsObjects(u'aizen')
+        assert_that(list(predicate.iter_objects()), has_length(1))
@@ -13,10 +13,12 @@ import fudge
 
 from hamcrest import is_
 from hamcrest import not_
+from hamcrest import none
 from hamcrest import not_none
 from hamcrest import contains
 from hamcrest import has_length
 from hamcrest import has_entries
+from hamcrest import ends_with
 from hamcrest import starts_with
 from hamcrest import assert_that
 from hamcrest import contains_inanyorder
@@ -42,12 +44,21 @@ from nti.app.invitations import SITE_ADMIN_INVITATION_MIMETYPE
 
 from nti.app.invitations.interfaces import IInvitationSigner
 from nti.app.invitations.interfaces import ISiteAdminInvitation
+from nti.app.invitations.interfaces import ISiteInvitationJobRunner
+
+from nti.app.invitations.jobs import FINISHED_JOB_TTL
+from nti.app.invitations.jobs import STALE_JOB_TIMEOUT
+
+from nti.app.invitations.jobs import get_site_invitation_job
 
 from nti.app.invitations.invitations import JoinEntityInvitation
 from nti.app.invitations.invitations import SiteAdminInvitation
 from nti.app.invitations.invitations import SiteInvitation
 
 from nti.app.invitations.utils import get_invitation_url
+from nti.app.invitations.utils import get_users_by_emails_in_sites
+
+from nti.app.invitations.views import SendSiteInvitationCodeView
 
 from nti.app.testing.application_webtest import ApplicationLayerTest
 
@@ -68,6 +79,7 @@ from nti.invitations.interfaces import IInvitationsContainer
 from nti.ntiids.oids import to_external_ntiid_oid
 
 ITEMS = StandardExternalFields.ITEMS
+TOTAL = StandardExternalFields.TOTAL
 
 logger = __import__('logging').getLogger(__name__)
 
@@ -742,10 +754,49 @@ class TestSiteInvitationViews(ApplicationLayerTest):
         
         invite_codes = _get_codes('expired')
         assert_that(invite_codes, contains_inanyorder('Sunnyvale6'))
-        
+
+        # Counts by status and mimetype
+        counts_url = '%s/@@site-invitation-counts' % invitations_url
+        res = self.testapp.get(counts_url).json_body
+        assert_that(res, has_entries('Site', 'dataserver2',
+                                     'Total', 5,
+                                     'Pending', 2,
+                                     'Accepted', 2,
+                                     'Expired', 1))
+        assert_that(res['MimeTypes'],
+                    has_entries(SITE_INVITATION_MIMETYPE,
+                                has_entries('Total', 5,
+                                            'Pending', 2,
+                                            'Accepted', 2,
+                                            'Expired', 1),
+                                SITE_ADMIN_INVITATION_MIMETYPE,
+                                has_entries('Total', 0)))
+        res = self.testapp.get(counts_url, {'site': 'exclude_me'}).json_body
+        assert_that(res, has_entries('Total', 3,
+                                     'Pending', 1,
+                                     'Accepted', 1,
+                                     'Expired', 1))
+
+        # Sorted batches come from the catalog
+        params = {'sortOn': 'receiver', 'batchSize': 2, 'batchStart': 1}
+        res = self.testapp.get(invitations_url, params=params).json_body
+        assert_that([x['code'] for x in res[ITEMS]],
+                    contains('Sunnyvale6', 'Sunnyvale8'))
+        assert_that(res, has_entries(TOTAL, 5,
+                                     'FilteredTotalItemCount', 5))
+
+        params = {'sortOn': 'created_time', 'sortOrder': 'descending',
+                  'type_filter': 'pending', 'batchSize': 1, 'batchStart': 0}
+        res = self.testapp.get(invitations_url, params=params).json_body
+        assert_that([x['code'] for x in res[ITEMS]], contains('Sunnyvale8'))
+        assert_that(res, has_entries(TOTAL, 2,
+                                     'FilteredTotalItemCount', 2))
+
         headers = {'accept': str('text/csv')}
         inv_url = '%s?type_filter=%s&sortOn=receiver' % (invitations_url, 'accepted')
-        csv_res = self.testapp.get(inv_url, headers=headers).body
+        csv_res = self.testapp.get(inv_url, headers=headers)
+        assert_that(csv_res.content_length, is_(len(csv_res.body)))
+        csv_res = csv_res.body
         csv_reader = csv.DictReader(StringIO(csv_res))
         csv_reader = tuple(csv_reader)
         assert_that(csv_reader, has_length(2))
@@ -982,6 +1033,151 @@ class TestSiteInvitationViews(ApplicationLayerTest):
         body = res.json_body
         assert_that(body['Items'], has_length(3))
 
+    @WithSharedApplicationMockDS(testapp=True, users=True)
+    def test_send_site_invitations_in_batches(self):
+        site_invitation_url = '/dataserver2/Invitations/@@send-site-invitation'
+        receivers = [{'receiver': 'batch%s@test.com' % i,
+                      'receiver_name': 'Batch %s' % i} for i in range(5)]
+        # Duplicate receivers (ignoring case and whitespace) are collapsed
+        # before anything is stored or mailed
+        receivers.append({'receiver': ' Batch0@Test.com ',
+                          'receiver_name': 'Batch 0 Again'})
+        data = {'invitations': receivers,
+                'message': 'Batched Test Case'}
+        with fudge.patched_context(SendSiteInvitationCodeView,
+                                   '_BULK_SEND_BATCH_SIZE', 2):
+            res = self.testapp.post_json(site_invitation_url,
+                                         data,
+                                         status=200)
+        body = res.json_body
+        assert_that(body['Items'], has_length(5))
+        assert_that(body['Merged'], has_length(1))
+        assert_that(body['Merged'][0],
+                    has_entries('receiver', ' Batch0@Test.com ',
+                                'receiver_name', 'Batch 0 Again'))
+        code = body['Items'][0]['code']
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            assert_that(self.invitations, has_length(5))
+
+        mailer = component.getUtility(ITestMailDelivery)
+        assert_that(mailer.queue, has_length(5))
+
+        # A later resend of the same receiver reuses the pending code
+        data = {'invitations': [{'receiver': 'BATCH0@test.com',
+                                 'receiver_name': 'Batch 0'}]}
+        res = self.testapp.post_json(site_invitation_url,
+                                     data,
+                                     status=200)
+        body = res.json_body
+        assert_that(body['Items'][0], has_entries('code', code,
+                                                  'receiver', 'batch0@test.com'))
+        assert_that(body['Merged'], has_length(0))
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            assert_that(self.invitations, has_length(5))
+
+    @WithSharedApplicationMockDS(testapp=True, users=True)
+    def test_send_site_invitations_async(self):
+        site_invitation_url = '/dataserver2/Invitations/@@send-site-invitation'
+        data = {'invitations': [{'receiver': 'async%s@test.com' % i,
+                                 'receiver_name': 'Async %s' % i} for i in range(3)],
+                'message': 'Async Test Case',
+                'async': True}
+        with fudge.patched_context(SendSiteInvitationCodeView,
+                                   '_BULK_SEND_BATCH_SIZE', 2):
+            res = self.testapp.post_json(site_invitation_url,
+                                         data,
+                                         status=202)
+        body = res.json_body
+        assert_that(body, has_entries('State', 'Pending',
+                                      'Total', 3,
+                                      'Processed', 0,
+                                      'Sent', 0))
+        status_href = self.require_link_href_with_rel(body, 'status')
+        assert_that(res.location, ends_with(status_href))
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            assert_that(self.invitations, has_length(0))
+
+        runner = component.getUtility(ISiteInvitationJobRunner)
+        runner.run_pending()
+
+        body = self.testapp.get(status_href).json_body
+        assert_that(body, has_entries('State', 'Success',
+                                      'Total', 3,
+                                      'Processed', 3,
+                                      'Sent', 3,
+                                      'FailureCount', 0))
+        with mock_dataserver.mock_db_trans(self.ds):
+            assert_that(self.invitations, has_length(3))
+
+        mailer = component.getUtility(ITestMailDelivery)
+        assert_that(mailer.queue, has_length(3))
+
+        # Role changes are reported as row failures
+        data['mimeType'] = SITE_ADMIN_INVITATION_MIMETYPE
+        res = self.testapp.post_json(site_invitation_url,
+                                     data,
+                                     status=202)
+        runner.run_pending()
+        status_href = self.require_link_href_with_rel(res.json_body, 'status')
+        body = self.testapp.get(status_href).json_body
+        assert_that(body, has_entries('State', 'Success',
+                                      'Processed', 3,
+                                      'Sent', 0,
+                                      'FailureCount', 3))
+        assert_that(body['Failures'][0],
+                    has_entries('code', 'UpdatePendingInvitations'))
+
+        # The processed rows are not kept
+        with mock_dataserver.mock_db_trans(self.ds):
+            job = get_site_invitation_job(body['ID'])
+            assert_that(list(job.iter_chunks()), has_length(0))
+
+    @WithSharedApplicationMockDS(testapp=True, users=True)
+    def test_resume_site_invitation_jobs(self):
+        site_invitation_url = '/dataserver2/Invitations/@@send-site-invitation'
+        data = {'invitations': [{'receiver': 'stale%s@test.com' % i,
+                                 'receiver_name': 'Stale %s' % i} for i in range(3)],
+                'async': True}
+        res = self.testapp.post_json(site_invitation_url,
+                                     data,
+                                     status=202)
+        job_id = res.json_body['ID']
+        site_name = res.json_body['Site']
+        status_href = self.require_link_href_with_rel(res.json_body, 'status')
+
+        # The process running the job goes away
+        runner = component.getUtility(ISiteInvitationJobRunner)
+        del runner.pending[:]
+
+        # Recent jobs are left alone
+        assert_that(runner.resume_stale_jobs(), has_length(0))
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            job = get_site_invitation_job(job_id)
+            job.updateLastMod(job.lastModified - STALE_JOB_TIMEOUT - 1)
+
+        assert_that(runner.resume_stale_jobs(), contains((job_id, site_name)))
+        # Claimed, so not resumed twice
+        assert_that(runner.resume_stale_jobs(), has_length(0))
+        runner.run_pending()
+
+        body = self.testapp.get(status_href).json_body
+        assert_that(body, has_entries('State', 'Success',
+                                      'Processed', 3,
+                                      'Sent', 3))
+
+        # Finished jobs expire
+        with mock_dataserver.mock_db_trans(self.ds):
+            job = get_site_invitation_job(job_id)
+            job.updateLastMod(job.lastModified - FINISHED_JOB_TTL - 1)
+
+        runner.resume_stale_jobs()
+        with mock_dataserver.mock_db_trans(self.ds):
+            assert_that(get_site_invitation_job(job_id), is_(none()))
+
     @WithSharedApplicationMockDS(testapp=True, users=True)
     def test_delete_invitations(self):
         emails = []
@@ -1084,6 +1280,71 @@ class TestSiteInvitationViews(ApplicationLayerTest):
         body = res.json_body
         assert_that(body['Items'], has_length(1))
 
+    @WithSharedApplicationMockDS(testapp=True, users=True)
+    def test_bulk_send_to_existing_emails(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            self._create_user(u'lahey', external_value={'email': u'lahey@tpb.net'})
+            self._create_user(u'randy', external_value={'email': u'randy@tpb.net'})
+        site_invitation_url = '/dataserver2/Invitations/@@send-site-invitation'
+        data = {
+            'invitations':
+                [
+                    {'receiver': 'lahey@tpb.net',
+                     'receiver_name': 'Lahey'},
+                    {'receiver': 'Randy@tpb.net',
+                     'receiver_name': 'Randy'},
+                    {'receiver': 'ricky@tpb.net',
+                     'receiver_name': 'Ricky'},
+                ],
+        }
+        # Existing accounts are silently skipped for bulk sends
+        res = self.testapp.post_json(site_invitation_url,
+                                     data,
+                                     status=200)
+        body = res.json_body
+        assert_that(body['Items'], has_length(1))
+        assert_that(body['Items'][0]['receiver'], is_('ricky@tpb.net'))
+        assert_that(body['Merged'], has_length(0))
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            users = get_users_by_emails_in_sites(('LAHEY@tpb.net',
+                                                  'randy@tpb.net',
+                                                  'ricky@tpb.net'))
+            assert_that(users, has_length(2))
+            assert_that(users['lahey@tpb.net'][0].username, is_('lahey'))
+
+    @WithSharedApplicationMockDS(testapp=True, users=True)
+    def test_send_site_csv_invitations_in_batches(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            self._create_user(u'lahey', external_value={'email': u'lahey@tpb.net'})
+        site_csv_invitation_url = '/dataserver2/Invitations/@@send-site-invitation'
+        data = [[u'csv%s@tpb.net' % i, u'Csv %s' % i] for i in range(5)]
+        data.insert(2, [u'lahey@tpb.net', u'Lahey'])
+        self._make_fake_csv(data)
+        with fudge.patched_context(SendSiteInvitationCodeView,
+                                   '_BULK_SEND_BATCH_SIZE', 2):
+            res = self.testapp.post(site_csv_invitation_url,
+                                    {'message': 'Test csv batches'},
+                                    upload_files=[('csv', 'test.csv'), ],
+                                    status=200)
+        body = res.json_body
+        assert_that(body['Items'], has_length(5))
+        receivers = [x['receiver'] for x in body['Items']]
+        assert_that(receivers, is_([u'csv%s@tpb.net' % i for i in range(5)]))
+
+        # An invalid row anywhere fails the upload before anything is sent
+        data.append([u'bademail', u'Bad Email'])
+        self._make_fake_csv(data)
+        with fudge.patched_context(SendSiteInvitationCodeView,
+                                   '_BULK_SEND_BATCH_SIZE', 2):
+            res = self.testapp.post(site_csv_invitation_url,
+                                    {'message': 'Test csv batches'},
+                                    upload_files=[('csv', 'test.csv'), ],
+                                    status=417)
+        assert_that(res.json_body['InvalidEmails'], is_([u'bademail']))
+        with mock_dataserver.mock_db_trans(self.ds):
+            assert_that(self.invitations, has_length(5))
+
     @WithSharedApplicationMockDS(testapp=True, users=True)
     def test_existing_user_accept(self):
         with mock_dataserver.mock_db_trans(self.ds):
@@ -9,6 +9,7 @@ from __future__ import absolute_import
 import unittest
 
 from hamcrest import is_not, is_
+from hamcrest import contains
 from hamcrest import has_length
 from hamcrest import assert_that
 from hamcrest import not_none
@@ -19,16 +20,28 @@ import fudge
 from pyramid import httpexceptions as hexc
 
 from zope import component
+from zope import interface
 
 from zope.component import getGlobalSiteManager
 
 from zope.event import notify
 
+from zope.interface.registry import Components
+
+from zope.lifecycleevent.interfaces import IObjectRemovedEvent
+
 from nti.app.invitations import SITE_INVITATION_SESSION_KEY
 
+from nti.app.invitations.caches import get_site_components_cache
+
+from nti.app.invitations.index import get_entity_invitation_ids
+
 from nti.app.invitations.invitations import SiteInvitation
+from nti.app.invitations.invitations import JoinEntityInvitation
 
 from nti.app.invitations.subscribers import _get_invitations_bcc
+from nti.app.invitations.subscribers import reload_invitations_bcc
+from nti.app.invitations.subscribers import get_invitation_email_context
 from nti.app.invitations.subscribers import _validate_site_invitation
 from nti.app.invitations.subscribers import require_invite_for_user_creation
 
@@ -42,10 +55,13 @@ from nti.app.invitations.interfaces import InvitationRequiredError
 
 from nti.dataserver.tests import mock_dataserver
 
+from nti.dataserver.users.friends_lists import DynamicFriendsList
+
 from nti.dataserver.users.interfaces import WillCreateNewEntityEvent
 
 from nti.dataserver.users.users import User
 
+from nti.invitations.interfaces import IInvitation
 from nti.invitations.interfaces import IInvitationsContainer
 
 from nti.invitations.model import Invitation
@@ -88,6 +104,153 @@ class TestSubscribers(ApplicationLayerTest):
             container = component.getUtility(IInvitationsContainer)
             assert_that(container, has_length(0))
 
+    @WithSharedApplicationMockDS
+    def test_user_deletion_event_email(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            self._create_user(u"aizen", external_value={'email': u"aizen@nti.com"})
+            container = component.getUtility(IInvitationsContainer)
+            container.add(Invitation(code=u'bleach',
+                                     receiver=u'ichigo',
+                                     sender=u'aizen',
+                                     acceptedTime=None))
+            container.add(Invitation(code=u'hollow',
+                                     receiver=u'orihime',
+                                     sender=u'aizen@nti.com',
+                                     acceptedTime=None))
+            container.add(Invitation(code=u'arrancar',
+                                     receiver=u'ulquiorra',
+                                     sender=u'aizen@nti.com',
+                                     acceptedTime=1.0))
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            assert_that(get_pending_invitations(), has_length(2))
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            User.delete_entity(u"aizen")
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            # The unaccepted invitations, sent by username or email
+            container = component.getUtility(IInvitationsContainer)
+            assert_that(list(container), contains(u'arrancar'))
+            assert_that(get_pending_invitations(), has_length(0))
+
+    @WithSharedApplicationMockDS
+    def test_users_deletion_event(self):
+        removed = []
+
+        @component.adapter(IInvitation, IObjectRemovedEvent)
+        def _removed(invitation, unused_event):
+            removed.append(invitation.code)
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            container = component.getUtility(IInvitationsContainer)
+            for username in (u'aizen', u'gin', u'tosen'):
+                self._create_user(username)
+                container.add(Invitation(code=username,
+                                         receiver=u'ichigo',
+                                         sender=username,
+                                         acceptedTime=None))
+
+        gsm = getGlobalSiteManager()
+        gsm.registerHandler(_removed)
+        try:
+            with mock_dataserver.mock_db_trans(self.ds):
+                User.delete_entity(u"aizen")
+                # Removed right away, with the removal events
+                container = component.getUtility(IInvitationsContainer)
+                assert_that(container, has_length(2))
+                assert_that(get_sent_invitations(u'aizen'), has_length(0))
+                User.delete_entity(u"gin")
+                assert_that(removed, contains(u'aizen', u'gin'))
+        finally:
+            gsm.unregisterHandler(_removed)
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            container = component.getUtility(IInvitationsContainer)
+            assert_that(list(container), contains(u'tosen'))
+            assert_that(get_sent_invitations(u'gin'), has_length(0))
+            assert_that(get_pending_invitations(), has_length(1))
+
+    @WithSharedApplicationMockDS
+    def test_invitation_email_context_cache(self):
+        calls = []
+
+        def _brand():
+            calls.append(1)
+            return u'Bleach'
+
+        get_site_components_cache().clear()
+        with mock_dataserver.mock_db_trans(self.ds):
+            with fudge.patched_context('nti.app.invitations.subscribers',
+                                       'get_site_brand_name', _brand):
+                context = get_invitation_email_context()
+                assert_that(context['brand'], is_(u'Bleach'))
+                get_invitation_email_context()
+                assert_that(calls, has_length(1))
+
+                # Changing the components drops the cache
+                gsm = getGlobalSiteManager()
+                marker = object()
+                gsm.registerUtility(marker, interface.Interface,
+                                    name=u'invitation-email-context-test')
+                try:
+                    get_invitation_email_context()
+                    assert_that(calls, has_length(2))
+                finally:
+                    gsm.unregisterUtility(marker, interface.Interface,
+                                          name=u'invitation-email-context-test')
+
+                # Changes in other components keep it
+                get_invitation_email_context()
+                calls[:] = []
+                other = Components(u'invitation-email-context-test')
+                other.registerUtility(marker, interface.Interface)
+                get_invitation_email_context()
+                assert_that(calls, has_length(0))
+
+    @WithSharedApplicationMockDS
+    def test_dfl_deletion_event(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            owner = self._create_user(u"aizen")
+            fl1 = DynamicFriendsList(username=u'Espada')
+            fl1.creator = owner
+            owner.addContainedObject(fl1)
+            dfl_ntiid = fl1.NTIID
+            container = component.getUtility(IInvitationsContainer)
+            for code, receiver, accepted in ((u'espada1', u'ulquiorra', None),
+                                             (u'espada2', u'grimmjow', None),
+                                             (u'espada3', u'stark', 1.0)):
+                invitation = JoinEntityInvitation(code=code,
+                                                  receiver=receiver,
+                                                  sender=u'aizen',
+                                                  acceptedTime=accepted)
+                invitation.entity = dfl_ntiid
+                container.add(invitation)
+            container.add(JoinEntityInvitation(code=u'gotei13',
+                                               receiver=u'ichigo',
+                                               sender=u'aizen',
+                                               entity=u'gotei'))
+
+            assert_that(get_entity_invitation_ids((dfl_ntiid,)), has_length(3))
+            assert_that(get_entity_invitation_ids((dfl_ntiid,), pending=True),
+                        has_length(2))
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            owner = User.get_user(u'aizen')
+            fl1 = owner.getContainedObject(fl1.containerId, fl1.id)
+            owner.deleteContainedObject(fl1.containerId, fl1.id)
+
+        with mock_dataserver.mock_db_trans(self.ds):
+            container = component.getUtility(IInvitationsContainer)
+            for code, expected in ((u'espada1', False),
+                                   (u'espada2', False),
+                                   (u'espada3', True),
+                                   (u'gotei13', True)):
+                assert_that(container.get_invitation_by_code(code) is not None,
+                            is_(expected))
+            assert_that(get_entity_invitation_ids((dfl_ntiid,), pending=True),
+                        has_length(0))
+
     @WithSharedApplicationMockDS
     @fudge.patch('nti.app.invitations.subscribers.get_current_request')
     def test_validate_site_invitation(self, mock_request):
@@ -215,3 +378,15 @@ class TestInvitationsBcc(unittest.TestCase):
     def test_invitations_bcc_multi(self, get_app_setting):
         get_app_setting.is_callable().returns("hatter@wl.org, cheshire@wl.org , @xyz123,")
         assert_that(_get_invitations_bcc(), is_(("hatter@wl.org", "cheshire@wl.org",)))
+
+    @fudge.patch('nti.app.invitations.subscribers._get_app_setting')
+    def test_invitations_bcc_parsed_once(self, get_app_setting):
+        get_app_setting.is_callable().returns("hatter@wl.org, @xyz123")
+        assert_that(reload_invitations_bcc(), is_(("hatter@wl.org",)))
+
+        def _fail(*unused_args):
+            raise AssertionError('bcc parsed again')
+        with fudge.patched_context('nti.app.invitations.subscribers',
+                                   'parse_invitations_bcc', _fail):
+            for _ in range(3):
+                assert_that(_get_invitations_bcc(), is_(("hatter@wl.org",)))
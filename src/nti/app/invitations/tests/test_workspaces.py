@@ -7,6 +7,9 @@ from __future__ import absolute_import
 
 # pylint: disable=protected-access,too-many-public-methods,arguments-differ
 
+import fudge
+
+from hamcrest import is_
 from hamcrest import none
 from hamcrest import is_not
 from hamcrest import has_item
@@ -18,6 +21,10 @@ does_not = is_not
 
 from zope import component
 
+from nti.app.invitations import caches
+
+from nti.app.invitations.caches import user_has_pending_invitations
+
 from nti.app.invitations.interfaces import IInvitationsWorkspace
 
 from nti.app.testing.application_webtest import ApplicationLayerTest
@@ -79,3 +86,32 @@ class TestUserService(ApplicationLayerTest):
         invitations_wss, = invitations_wss
         assert_that(invitations_wss['Items'],
                     has_item(has_entry('Links', has_length(greater_than(0)))))
+
+    @mock_dataserver.WithMockDSTrans
+    def test_pending_invitations_cache(self):
+        user = self._create_user(external_value={'email': u"steve@nti.com"})
+        assert_that(user_has_pending_invitations(user, u'steve@nti.com'), is_(False))
+
+        invitations = component.getUtility(IInvitationsContainer)
+        invitation = Invitation(receiver=u'steve@nti.com',
+                                sender=u'aizen',
+                                code=u"7890")
+        invitations.add(invitation)
+        assert_that(user_has_pending_invitations(user, u'steve@nti.com'), is_(True))
+
+        # Answered from the cache until an invitation changes
+        def _fail(*unused_args, **unused_kwargs):
+            raise AssertionError('catalog queried')
+        with fudge.patched_context(caches, 'has_pending_invitations', _fail):
+            assert_that(user_has_pending_invitations(user, u'steve@nti.com'), is_(True))
+
+        invitations.remove(invitation)
+        assert_that(user_has_pending_invitations(user, u'steve@nti.com'), is_(False))
+
+        # Entries expire
+        cache = caches.PendingInvitationsCache(ttl=0)
+        assert_that(cache.get(None, user.username, u'steve@nti.com'), is_(False))
+        invitations.add(Invitation(receiver=user.username,
+                                   sender=u'aizen',
+                                   code=u"7891"))
+        assert_that(cache.get(None, user.username, u'steve@nti.com'), is_(True))
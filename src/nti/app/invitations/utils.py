@@ -8,11 +8,19 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import six
+import time
+import heapq
+import hashlib
+import operator
+
 from itsdangerous import URLSafeSerializer
 from nti.common.cypher import get_plaintext
 
 from nti.dataserver.users.utils import reindex_email_verification
 
+from pyramid.threadlocal import get_current_request
+
 from six.moves import urllib_parse
 
 from zope import component
@@ -20,6 +28,9 @@ from zope import interface
 
 from zope.component.hooks import getSite
 
+from zope.index.interfaces import IIndexSort
+
+from zope.intid.interfaces import IIntIds
 
 from nti.app.invitations import SITE_INVITATION_MIMETYPE
 from nti.app.invitations import SITE_ADMIN_INVITATION_MIMETYPE
@@ -27,10 +38,33 @@ from nti.app.invitations import INVITATIONS
 from nti.app.invitations import REL_ACCEPT_SITE_INVITATION
 from nti.app.invitations import SIGNED_CONTENT_VERSION_1_0
 
+from nti.app.invitations.caches import get_signed_codes_cache
+
 from nti.app.invitations.interfaces import IInvitationSigner
 
+from nti.dataserver.authorization import is_admin
+from nti.dataserver.authorization import is_site_admin
+from nti.dataserver.authorization import is_admin_or_site_admin
+
+from nti.dataserver.interfaces import IUser
+
+from nti.dataserver.users.index import IX_EMAIL
+
+from nti.dataserver.users.index import get_entity_catalog
+
 from nti.dataserver.users.interfaces import IUserProfile
 
+from nti.dataserver.users.utils import get_user_creation_sitename
+
+from nti.invitations.index import IX_SITE
+from nti.invitations.index import IX_ACCEPTED
+from nti.invitations.index import IX_MIMETYPE
+from nti.invitations.index import IX_SENDER
+from nti.invitations.index import IX_RECEIVER
+from nti.invitations.index import IX_EXPIRYTIME
+
+from nti.invitations.index import get_invitations_catalog
+
 from nti.invitations.interfaces import IDisabledInvitation
 from nti.invitations.interfaces import IInvitationsContainer
 from nti.invitations.interfaces import InvitationCodeError
@@ -40,24 +74,48 @@ from nti.invitations.interfaces import InvitationExpiredError
 from nti.invitations.interfaces import InvitationDisabledError
 from nti.invitations.interfaces import InvitationAlreadyAcceptedError
 
-from nti.invitations.utils import get_invitations
 from nti.invitations.utils import get_invitation_actor 
-from nti.invitations.utils import get_pending_invitations
+
+from nti.site.site import get_component_hierarchy_names
+
+#: The mimetypes of the invitations to join a site
+_SITE_INVITATION_MIMETYPES = (SITE_INVITATION_MIMETYPE,
+                              SITE_ADMIN_INVITATION_MIMETYPE)
+
+#: The request attribute holding the resolved admin roles
+_ADMIN_ROLES_ATTR = '_nti_invitations_admin_roles'
 
 logger = __import__('logging').getLogger(__name__)
 
 
+def _get_site_invitation_for_email(email, type_filter=None):
+    """
+    Return the first site invitation to the current site for the given
+    email, constraining receiver and mimetype in the catalog query and
+    only loading invitations until one targets the current site.
+    """
+    current_site = getattr(getSite(), '__name__', None)
+    receivers = _receiver_query_terms((email,))
+    if not current_site or not receivers:
+        return None
+    # The site index holds the site the invitation was created in,
+    # which is not necessarily its target site
+    doc_ids = get_invitation_ids(receivers=receivers,
+                                 mimeTypes=_SITE_INVITATION_MIMETYPES,
+                                 type_filter=type_filter)
+    intids = component.getUtility(IIntIds)
+    for doc_id in doc_ids:
+        invitation = intids.queryObject(doc_id)
+        if invitation is not None and invitation.target_site == current_site:
+            return invitation
+    return None
+
+
 def get_pending_site_invitation_for_email(email):
     """
     Get any open (pending) invitations to the given email addr.
     """
-    current_site = getattr(getSite(), '__name__', None)
-    pending_invitations = get_pending_invitations(receivers=email,
-                                                  mimeTypes=(SITE_INVITATION_MIMETYPE,
-                                                             SITE_ADMIN_INVITATION_MIMETYPE))
-    for pending_invite in pending_invitations:
-        if pending_invite.target_site == current_site:
-            return pending_invite
+    return _get_site_invitation_for_email(email, 'pending')
 pending_site_invitation_for_email = get_pending_site_invitation_for_email
 
 
@@ -65,13 +123,337 @@ def get_site_invitation_for_email(email):
     """
     Get all invitations with the given email addr as a receiver.
     """
+    return _get_site_invitation_for_email(email)
+
+
+def normalize_email(email):
+    """
+    Return the canonical (stripped, case-folded) form of the given email
+    addr, used to detect duplicate receivers.
+    """
+    return email.strip().lower() if email else email
+
+
+def _receiver_query_terms(emails):
+    result = set()
+    for email in emails or ():
+        if email:
+            result.add(email)
+            result.add(email.lower())
+    return tuple(result)
+
+
+def get_site_invitations_for_emails(emails):
+    """
+    Get the site invitations for all of the given email addrs with a single
+    catalog query. Returns a dict keyed by the lower-cased email; as with
+    :func:`get_site_invitation_for_email`, only the first invitation for
+    the current site is returned for each email.
+    """
+    result = dict()
     current_site = getattr(getSite(), '__name__', None)
-    user_invitations = get_invitations(receivers=email,
-                                       mimeTypes=(SITE_INVITATION_MIMETYPE,
-                                                  SITE_ADMIN_INVITATION_MIMETYPE))
-    for user_invite in user_invitations:
-        if user_invite.target_site == current_site:
-            return user_invite
+    receivers = _receiver_query_terms(emails)
+    if not current_site or not receivers:
+        return result
+    doc_ids = get_invitation_ids(receivers=receivers,
+                                 mimeTypes=_SITE_INVITATION_MIMETYPES)
+    intids = component.getUtility(IIntIds)
+    for doc_id in doc_ids:
+        user_invite = intids.queryObject(doc_id)
+        if      user_invite is not None \
+            and user_invite.receiver \
+            and user_invite.target_site == current_site:
+            result.setdefault(user_invite.receiver.lower(), user_invite)
+    return result
+
+
+def get_sent_invitation_ids(senders, pending=True, catalog=None):
+    """
+    Return the doc ids of the invitations sent by any of the given
+    usernames or email addrs with a single catalog query, only the
+    unaccepted ones if ``pending``.
+    """
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    senders = _receiver_query_terms(senders)
+    if catalog is None or not senders:
+        return ()
+    query = {
+        IX_SENDER: {'any_of': senders}
+    }
+    if pending:
+        query[IX_ACCEPTED] = {'any_of': (False,)}
+    doc_ids = catalog.apply(query)
+    return doc_ids if doc_ids is not None else ()
+
+
+def remove_invitations(doc_ids, container=None, intids=None):
+    """
+    Remove the invitations with the given doc ids from the container.
+    The ids are copied first, so the (unindexed) result set of a catalog
+    query can be passed. Returns the number of removed invitations.
+
+    Each invitation is removed through the container, so its removal
+    events (unregistering its intid, unindexing it, invalidating the
+    pending invitation flags of its receiver) fire as usual.
+    """
+    doc_ids = list(doc_ids or ())
+    if not doc_ids:
+        return 0
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    if container is None:
+        container = component.getUtility(IInvitationsContainer)
+    invitations = [intids.queryObject(x) for x in doc_ids]
+    count = 0
+    for invitation in invitations:
+        if invitation is not None:
+            container.remove(invitation)
+            count += 1
+    return count
+
+
+def remove_sent_invitations(senders, container=None, intids=None, catalog=None):
+    """
+    Remove the unaccepted invitations sent by any of the given usernames
+    or email addrs, found with a single catalog query. Returns the number
+    of removed invitations.
+    """
+    doc_ids = get_sent_invitation_ids(senders, catalog=catalog)
+    return remove_invitations(doc_ids, container, intids)
+
+
+def get_users_by_emails_in_sites(emails, sites=None):
+    """
+    Get the users using any of the given email addrs in the given sites
+    (the current site hierarchy by default) with a single entity catalog
+    query. Returns a dict of lower-cased email to the list of users.
+    """
+    result = dict()
+    terms = _receiver_query_terms(emails)
+    if not terms:
+        return result
+    if isinstance(sites, six.string_types):
+        sites = sites.split(',')
+    sites = set(sites or get_component_hierarchy_names())
+    catalog = get_entity_catalog()
+    intids = component.getUtility(IIntIds)
+    doc_ids = catalog[IX_EMAIL].apply({'any_of': terms})
+    for doc_id in doc_ids or ():
+        user = intids.queryObject(doc_id)
+        if not IUser.providedBy(user) \
+                or get_user_creation_sitename(user) not in sites:
+            continue
+        email = getattr(IUserProfile(user, None), 'email', None)
+        if email:
+            result.setdefault(email.lower(), []).append(user)
+    return result
+
+
+def _as_tuple(values):
+    if isinstance(values, six.string_types):
+        values = values.split(',')
+    return tuple(values)
+
+
+def _expired_ids(catalog, now=None):
+    # A zero expiry time never expires
+    now = time.time() if now is None else now
+    return catalog[IX_EXPIRYTIME].apply({'between': (0, now, True, False)})
+
+
+def get_invitation_ids(receivers=None, mimeTypes=None, type_filter=None,
+                       now=None, catalog=None, sites=None):
+    """
+    Return the catalog doc ids of the invitations for the given receivers,
+    mimetypes and sites (all of them if not given), optionally only the
+    ``pending``, ``accepted`` or ``expired`` ones, without loading any
+    invitation.
+    """
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    query = {}
+    if sites:
+        query[IX_SITE] = {'any_of': _as_tuple(sites)}
+    if mimeTypes:
+        query[IX_MIMETYPE] = {'any_of': _as_tuple(mimeTypes)}
+    if receivers:
+        query[IX_RECEIVER] = {'any_of': _as_tuple(receivers)}
+    if type_filter == 'accepted':
+        query[IX_ACCEPTED] = {'any_of': (True,)}
+    elif type_filter in ('pending', 'expired'):
+        query[IX_ACCEPTED] = {'any_of': (False,)}
+    doc_ids = catalog.apply(query)
+    if type_filter in ('pending', 'expired'):
+        expired_ids = _expired_ids(catalog, now)
+        if type_filter == 'pending':
+            doc_ids = catalog.family.IF.difference(doc_ids, expired_ids)
+        else:
+            doc_ids = catalog.family.IF.intersection(doc_ids, expired_ids)
+    return doc_ids if doc_ids is not None else catalog.family.IF.Set()
+
+
+def get_site_invitation_ids(sites=None, mimeTypes=None, type_filter=None,
+                            now=None, catalog=None, receivers=None):
+    """
+    Return the catalog doc ids of the invitations for the given sites
+    (the current site by default), mimetypes and, if given, receivers,
+    optionally only the ``pending``, ``accepted`` or ``expired`` ones,
+    without loading any invitation.
+    """
+    return get_invitation_ids(receivers=receivers,
+                              mimeTypes=mimeTypes,
+                              type_filter=type_filter,
+                              now=now,
+                              catalog=catalog,
+                              sites=sites or getSite().__name__)
+
+
+def get_site_invitation_counts(sites=None, mimeTypes=None, now=None, catalog=None):
+    """
+    Count the invitations for the given sites by status (pending, accepted
+    and expired), in total and for each of the given mimetypes. Only
+    catalog doc id sets are used; no invitation is loaded.
+    """
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    IF = catalog.family.IF
+    empty = IF.Set()
+    site_ids = catalog.apply({
+        IX_SITE: {'any_of': _as_tuple(sites or getSite().__name__)}
+    }) or empty
+    accepted_ids = catalog[IX_ACCEPTED].apply({'any_of': (True,)}) or empty
+    unaccepted_ids = catalog[IX_ACCEPTED].apply({'any_of': (False,)}) or empty
+    expired_ids = _expired_ids(catalog, now) or empty
+
+    def _counts(doc_ids):
+        unaccepted = IF.intersection(doc_ids, unaccepted_ids)
+        expired = len(IF.intersection(unaccepted, expired_ids))
+        return {
+            'Total': len(doc_ids),
+            'Pending': len(unaccepted) - expired,
+            'Accepted': len(IF.intersection(doc_ids, accepted_ids)),
+            'Expired': expired,
+        }
+
+    by_mimetype = {}
+    mimetype_index = catalog[IX_MIMETYPE]
+    for mimetype in _as_tuple(mimeTypes or ()):
+        mimetype_ids = mimetype_index.apply({'any_of': (mimetype,)}) or empty
+        by_mimetype[mimetype] = IF.intersection(site_ids, mimetype_ids)
+    if by_mimetype:
+        site_ids = IF.multiunion(list(by_mimetype.values()))
+    result = _counts(site_ids)
+    result['MimeTypes'] = {k: _counts(v) for k, v in by_mimetype.items()}
+    return result
+
+
+def sort_invitation_ids(doc_ids, sort_on, reverse=False, limit=None, catalog=None):
+    """
+    Sort the given doc ids on the values of the named invitations catalog
+    index, returning at most ``limit`` ids. Returns None if there is no
+    such index or it cannot be sorted on.
+    """
+    catalog = get_invitations_catalog() if catalog is None else catalog
+    index = catalog.get(sort_on)
+    if index is None:
+        return None
+    if limit is not None and limit < 1:
+        return []
+    # Wrappers (e.g. normalized indexes) may not declare that the
+    # index they wrap can sort
+    for sortable in (index, getattr(index, 'index', None)):
+        if IIndexSort.providedBy(sortable):
+            return list(sortable.sort(doc_ids, reverse=reverse, limit=limit))
+    # Value indexes map doc ids to their values
+    values = getattr(getattr(index, 'index', index), 'documents_to_values', None)
+    if values is None:
+        return None
+    missing = []
+    present = []
+    for doc_id in doc_ids:
+        value = values.get(doc_id)
+        if value is None:
+            missing.append(doc_id)
+        else:
+            present.append((value, doc_id))
+    key = operator.itemgetter(0)
+    if limit is not None and limit < len(present):
+        # Only select what is needed, with a bounded heap
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        present = select(limit, present, key=key)
+    else:
+        present.sort(key=key, reverse=reverse)
+    result = [x[1] for x in present]
+    result.extend(missing)
+    return result[:limit] if limit is not None else result
+
+
+class LazyInvitations(object):
+    """
+    A sequence of the invitations for (a prefix of) a sorted list of doc
+    ids, resolving the invitations only as they are accessed. Its length
+    is the length of the full result.
+    """
+
+    def __init__(self, doc_ids, length=None, intids=None):
+        self.doc_ids = doc_ids
+        self.length = len(doc_ids) if length is None else length
+        self.intids = component.getUtility(IIntIds) if intids is None else intids
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for doc_id in self.doc_ids:
+            invitation = self.intids.queryObject(doc_id)
+            if invitation is not None:
+                yield invitation
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [x for x in (self.intids.queryObject(doc_id)
+                                for doc_id in self.doc_ids[index])
+                    if x is not None]
+        return self.intids.getObject(self.doc_ids[index])
+
+
+def _get_admin_role(check, user, request=None):
+    """
+    Resolve the given role check for the user once per request (and
+    site); without a request the check is not cached.
+    """
+    if user is None:
+        return False
+    request = get_current_request() if request is None else request
+    if request is None:
+        return check(user)
+    try:
+        roles = getattr(request, _ADMIN_ROLES_ATTR)
+    except AttributeError:
+        roles = {}
+        setattr(request, _ADMIN_ROLES_ATTR, roles)
+    site = getSite()
+    key = (check.__name__,
+           getattr(user, 'username', user),
+           getattr(site, '__name__', None))
+    try:
+        result = roles[key]
+    except KeyError:
+        result = roles[key] = bool(check(user))
+    return result
+
+
+def request_is_admin(user, request=None):
+    return _get_admin_role(is_admin, user, request)
+
+
+def request_is_site_admin(user, request=None):
+    return _get_admin_role(is_site_admin, user, request)
+
+
+def request_is_admin_or_site_admin(user, request=None):
+    """
+    :func:`is_admin_or_site_admin` resolved once per request, so that
+    providers and decorators called for many objects share the answer.
+    """
+    return _get_admin_role(is_admin_or_site_admin, user, request)
 
 
 def get_site_invitation_actor(invitation, user, link_email):
@@ -129,14 +511,35 @@ def accept_site_invitation_by_code(user, code, link_email):
     return result
 
 
+def get_signed_invitation_code(invitation, signer=None):
+    """
+    Return the signed ``scode`` of the given invitation redemption link.
+
+    The signature only depends on the signer (its secret and salt),
+    version, code and original receiver, which make up the key of a
+    bounded process cache; a changed code or receiver is signed anew.
+    """
+    signer = component.getUtility(IInvitationSigner) if signer is None else signer
+    code = invitation.code
+    email = invitation.original_receiver
+    # Signers without a fingerprint are kept alive by the key itself
+    fingerprint = getattr(signer, 'fingerprint', None) or signer
+    key = (fingerprint, SIGNED_CONTENT_VERSION_1_0, code, email)
+    cache = get_signed_codes_cache()
+    result = cache.get(key)
+    if result is None:
+        signed_params = {
+            'version': SIGNED_CONTENT_VERSION_1_0,
+            'code': code,
+            'email': email
+        }
+        result = signer.encode(signed_params)
+        cache.set(key, result)
+    return result
+
+
 def get_invitation_url(application_url, invitation):
-    signed_params = {
-        'version': SIGNED_CONTENT_VERSION_1_0,
-        'code': invitation.code,
-        'email': invitation.original_receiver
-    }
-    signer = component.getUtility(IInvitationSigner)
-    params = {'scode': signer.encode(signed_params)}
+    params = {'scode': get_signed_invitation_code(invitation)}
     query = urllib_parse.urlencode(params)
 
     url = '/%s/%s/%s?%s' % ("dataserver2",
@@ -153,7 +556,11 @@ def get_invitation_url(application_url, invitation):
 class InvitationSigner(object):
 
     def __init__(self, secret, salt):
-        self.serializer = URLSafeSerializer(get_plaintext(secret), salt=salt)
+        secret = get_plaintext(secret)
+        self.serializer = URLSafeSerializer(secret, salt=salt)
+        # Identifies the signatures of this secret and salt
+        self.fingerprint = hashlib.sha256(
+            repr((secret, salt)).encode('utf-8')).hexdigest()
 
     def encode(self, content):
         return self.serializer.dumps(content)
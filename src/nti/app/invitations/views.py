@@ -13,6 +13,8 @@ from __future__ import absolute_import
 import csv
 import six
 import time
+import shutil
+import tempfile
 import calendar
 import isodate
 
@@ -20,14 +22,16 @@ import unicodecsv as ucsv
 
 from datetime import datetime
 
-from io import BytesIO
-
 from itsdangerous import BadSignature
 
+from persistent.list import PersistentList
+
 from pyramid import httpexceptions as hexc
 
 from pyramid.interfaces import IRequest
 
+from pyramid.response import FileIter
+
 from pyramid.view import view_config
 from pyramid.view import view_defaults
 
@@ -84,6 +88,7 @@ from nti.app.invitations import REL_ACCEPT_SITE_INVITATION
 from nti.app.invitations import REL_DELETE_SITE_INVITATIONS
 from nti.app.invitations import REL_GENERIC_SITE_INVITATION
 from nti.app.invitations import SITE_INVITATION_SESSION_KEY
+from nti.app.invitations import REL_SITE_INVITATION_COUNTS
 from nti.app.invitations import REL_PENDING_SITE_INVITATIONS
 from nti.app.invitations import SITE_ADMIN_INVITATION_MIMETYPE
 from nti.app.invitations import GENERIC_SITE_INVITATION_MIMETYPE
@@ -92,31 +97,53 @@ from nti.app.invitations import SITE_INVITATION_EMAIL_SESSION_KEY
 from nti.app.invitations import SIGNED_CONTENT_VERSION_1_0
 
 from nti.app.invitations.interfaces import ISiteInvitation
+from nti.app.invitations.interfaces import ISiteInvitationJob
+from nti.app.invitations.interfaces import ISiteInvitationJobRunner
+from nti.app.invitations.interfaces import ISiteInvitationJobContainer
 from nti.app.invitations.interfaces import ISiteAdminInvitation
 from nti.app.invitations.interfaces import IChallengeLogonProvider
 from nti.app.invitations.interfaces import IInvitationSigner
 from nti.app.invitations.interfaces import IInvitationInfo
 
+from nti.app.invitations.bulk import SiteInvitationSenderMixin
+
 from nti.app.invitations.invitations import JoinEntityInvitation
 from nti.app.invitations.invitations import GenericSiteInvitation
 
+from nti.app.invitations.index import IX_CREATEDTIME
+
+from nti.app.invitations.index import search_invitation_ids
+
+from nti.app.invitations.jobs import SiteInvitationJob
+
+from nti.app.invitations.jobs import get_site_invitation_job
+from nti.app.invitations.jobs import get_site_invitation_job_href
+
 from nti.app.invitations.traversal import InvitationInfoPathAdapter
 
 from nti.app.invitations.utils import accept_site_invitation_by_code
-from nti.app.invitations.utils import get_site_invitation_for_email
+from nti.app.invitations.utils import LazyInvitations
+from nti.app.invitations.utils import normalize_email
+from nti.app.invitations.utils import sort_invitation_ids
+from nti.app.invitations.utils import get_site_invitation_ids
+from nti.app.invitations.utils import get_site_invitation_counts
+from nti.app.invitations.utils import get_users_by_emails_in_sites
+from nti.app.invitations.utils import request_is_admin
+from nti.app.invitations.utils import request_is_site_admin
+from nti.app.invitations.utils import request_is_admin_or_site_admin
 
 from nti.appserver.interfaces import IApplicationSettings
 
 from nti.common._compat import text_
 
+from nti.common.string import is_true
+
 from nti.common.url import safe_add_query_params
 
 from nti.coremetadata.interfaces import IUsernameSubstitutionPolicy
 
 from nti.dataserver import authorization as nauth
 
-from nti.dataserver.authorization import is_site_admin
-from nti.dataserver.authorization import is_admin_or_site_admin
 
 from nti.dataserver.interfaces import IUser
 from nti.dataserver.interfaces import IDataserverFolder
@@ -127,8 +154,6 @@ from nti.dataserver.users.interfaces import IFriendlyNamed
 
 from nti.dataserver.users.users import User
 
-from nti.dataserver.users.utils import get_users_by_email_in_sites
-
 from nti.externalization.externalization import to_external_object
 
 from nti.externalization.integer_strings import to_external_string
@@ -137,6 +162,8 @@ from nti.externalization.integer_strings import from_external_string
 from nti.externalization.interfaces import LocatedExternalDict
 from nti.externalization.interfaces import StandardExternalFields
 
+from nti.invitations.index import IX_RECEIVER
+
 from nti.invitations.interfaces import IInvitation
 from nti.invitations.interfaces import IDisabledInvitation
 from nti.invitations.interfaces import InvitationSentEvent
@@ -149,7 +176,6 @@ from nti.invitations.utils import get_all_invitations
 from nti.invitations.utils import get_pending_invitations
 from nti.invitations.utils import get_expired_invitations
 from nti.invitations.utils import get_accepted_invitations
-from nti.invitations.utils import get_random_invitation_code
 
 from nti.links import Link
 
@@ -180,6 +206,8 @@ class InvitationsPathAdapter(object):
         # pylint: disable=no-member,too-many-function-args
         key = urllib_parse.unquote(key)
         result = self.invitations.get(key)
+        if result is None:
+            result = get_site_invitation_job(key)
         if result is not None:
             return result
         raise KeyError(key) if key else hexc.HTTPNotFound()
@@ -539,7 +567,7 @@ class DeleteSiteInvitationsView(AbstractAuthenticatedView,
         return component.getUtility(IInvitationsContainer)
 
     def __call__(self):
-        if not is_admin_or_site_admin(self.remoteUser):
+        if not request_is_admin_or_site_admin(self.remoteUser, self.request):
             return hexc.HTTPForbidden()
 
         values = self.readInput()
@@ -571,7 +599,7 @@ class DeleteSiteInvitationView(AbstractAuthenticatedView):
 
     def __call__(self):
         # Better permissioning? Is this container below a site?
-        if not is_admin_or_site_admin(self.remoteUser):
+        if not request_is_admin_or_site_admin(self.remoteUser, self.request):
             return hexc.HTTPForbidden()
         _delete_invitation(self.context)
         return hexc.HTTPNoContent()
@@ -584,18 +612,22 @@ class DeleteSiteInvitationView(AbstractAuthenticatedView):
              permission=nauth.ACT_READ,  # Do the permission check in the view
              name=REL_SEND_SITE_INVITATION)
 class SendSiteInvitationCodeView(AbstractAuthenticatedView,
-                                 ModeledContentUploadRequestUtilsMixin):
+                                 SiteInvitationSenderMixin):
+
+    #: Uploads larger than this are spooled to disk when they need
+    #: to be re-read.
+    _CSV_SPOOL_SIZE = 1024 * 1024
+
     def __init__(self, request):
         super(SendSiteInvitationCodeView, self).__init__(request)
         self.warnings = list()
         self.invalid_emails = list()
-
-    @Lazy
-    def invitations(self):
-        return component.getUtility(IInvitationsContainer)
+        self.merged = list()
+        self.invitation_count = 0
+        self.existing_user_count = 0
 
     def check_permissions(self):
-        if not is_admin_or_site_admin(self.remoteUser):
+        if not request_is_admin_or_site_admin(self.remoteUser, self.request):
             logger.info('User %s failed permissions check for sending site invitation.',
                         self.remoteUser)
             raise hexc.HTTPForbidden()
@@ -603,29 +635,41 @@ class SendSiteInvitationCodeView(AbstractAuthenticatedView,
     def _decode_cell(self, string, encoding='utf-8-sig'):
         return text_(string, encoding)
 
+    def _get_csv_source(self):
+        source = get_source(self.request, 'csv', 'input', 'source')
+        if source is not None and not callable(getattr(source, 'seek', None)):
+            # We read the upload twice (validate, then send), so make sure
+            # we can rewind it without holding it all in memory.
+            spooled = tempfile.SpooledTemporaryFile(max_size=self._CSV_SPOOL_SIZE)
+            shutil.copyfileobj(source, spooled)
+            source = spooled
+        return source
+
     # TODO: This closely resembles
     # TODO: nti.app.products.courseware.views.course_invitation_views.CheckCourseInvitationsCSVView.parse_csv_users
-    def parse_csv(self):
-        result = []
-        source = get_source(self.request, 'csv', 'input', 'source')
-        if source is not None:
-            # Read in and split (to handle universal newlines).
-            # XXX: Generalize this?
-            for unused_idx, row in enumerate(csv.reader(source)):
-                if not row or row[0].startswith("#"):
-                    continue
-                email = row[0]
-                email = self._decode_cell(email)
-                email = email.strip() if email else email
-                realname = self._decode_cell(row[1]) if len(row) > 1 else u''
-                if not email:
-                    # Ignore empty email lines
-                    continue
-                if not isValidMailAddress(email):
-                    self.invalid_emails.append(email)
-                    continue
-                result.append({'receiver': email, 'receiver_name': realname})
-        return result
+    def iter_csv(self, source, validate=True):
+        """
+        Lazily yield the invitation dicts of the given CSV source, one row
+        at a time. If ``validate``, invalid emails are recorded rather than
+        yielded.
+        """
+        source.seek(0)
+        # Read in and split (to handle universal newlines).
+        # XXX: Generalize this?
+        for row in csv.reader(source):
+            if not row or row[0].startswith("#"):
+                continue
+            email = row[0]
+            email = self._decode_cell(email)
+            email = email.strip() if email else email
+            if not email:
+                # Ignore empty email lines
+                continue
+            if validate and not isValidMailAddress(email):
+                self.invalid_emails.append(email)
+                continue
+            realname = self._decode_cell(row[1]) if len(row) > 1 else u''
+            yield {'receiver': email, 'receiver_name': realname}
 
     def readInput(self, value=None):
         result = None
@@ -651,16 +695,33 @@ class SendSiteInvitationCodeView(AbstractAuthenticatedView,
                 self.warnings.append(msg)
                 continue
 
-            if not isValidMailAddress(email):
+            if not isValidMailAddress(email.strip()):
                 self.invalid_emails.append(email)
                 continue
 
-    def get_site_invitations(self):
-        values = self.readInput()
-        json_invitations = values.get('invitations', [])
-        self._validate_json_invitations(json_invitations)
+    def _unique_invitations(self, invitations, merged=None):
+        """
+        Canonicalize the receiver of each invitation and collapse the
+        invitations to a receiver already seen, appending them to
+        ``merged`` if given.
+        """
+        seen = set()
+        for invitation in invitations:
+            receiver = normalize_email(invitation.get('receiver'))
+            if receiver:
+                if receiver in seen:
+                    if merged is not None:
+                        merged.append(invitation)
+                    continue
+                seen.add(receiver)
+                invitation['receiver'] = receiver
+            yield invitation
+
+    def _count_site_invitations(self, json_invitations, source):
+        invitations = self.iter_site_invitations(json_invitations, source,
+                                                 validate=True)
         try:
-            csv_invitations = self.parse_csv()
+            return sum(1 for _ in self._unique_invitations(invitations))
         except Exception:  # pylint: disable=broad-except
             logger.exception('Failed to parse CSV file')
             raise_json_error(
@@ -671,11 +732,58 @@ class SendSiteInvitationCodeView(AbstractAuthenticatedView,
                     'code': 'InvalidCSVFileCodeError',
                 },
                 None)
-        # Join csv and json invitations
-        invitations = json_invitations + csv_invitations
-        values['invitations'] = invitations
+
+    def iter_site_invitations(self, json_invitations, source, validate=False):
+        """
+        Lazily yield the JSON invitations followed by the rows of the
+        CSV source.
+        """
+        for invitation in json_invitations:
+            yield invitation
+        if source is not None:
+            for invitation in self.iter_csv(source, validate=validate):
+                yield invitation
+
+    def get_site_invitations(self):
+        """
+        Validate the JSON and CSV invitations in a first pass over the
+        input, storing the number of distinct receivers in
+        ``invitation_count``. Every row is validated (and counted) before
+        anything is sent, so this pass is always made. The returned
+        ``invitations`` are a generator reading the input again; the
+        collapsed duplicate rows are collected in ``merged`` as it is
+        consumed.
+
+        The rows are not collected into a list, but the upload is spooled
+        (to disk past ``_CSV_SPOOL_SIZE``) and each pass keeps the set of
+        receivers it has seen, so memory use still grows with the number
+        of distinct receivers.
+        """
+        values = self.readInput()
+        json_invitations = values.get('invitations', [])
+        self._validate_json_invitations(json_invitations)
+        source = self._get_csv_source()
+        self.invitation_count = self._count_site_invitations(json_invitations,
+                                                             source)
+        # Join json and csv invitations
+        invitations = self.iter_site_invitations(json_invitations, source)
+        values['invitations'] = self._unique_invitations(invitations,
+                                                         self.merged)
         return values
 
+    def _iter_new_invitations(self, invitations):
+        """
+        Yield the invitations whose receiver is not the email of an
+        existing user, checking a batch of receivers at a time.
+        """
+        for batch in self._iter_batches(invitations):
+            existing_users = get_users_by_emails_in_sites([x['receiver'] for x in batch])
+            for invitation in batch:
+                if existing_users.get(invitation['receiver'].lower()):
+                    self.existing_user_count += 1
+                else:
+                    yield invitation
+
     def preflight_input(self, force=False):
         values = self.get_site_invitations()
         # At this point we should have a values dict containing invitation destinations and message
@@ -694,33 +802,30 @@ class SendSiteInvitationCodeView(AbstractAuthenticatedView,
             )
 
         # We ignore users already accepted unless *only* (1) specific
-        # user was invited. 
-        challenge = []
-        new_invitations = []
+        # user was invited.
         invites = values['invitations']
-        for invitation in invites:
-            if get_users_by_email_in_sites(invitation['receiver']):
-                challenge.append(invitation)
-            else:
-                new_invitations.append(invitation)
+        if self.invitation_count != 1:
+            values['invitations'] = self._iter_new_invitations(invites)
+            return values
+
+        invites = list(invites)
+        existing_users = get_users_by_emails_in_sites([x['receiver'] for x in invites])
+        challenge = [x for x in invites if existing_users.get(x['receiver'].lower())]
         # XXX Is there ever a valid reason to send an invite to an
         # email owned by an existing user?
-        if challenge and len(invites) == 1:
+        if challenge and not force:
             # XXX: Ideally we separate out this direct invite
             # case from the bulk, alas.
-            if force:
-                new_invitations = challenge
-            else:
-                self._handle_challenge(challenge,
-                                       code=u'ExistingAccountEmail',
-                                       message=_(
-                                           u'%s %s will be sent to an email address'
-                                           u' already associated with an account.' %
-                                           (len(challenge), self.request.localizer.pluralize(u'invitation',
-                                                                                             u'invitations',
-                                                                                             len(challenge)))
-                                       ))
-        values['invitations'] = new_invitations
+            self._handle_challenge(challenge,
+                                   code=u'ExistingAccountEmail',
+                                   message=_(
+                                       u'%s %s will be sent to an email address'
+                                       u' already associated with an account.' %
+                                       (len(challenge), self.request.localizer.pluralize(u'invitation',
+                                                                                         u'invitations',
+                                                                                         len(challenge)))
+                                   ))
+        values['invitations'] = invites
         return values
 
     def _handle_challenge(self, challenge_invitations, code, message):
@@ -741,8 +846,36 @@ class SendSiteInvitationCodeView(AbstractAuthenticatedView,
                          challenge,
                          None)
 
-    def _notify(self, invitation, email):
-        notify(InvitationSentEvent(invitation, email))
+    def _is_async(self, values):
+        return is_true(self.request.params.get('async') or values.get('async'))
+
+    def _submit_job(self, values, mimetype, message, force):
+        """
+        Store the validated rows in a job to be sent in the background and
+        return the job with a `202 Accepted` status.
+        """
+        # pylint: disable=no-member
+        job = SiteInvitationJob(creator=self.remoteUser.username,
+                                site=getSite().__name__,
+                                rows=values['invitations'],
+                                chunk_size=self._BULK_SEND_BATCH_SIZE,
+                                mimetype=mimetype,
+                                message=message,
+                                force=force,
+                                notify_sent=self._notify_sent,
+                                application_url=self.request.application_url)
+        if self.merged:
+            job.merged = PersistentList(dict(x) for x in self.merged)
+        jobs = component.getUtility(ISiteInvitationJobContainer)
+        jobs[job.id] = job
+        component.getUtility(ISiteInvitationJobRunner).submit(job)
+        logger.info('Submitted site invitation job %s for %s row(s)',
+                    job.id, job.total)
+        response = self.request.response
+        response.status_int = 202
+        response.location = get_site_invitation_job_href(job,
+                                                         self.request.application_url)
+        return job
 
     def __call__(self):
         self.check_permissions()
@@ -751,52 +884,18 @@ class SendSiteInvitationCodeView(AbstractAuthenticatedView,
         # Default to a regular site invitation
         mimetype = values.get('mime_type') or values.get('mimeType')
         message = values.get('message')
+        if self._is_async(values):
+            return self._submit_job(values, mimetype, message, force)
         result = LocatedExternalDict()
         items = []
         challenge_invitations = []
-        # pylint: disable=no-member
-        for ext_values in values['invitations']:
-            email = ext_values['receiver']
-            # Check if this user already has an invite to this site
-            # We are only *accepted* here if this is a direct invite that was already 
-            # confirmed (e.g. forced).
-            user_invitation = get_site_invitation_for_email(email)
-            if user_invitation is not None:
-                if      mimetype \
-                    and not force \
-                    and user_invitation.mime_type != mimetype:
-                    # Only challenge invitations that change the user role without the force param
-                    challenge_invitations.append(user_invitation)
-                    continue
-
-                # Issue a new invite with mimetype or existing mimetype
-                # This is where we can update the invitation type
-                ext_values[MIMETYPE] = mimetype or user_invitation.mime_type
-                # Prefer given message if we have one
-                ext_values['message'] = message or user_invitation.message
-                if     user_invitation.is_expired() \
-                    or user_invitation.is_accepted():
-                    ext_values['code'] = get_random_invitation_code()
-                else:
-                    # Pending, re-use code
-                    ext_values['code'] = user_invitation.code
-                if not user_invitation.is_accepted():
-                    self.invitations.remove(user_invitation)
-            else:
-                # New invites
-                if MIMETYPE not in ext_values:
-                    ext_values[MIMETYPE] = mimetype or SITE_INVITATION_MIMETYPE
-                if 'message' not in ext_values:
-                    ext_values['message'] = message
-                ext_values['code'] = get_random_invitation_code()
-            
-            # XXX: we may have receiver with no message and mimetype - that's ok?
-            # We default mimetype and we'll have no message.                        
-            ext_values['target_site'] = getSite().__name__
-            invitation = self.readCreateUpdateContentObject(self.remoteUser, externalValue=ext_values)
-            items.append(invitation)
-            self.invitations.add(invitation)
-            self._notify(invitation, email)
+        for batch in self._iter_batches(values['invitations']):
+            items.extend(self.send_batch(batch, mimetype, message, force,
+                                         challenge_invitations))
+            logger.info('Processed %s of %s site invitation(s) (site=%s)',
+                        len(items) + len(challenge_invitations) + self.existing_user_count,
+                        self.invitation_count,
+                        getSite().__name__)
 
         if len(challenge_invitations) > 0:
             self._handle_challenge(challenge_invitations,
@@ -810,6 +909,7 @@ class SendSiteInvitationCodeView(AbstractAuthenticatedView,
                                    ))
 
         result[ITEMS] = items
+        result['Merged'] = self.merged
         result.__name__ = self.request.view_name
         result.__parent__ = self.request.context
         result[TOTAL] = result[ITEM_COUNT] = len(items)
@@ -824,9 +924,27 @@ class SendSiteInvitationCodeView(AbstractAuthenticatedView,
              name=REL_CREATE_SITE_INVITATION)
 class CreateSiteInvitationCodeView(SendSiteInvitationCodeView):
 
-    def _notify(self, invitation, email):
-        # Don't send e-mail
-        pass
+    # Don't send e-mail
+    _notify_sent = False
+
+
+@view_config(route_name='objects.generic.traversal',
+             renderer='rest',
+             context=ISiteInvitationJob,
+             request_method='GET',
+             permission=nauth.ACT_READ)  # Do the permission check in the view
+class SiteInvitationJobView(AbstractAuthenticatedView):
+    """
+    Report the progress of a background site invitation job.
+    """
+
+    def __call__(self):
+        # pylint: disable=no-member
+        if     not request_is_admin_or_site_admin(self.remoteUser, self.request) \
+            or (    not request_is_admin(self.remoteUser, self.request)
+                and self.context.site != getSite().__name__):
+            raise hexc.HTTPForbidden()
+        return self.context
 
 
 @view_config(route_name='objects.generic.traversal',
@@ -1043,6 +1161,13 @@ class GetSiteInvitationsView(AbstractAuthenticatedView,
     _default_mimetypes = (SITE_INVITATION_MIMETYPE,
                           SITE_ADMIN_INVITATION_MIMETYPE)
 
+    #: The catalog indexes for the ``sortOn`` values we can sort on
+    #: without loading the invitations.
+    _index_sorts = {
+        'created_time': IX_CREATEDTIME,
+        'receiver': IX_RECEIVER,
+    }
+
     def _do_sort_receiver(self, items, reverse):
         return sorted(items, key=lambda item: item.receiver, reverse=reverse)
 
@@ -1107,21 +1232,13 @@ class GetSiteInvitationsView(AbstractAuthenticatedView,
     
     def _filter_invitations(self, invitations):
         if self.filter_value:
-            val = self.filter_value.lower()
-            def _include(invite):
-                rec_user = User.get_user(invite.receiver)
-                fn = IFriendlyNamed(rec_user, '')
-                realname = getattr(fn, 'realname', '')
-                alias = getattr(fn, 'alias', '')
-                # username, target email, user real name
-                return (invite.receiver and val in invite.receiver.lower()) \
-                    or (invite.original_receiver and val in invite.original_receiver.lower()) \
-                    or (alias and val in alias.lower()) \
-                    or (realname and val in realname.lower())
-            invitations = [x for x in invitations if _include(x)]
+            # username, target email, user real name and alias
+            intids = component.getUtility(IIntIds)
+            doc_ids = search_invitation_ids(self.filter_value)
+            invitations = [x for x in invitations
+                           if intids.queryId(x) in doc_ids]
         return invitations
-    
-    
+
     def filter_and_sort_invitations(self, items):
         items = self._filter_invitations(items)
         sort_name = self._params.get('sortOn', 'created_time')
@@ -1134,32 +1251,76 @@ class GetSiteInvitationsView(AbstractAuthenticatedView,
                 pass
         return items
 
+    def get_invitation_ids(self):
+        """
+        Return the catalog doc ids of the invitations returned by
+        :meth:`get_invitations`.
+        """
+        return get_site_invitation_ids(sites=self.site,
+                                       mimeTypes=self.mime_types,
+                                       type_filter=self.type_filter)
+
+    def _get_sorted_invitations(self, batch_size=None, batch_start=None):
+        """
+        Filter and sort the invitations in the catalog, only resolving the
+        invitations of the requested batch. Returns the unfiltered total
+        and the sorted invitations, or None if this cannot be done by the
+        catalog.
+        """
+        sort_name = self._params.get('sortOn', 'created_time')
+        if sort_name not in self._index_sorts:
+            return None
+        sort_reverse = self._params.get('sortOrder', 'ascending') == 'descending'
+        doc_ids = self.get_invitation_ids()
+        total = len(doc_ids)
+        if self.filter_value:
+            doc_ids = search_invitation_ids(self.filter_value, doc_ids=doc_ids)
+        limit = None
+        if batch_size is not None and batch_start is not None:
+            # Enough to fill the batch and to know about the next one
+            limit = batch_start + batch_size + 2
+        sorted_ids = sort_invitation_ids(doc_ids,
+                                         self._index_sorts[sort_name],
+                                         reverse=sort_reverse,
+                                         limit=limit)
+        if sorted_ids is None:
+            return None
+        return total, LazyInvitations(sorted_ids, len(doc_ids))
+
     def _do_call(self):
         result = LocatedExternalDict()
-        items = self.get_invitations()
-        filtered_items = self.filter_and_sort_invitations(items)
+        batch_size, batch_start = self._get_batch_size_start()
+        sorted_invitations = self._get_sorted_invitations(batch_size, batch_start)
+        if sorted_invitations is not None:
+            total, filtered_items = sorted_invitations
+        else:
+            items = self.get_invitations()
+            total = len(items)
+            filtered_items = self.filter_and_sort_invitations(items)
         result[ITEMS] = filtered_items
 
-        result[TOTAL] = len(items)
+        result[TOTAL] = total
         result[ITEM_COUNT] = len(filtered_items)
         result["FilteredTotalItemCount"] = len(filtered_items)
         result.__name__ = self.request.view_name
         result.__parent__ = self.request.context
-        batch_size, batch_start = self._get_batch_size_start()
         if batch_size is not None and batch_start is not None:
             self._batch_items_iterable(result, result[ITEMS],
                                        batch_size=batch_size,
                                        batch_start=batch_start)
+        elif isinstance(filtered_items, LazyInvitations):
+            result[ITEMS] = list(filtered_items)
         return result
 
     def __call__(self):
-        if not is_admin_or_site_admin(self.remoteUser):
+        if not request_is_admin_or_site_admin(self.remoteUser, self.request):
             logger.exception(
                 'User %s failed permissions check for site invitations.',
                 self.remoteUser
             )
             raise hexc.HTTPForbidden()
-        if self._params.get('site') and is_site_admin(self.remoteUser):
+        if      self._params.get('site') \
+            and request_is_site_admin(self.remoteUser, self.request):
             # Site admins cannot filter by site name
             raise hexc.HTTPForbidden()
         return self._do_call()
@@ -1176,6 +1337,32 @@ class GetPendingSiteInvitationsView(GetSiteInvitationsView):
         return get_pending_invitations(mimeTypes=self.mime_types,
                                        sites=self.site)
 
+    def get_invitation_ids(self):
+        return get_site_invitation_ids(sites=self.site,
+                                       mimeTypes=self.mime_types,
+                                       type_filter='pending')
+
+
+@view_config(route_name='objects.generic.traversal',
+             renderer='rest',
+             context=InvitationsPathAdapter,
+             request_method='GET',
+             name=REL_SITE_INVITATION_COUNTS)
+class SiteInvitationCountsView(GetSiteInvitationsView):
+    """
+    The pending, accepted and expired invitation counts of a site, in
+    total and by mimetype, answered from the catalog alone.
+    """
+
+    def _do_call(self):
+        result = LocatedExternalDict()
+        result.__name__ = self.request.view_name
+        result.__parent__ = self.request.context
+        result.update(get_site_invitation_counts(sites=self.site,
+                                                 mimeTypes=self.mime_types))
+        result['Site'] = self.site
+        return result
+
 
 @view_config(route_name='objects.generic.traversal',
              request_method='GET',
@@ -1187,6 +1374,12 @@ class SiteInvitationsCSVView(GetSiteInvitationsView):
     Get site invitations in CSV format.
     """
 
+    #: Exports larger than this are spooled to disk
+    _EXPORT_SPOOL_SIZE = 1024 * 1024
+
+    #: The size of the chunks the written export is sent in
+    _EXPORT_CHUNK_SIZE = 64 * 1024
+
     def _replace_username(self, username):
         substituter = component.queryUtility(IUsernameSubstitutionPolicy)
         if substituter is None:
@@ -1205,30 +1398,47 @@ class SiteInvitationsCSVView(GetSiteInvitationsView):
             logger.debug("Cannot parse time '%s'", t)
             return str(t)
 
+    @Lazy
+    def _user_info_cache(self):
+        return dict()
+
+    def _get_user_info(self, username):
+        """
+        Return the (substituted) username, email, alias and realname of the
+        given user, or None if there is no such user. These are resolved
+        once per user for each export.
+        """
+        try:
+            return self._user_info_cache[username]
+        except KeyError:
+            pass
+        result = None
+        user = User.get_user(username) if username else None
+        if user:
+            named = IFriendlyNamed(user)
+            result = (self._replace_username(user.username),
+                      self._get_email(user),
+                      named.alias,
+                      named.realname)
+        self._user_info_cache[username] = result
+        return result
+
     def _build_inv_info(self, invitation):
         sender_username = invitation.sender
-        sender_user = User.get_user(sender_username)
+        sender_info = self._get_user_info(sender_username)
         sender_email = sender_alias = sender_realname = u''
-        if sender_user: 
-            sender_username = self._replace_username(sender_username)
-            sender_email = self._get_email(sender_user)
-            sender_named = IFriendlyNamed(sender_user)
-            sender_alias = sender_named.alias
-            sender_realname = sender_named.realname
-            
-        # May be username of (accepted) invite or the email the invitation was 
-        # sent to. 
+        if sender_info:
+            sender_username, sender_email, sender_alias, sender_realname = sender_info
+
+        # May be username of (accepted) invite or the email the invitation was
+        # sent to.
         rec_username = invitation.receiver
-        rec_user = User.get_user(rec_username)
+        rec_info = self._get_user_info(rec_username)
         invitation_email = invitation.original_receiver or rec_username
         rec_alias = rec_realname = rec_username = rec_email = u''
-        if rec_user: 
-            rec_username = self._replace_username(rec_user.username)
-            rec_email = self._get_email(rec_user)
-            rec_named = IFriendlyNamed(rec_user)
-            rec_alias = rec_named.alias
-            rec_realname = rec_named.realname
-            
+        if rec_info:
+            rec_username, rec_email, rec_alias, rec_realname = rec_info
+
         sent_time = self._format_time(invitation.sent)
         expiry_time = self._format_time(invitation.expiryTime)
         accepted_time = self._format_time(invitation.acceptedTime)
@@ -1253,8 +1463,11 @@ class SiteInvitationsCSVView(GetSiteInvitationsView):
     def _do_call(self):
         invitations = self.get_invitations()
         invitations = self.filter_and_sort_invitations(invitations)
-        
-        stream = BytesIO()
+
+        # The rows need our transaction (and its connection), so the
+        # whole export is written before the response starts; it is
+        # only held in memory up to a threshold before spilling to disk.
+        stream = tempfile.SpooledTemporaryFile(max_size=self._EXPORT_SPOOL_SIZE)
         fieldnames = ['sender username', 'sender email', 'sender alias', 'invitation email',
                       'target username', 'target email', 'target alias',
                       'sent time', 'accepted time', 'expiration time', 
@@ -1269,7 +1482,9 @@ class SiteInvitationsCSVView(GetSiteInvitationsView):
             csv_writer.writerow(inv_info)
 
         response = self.request.response
-        response.body = stream.getvalue()
+        response.content_length = stream.tell()
+        stream.seek(0)
+        response.app_iter = FileIter(stream, block_size=self._EXPORT_CHUNK_SIZE)
         response.content_encoding = 'identity'
         response.content_type = 'text/csv; charset=UTF-8'
         response.content_disposition = 'attachment; filename="invitations_export.csv"'
@@ -1330,7 +1545,7 @@ class SetGenericSiteInvitationCode(AbstractAuthenticatedView,
         return component.getUtility(IInvitationsContainer)
 
     def __call__(self):
-        if not is_admin_or_site_admin(self.remoteUser):
+        if not request_is_admin_or_site_admin(self.remoteUser, self.request):
             logger.info(
                 'User %s failed permissions check for creating a generic site invitation.',
                 self.remoteUser
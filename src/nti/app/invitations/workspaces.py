@@ -22,6 +22,7 @@ from nti.app.invitations import INVITATIONS
 from nti.app.invitations import REL_GENERIC_SITE_INVITATION
 from nti.app.invitations import REL_DELETE_SITE_INVITATIONS
 from nti.app.invitations import REL_SEND_SITE_INVITATION
+from nti.app.invitations import REL_SITE_INVITATION_COUNTS
 from nti.app.invitations import REL_PENDING_SITE_INVITATIONS
 from nti.app.invitations import REL_ACCEPT_INVITATION
 from nti.app.invitations import REL_DECLINE_INVITATION
@@ -29,9 +30,13 @@ from nti.app.invitations import REL_ACCEPT_INVITATIONS
 from nti.app.invitations import REL_PENDING_INVITATIONS
 from nti.app.invitations import REL_INVITATION_INFO
 
+from nti.app.invitations.caches import user_has_pending_invitations
+
 from nti.app.invitations.interfaces import IInvitationsWorkspace
 from nti.app.invitations.interfaces import IUserInvitationsLinkProvider
 
+from nti.app.invitations.utils import request_is_admin_or_site_admin
+
 from nti.app.invitations.views import InvitationsPathAdapter
 
 from nti.appserver.workspaces import IGlobalWorkspaceLinkProvider
@@ -40,16 +45,12 @@ from nti.appserver.workspaces.interfaces import IUserService
 from nti.appserver.workspaces.interfaces import IUserWorkspace
 from nti.appserver.workspaces.interfaces import IContainerCollection
 
-from nti.dataserver.authorization import is_admin_or_site_admin
-
 from nti.dataserver.interfaces import IDataserver
 from nti.dataserver.interfaces import IDataserverFolder
 from nti.dataserver.interfaces import IUser
 
 from nti.dataserver.users.interfaces import IUserProfile
 
-from nti.invitations.utils import has_pending_invitations
-
 from nti.links.links import Link
 
 from nti.property.property import alias
@@ -159,9 +160,8 @@ class _DefaultUserInvitationsLinksProvider(object):
             interface.alsoProvides(link, ILocation)
             result.append(link)
 
-        username = self.user.username
         email = getattr(IUserProfile(self.user, None), 'email', None)
-        if has_pending_invitations(receivers=(username, email)):
+        if user_has_pending_invitations(self.user, email):
             link = Link(self.user,
                         method="GET",
                         rel=REL_PENDING_INVITATIONS,
@@ -195,7 +195,7 @@ class _DefaultSiteInvitationsLinksProvider(object):
         result = []
 
         # TODO we may not want this quite so rigid
-        if not is_admin_or_site_admin(self.user):
+        if not request_is_admin_or_site_admin(self.user):
             return result
         
         link = Link(self.ds,
@@ -212,7 +212,8 @@ class _DefaultSiteInvitationsLinksProvider(object):
             link = self._create_link(name, name, 'POST', InvitationsPathAdapter)
             result.append(link)
 
-        for name in (REL_PENDING_SITE_INVITATIONS,):
+        for name in (REL_PENDING_SITE_INVITATIONS,
+                     REL_SITE_INVITATION_COUNTS):
             link = self._create_link(name, name, 'GET', InvitationsPathAdapter)
             result.append(link)
 